@@ -0,0 +1,285 @@
+"""
+Admission control for the Gemini-backed endpoints.
+
+All users share one GEMINI_API_KEY quota, so every request is admitted against:
+- a token bucket refilled at ADMISSION_TPM tokens per minute, charged with the
+  request's estimated token cost (images and PDF pages cost far more than text),
+- a per-endpoint concurrency limit, so a burst of uploads can't take every worker,
+- a per-endpoint reserve: image endpoints can't drain the last part of the bucket,
+  which keeps headroom for chat.
+
+Requests that can't be admitted right away wait in per-client queues served
+round-robin, so one client (IP) uploading in a loop doesn't delay everyone else.
+A request that would wait longer than ADMISSION_MAX_WAIT seconds, or a client
+with too many queued requests, is rejected with AdmissionRejected, which the
+endpoints turn into a 429 with Retry-After.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+
+# Rough Gemini token costs, prompt + typical answer. Images are ~258 tokens per
+# 768px tile after preprocessing; chat adds ~600 tokens of system instruction.
+COST_ESTIMATES = {
+    'chat': 1100,
+    'stream': 1100,
+    'report': 1800,
+    'analyze': 3000,  # Per page
+    'form': 3000,  # Per page
+    'batch': 1800,  # Per photo (near-duplicates share a call, so this is the worst case)
+}
+CHARS_PER_TOKEN = 4
+
+
+def estimate_cost(endpoint, text='', pages=1):
+    """Estimated Gemini tokens for one request to `endpoint`."""
+    return COST_ESTIMATES.get(endpoint, 1000) * max(1, pages) + len(text or '') // CHARS_PER_TOKEN
+
+
+@dataclass(frozen=True)
+class EndpointLimit:
+    max_concurrent: int
+    reserve: float = 0.0  # Fraction of bucket capacity this endpoint must leave untouched
+
+
+def default_limits():
+    image_limit = int(os.getenv("ADMISSION_IMAGE_CONCURRENCY", "8"))
+    chat_limit = int(os.getenv("ADMISSION_CHAT_CONCURRENCY", "32"))
+    image_reserve = float(os.getenv("ADMISSION_CHAT_RESERVE", "0.2"))
+    # Each batch runs up to BATCH_WORKERS model calls itself
+    batch_limit = int(os.getenv("ADMISSION_BATCH_CONCURRENCY", "2"))
+    return {
+        'chat': EndpointLimit(chat_limit),
+        'stream': EndpointLimit(chat_limit),
+        'report': EndpointLimit(image_limit, image_reserve),
+        'analyze': EndpointLimit(image_limit, image_reserve),
+        'form': EndpointLimit(image_limit, image_reserve),
+        'batch': EndpointLimit(batch_limit, image_reserve),
+    }
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """One request's place in line; holds its endpoint slot and tokens once granted."""
+
+    __slots__ = ('endpoint', 'client', 'cost', 'deadline', 'enqueued_at', 'granted', 'released', 'wake')
+
+    def __init__(self, endpoint, client, cost, deadline, now, wake):
+        self.endpoint = endpoint
+        self.client = client
+        self.cost = cost
+        self.deadline = deadline
+        self.enqueued_at = now
+        self.granted = False
+        self.released = False
+        self.wake = wake
+
+
+class AdmissionController:
+    """
+    Token bucket + per-endpoint concurrency + per-client round-robin queues.
+    Thread-safe; acquire() blocks a worker thread, acquire_async() awaits.
+    """
+
+    def __init__(self, tokens_per_minute, burst=None, limits=None, max_wait=10.0,
+                 client_queue=8, clock=time.monotonic):
+        self.rate = tokens_per_minute / 60.0  # Tokens per second; 0 disables the bucket
+        self.capacity = burst or tokens_per_minute / 6.0  # Default burst: 10 seconds of quota
+        self.limits = limits or default_limits()
+        self.max_wait = max_wait
+        self.client_queue = client_queue
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.in_flight = dict.fromkeys(self.limits, 0)
+        self.queues = OrderedDict()  # client -> deque of waiting tickets, in round-robin order
+        self.counts = {name: {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0} for name in self.limits}
+        self.wait_total = dict.fromkeys(self.limits, 0.0)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            tokens_per_minute=float(os.getenv("ADMISSION_TPM", "1000000")),
+            burst=float(os.getenv("ADMISSION_BURST", "0")) or None,
+            max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "10")),
+            client_queue=int(os.getenv("ADMISSION_CLIENT_QUEUE", "8")),
+        )
+
+    # --- bucket and scheduling (call with self.lock held) ---
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _shortfall(self, ticket):
+        """Tokens missing before `ticket` fits above its endpoint's reserve (0 when it fits)."""
+        if self.rate <= 0:
+            return 0.0
+        floor = self.capacity * self.limits[ticket.endpoint].reserve
+        return max(0.0, ticket.cost + floor - self.tokens)
+
+    def _admissible(self, ticket):
+        return (self.in_flight[ticket.endpoint] < self.limits[ticket.endpoint].max_concurrent
+                and self._shortfall(ticket) == 0)
+
+    def _grant(self, ticket, now):
+        ticket.granted = True
+        self.in_flight[ticket.endpoint] += 1
+        if self.rate > 0:
+            self.tokens -= ticket.cost
+        self.counts[ticket.endpoint]['admitted'] += 1
+        self.wait_total[ticket.endpoint] += now - ticket.enqueued_at
+
+    def _dispatch(self, now):
+        """Grants queued tickets round-robin over clients until nobody at the head of a queue fits."""
+        granted = True
+        while granted and self.queues:
+            granted = False
+            for client in list(self.queues):
+                queue = self.queues[client]
+                if not self._admissible(queue[0]):
+                    continue
+                ticket = queue.popleft()
+                self._grant(ticket, now)
+                ticket.wake()
+                granted = True
+                # Served clients go to the back of the rotation
+                if queue:
+                    self.queues.move_to_end(client)
+                else:
+                    del self.queues[client]
+
+    def _retry_after(self, ticket):
+        shortfall = self._shortfall(ticket)
+        wait = shortfall / self.rate if shortfall and self.rate else 1.0
+        return max(1, math.ceil(wait))
+
+    def _enqueue(self, endpoint, client, cost, wake):
+        """Returns a ticket (possibly already granted) or raises AdmissionRejected."""
+        if endpoint not in self.limits:
+            raise KeyError(f"Unknown admission endpoint: {endpoint}")
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            # Serve whoever is already waiting before letting a newcomer in
+            self._dispatch(now)
+            # A request bigger than the whole bucket would never fit; charge it a full bucket instead
+            cost = min(cost, self.capacity * (1 - self.limits[endpoint].reserve)) if self.rate > 0 else cost
+            ticket = Ticket(endpoint, client, cost, now + self.max_wait, now, wake)
+
+            queue = self.queues.get(client)
+            if queue is None and self._admissible(ticket):
+                self._grant(ticket, now)
+                return ticket
+            if queue is not None and len(queue) >= self.client_queue:
+                self.counts[endpoint]['rejected'] += 1
+                raise AdmissionRejected("Too many queued requests from this client", self._retry_after(ticket))
+            # Not worth queueing if the bucket can't refill in time
+            if self.rate > 0 and self._shortfall(ticket) / self.rate > self.max_wait:
+                self.counts[endpoint]['rejected'] += 1
+                raise AdmissionRejected("Request quota exhausted", self._retry_after(ticket))
+
+            self.queues.setdefault(client, deque()).append(ticket)
+            self.counts[endpoint]['queued'] += 1
+            self._dispatch(now)
+            return ticket
+
+    def _poll(self, ticket):
+        """Returns seconds to wait before checking again, 0 once granted; raises when the wait is over."""
+        with self.lock:
+            if ticket.granted:
+                return 0
+            now = self.clock()
+            self._refill(now)
+            self._dispatch(now)
+            if ticket.granted:
+                return 0
+            if now >= ticket.deadline:
+                queue = self.queues.get(ticket.client)
+                if queue is not None:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self.queues[ticket.client]
+                self.counts[ticket.endpoint]['timed_out'] += 1
+                raise AdmissionRejected("Server is busy", self._retry_after(ticket))
+            # Tokens refill continuously, so re-check at least every 100ms
+            return min(ticket.deadline - now, 0.1)
+
+    # --- public API ---
+
+    def acquire(self, endpoint, client, cost):
+        """Blocks until admitted; returns a ticket to pass to release()."""
+        event = threading.Event()
+        ticket = self._enqueue(endpoint, client, cost, event.set)
+        while True:
+            delay = self._poll(ticket)
+            if not delay:
+                return ticket
+            event.wait(delay)
+
+    async def acquire_async(self, endpoint, client, cost):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        ticket = self._enqueue(endpoint, client, cost, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                delay = self._poll(ticket)
+                if not delay:
+                    return ticket
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            # Client went away while queued: give the slot back if it was just granted
+            with self.lock:
+                queue = self.queues.get(ticket.client)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self.queues[ticket.client]
+            if ticket.granted:
+                self.release(ticket)
+            raise
+
+    def release(self, ticket):
+        """Frees the endpoint slot. Safe to call more than once."""
+        with self.lock:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            self.in_flight[ticket.endpoint] -= 1
+            self._dispatch(self.clock())
+
+    def stats(self):
+        with self.lock:
+            self._refill(self.clock())
+            endpoints = {}
+            for name, counts in self.counts.items():
+                admitted = counts['admitted']
+                endpoints[name] = dict(
+                    counts,
+                    in_flight=self.in_flight[name],
+                    max_concurrent=self.limits[name].max_concurrent,
+                    avg_wait_ms=round(self.wait_total[name] / admitted * 1000, 1) if admitted else 0.0,
+                )
+            return {
+                'tokens_available': round(self.tokens) if self.rate > 0 else None,
+                'capacity': round(self.capacity) if self.rate > 0 else None,
+                'tokens_per_minute': round(self.rate * 60),
+                'queued': sum(len(queue) for queue in self.queues.values()),
+                'queued_clients': len(self.queues),
+                'endpoints': endpoints,
+            }
@@ -0,0 +1,549 @@
+"""
+Async serving mode for the CitiAssist API.
+
+Same endpoints and JSON shapes as main.py, but served by Quart on an ASGI
+server so a single process can keep hundreds of Gemini calls in flight:
+model calls use the SDK's *_async methods, and Pillow work (preprocessing,
+form rendering) runs in a thread pool so it never blocks the event loop.
+Only the request handling lives here: everything else an endpoint does
+(ChatTurn, stored_answer and the *_call / *_reply halves around each model
+call) is shared with main.py, so the two apps can't drift apart.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+or, with one event loop per worker process:
+    SERVER_MODE=asgi gunicorn -c gunicorn.conf.py
+"""
+import asyncio
+import base64
+import contextvars
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, Response, jsonify, request
+from quart_cors import cors
+
+import main
+from main import (
+    ANALYZE_VERSION,
+    FORM_VERSION,
+    JOB_ENDPOINTS,
+    REPORT_VERSION,
+    BATCH_MAX_IMAGES,
+    ChatTurn,
+    admission,
+    analyze_call,
+    analyze_pdf_response,
+    analyze_reply,
+    batch_cost,
+    batch_uploads,
+    read_batch,
+    binary_form_output,
+    chat_cache,
+    chat_cost,
+    client_id,
+    extract_pdf_fields,
+    form_fields_call,
+    form_fields_reply,
+    form_fill_body,
+    form_sessions,
+    job_wait_seconds,
+    open_form_session,
+    prepare_upload,
+    queue_job,
+    report_call,
+    report_reply,
+    requested_output_format,
+    sse_event,
+    stored_answer,
+    stream_error,
+    too_many_requests,
+    upload_cost,
+    upstream_unavailable,
+    wants_job,
+)
+from admission import AdmissionRejected
+from dispatcher import AsyncChatDispatcher
+from structured_output import structured_stats
+from form_renderer import render_filled_form, render_filled_pdf
+from gemini_client import UpstreamUnavailable
+from image_pipeline import pipeline_stats
+from job_queue import JOBS_ENABLED
+from pdf_pages import is_pdf
+from observability import (begin_request, finish_request, log, log_exception, metrics, profiler,
+                           profiler_authorized, profiler_command, redact, span)
+
+app = cors(Quart(__name__))
+
+
+@app.before_request
+async def start_request_context():
+    begin_request(request.url_rule.rule if request.url_rule else None, request.method,
+                  request.headers.get('X-Request-ID'))
+
+
+@app.after_request
+async def finish_request_context(response):
+    rid = finish_request(response.status_code)
+    if rid:
+        response.headers['X-Request-ID'] = rid
+    return response
+
+
+@app.before_serving
+async def start_warm_up():
+    main.start_warm_up()
+
+
+@app.after_serving
+async def begin_drain():
+    main.begin_drain()
+
+# Pillow releases the GIL for most decode/encode work, so threads scale well here
+image_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("IMAGE_WORKERS", str(min(8, (os.cpu_count() or 1) + 2)))),
+    thread_name_prefix="image",
+)
+
+
+chat_dispatcher = AsyncChatDispatcher(
+    lambda prompt: main.gemini.generate_async(prompt, policy='chat'),
+    window_ms=main.CHAT_BATCH_WINDOW_MS,
+    max_batch=main.CHAT_BATCH_MAX,
+) if main.CHAT_DISPATCH else None
+
+
+async def run_in_pool(func, *args):
+    # Copy the request context so spans and logs in the worker keep the request ID
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(image_pool, functools.partial(context.run, func, *args))
+
+
+async def read_upload():
+    """Returns (image_bytes, error_response)."""
+    files = await request.files
+    if 'image' not in files:
+        return None, (jsonify({'error': 'No image uploaded'}), 400)
+    file = files['image']
+    if file.filename == '':
+        return None, (jsonify({'error': 'No selected file'}), 400)
+    return file.read(), None
+
+
+async def estimate_request_cost(endpoint):
+    if endpoint in ('chat', 'stream'):
+        data = request.args if request.method == 'GET' else ((await request.get_json(silent=True)) or {})
+        return chat_cost(endpoint, str(data.get('message', '')))
+    files = await request.files
+    return await run_in_pool(upload_cost, endpoint, files.get('image'))
+
+
+def admitted(endpoint):
+    """Async twin of main.admitted: waits in the fair queue without blocking the event loop."""
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            if endpoint in JOB_ENDPOINTS and wants_job(request):
+                return await view(*args, **kwargs)  # Admitted when a job worker starts it
+            try:
+                ticket = await admission.acquire_async(endpoint, client_id(request),
+                                                       await estimate_request_cost(endpoint))
+            except AdmissionRejected as e:
+                return too_many_requests(e)
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                admission.release(ticket)
+        return wrapper
+    return decorator
+
+
+async def submit_job(endpoint, work, image_bytes):
+    """Async twin of main.submit_job; the job runs `work` (a sync main.py function) on the job pool."""
+    return await asyncio.to_thread(queue_job, endpoint, work, image_bytes, client_id(request),
+                                   request.headers.get('Idempotency-Key'))
+
+
+@app.route('/api/chat', methods=['POST'])
+@admitted('chat')
+async def chat():
+    try:
+        data = await request.get_json()
+        user_message = data.get('message', '')
+
+        if not user_message:
+            return jsonify({'error': 'Message is required'}), 400
+
+        log('chat_message', message=redact(user_message), conversation='conversation_id' in data)
+
+        # Store reads/writes (and the occasional summary call) block, so they run off the event loop
+        turn = await asyncio.to_thread(ChatTurn, data)
+        if turn.instant is not None:
+            return jsonify(await asyncio.to_thread(turn.instant_body, response=turn.instant[0]))
+
+        if chat_dispatcher is not None and turn.dispatch_key is not None:
+            response = await chat_dispatcher.submit(turn.dispatch_key, turn.prompt, main.CHAT_DEADLINE)
+        else:
+            response = await main.gemini.generate_async(turn.contents, policy='chat')
+        return jsonify(await asyncio.to_thread(turn.reply_body, response))
+
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except Exception as e:
+        log_exception('chat_failed', e)
+        return jsonify({'error': 'An error occurred', 'details': str(e)}), 500
+
+
+@app.route('/api/chat/stream', methods=['GET', 'POST'])
+async def chat_stream():
+    data = request.args if request.method == 'GET' else ((await request.get_json(silent=True)) or {})
+    user_message = data.get('message', '')
+
+    if not user_message:
+        return jsonify({'error': 'Message is required'}), 400
+
+    try:
+        # Held until the stream ends, so it is released by the generator rather than a decorator
+        ticket = await admission.acquire_async('stream', client_id(request), await estimate_request_cost('stream'))
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+
+    try:
+        turn = await asyncio.to_thread(ChatTurn, data)
+    except BaseException:
+        admission.release(ticket)
+        raise
+
+    async def generate():
+        start_time = time.perf_counter()
+        first_chunk_ms = None
+        parts = []
+        try:
+            yield ": stream-open\n\n"
+            if turn.instant is not None:
+                yield sse_event({'text': turn.instant[0]})
+                done = await asyncio.to_thread(turn.instant_body, chunks=1,
+                                               elapsed_ms=round((time.perf_counter() - start_time) * 1000, 1))
+                yield sse_event(done, event='done')
+                return
+            try:
+                response = await main.gemini.generate_async(turn.contents, policy='stream', stream=True)
+                async for chunk in response:
+                    if not chunk.parts:
+                        continue
+                    if first_chunk_ms is None:
+                        first_chunk_ms = round((time.perf_counter() - start_time) * 1000, 1)
+                    parts.append(chunk.text)
+                    yield sse_event({'text': chunk.text})
+                for frame in await asyncio.to_thread(turn.stream_end, response, parts, start_time, first_chunk_ms):
+                    yield frame
+            except asyncio.CancelledError:
+                # Client disconnected; the cancelled await tears down the upstream call
+                log('stream_cancelled')
+                raise
+            except Exception as e:
+                yield stream_error(e)
+        finally:
+            admission.release(ticket)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.timeout = None  # Streams may outlive Quart's default response timeout
+    return response
+
+
+@app.route('/api/chat/conversations/<conversation_id>', methods=['DELETE'])
+async def end_conversation(conversation_id):
+    await asyncio.to_thread(main.conversations.delete, conversation_id)
+    return jsonify({'deleted': conversation_id})
+
+
+@app.route('/api/chat/conversation-stats', methods=['GET'])
+async def chat_conversation_stats():
+    return jsonify(dict(await asyncio.to_thread(main.conversations.stats), enabled=main.CONVERSATIONS))
+
+
+@app.route('/api/chat/cache-stats', methods=['GET'])
+async def chat_cache_stats():
+    return jsonify(chat_cache.stats())
+
+
+@app.route('/api/chat/civic-stats', methods=['GET'])
+async def chat_civic_stats():
+    return jsonify(dict(main.civic_index.stats(), direct=main.CIVIC_DIRECT, context=main.CIVIC_CONTEXT))
+
+
+@app.route('/healthz', methods=['GET'])
+async def healthz():
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz', methods=['GET'])
+async def readyz():
+    main.start_warm_up()
+    stores_ok = await asyncio.to_thread(
+        lambda: form_sessions.ping() and main.conversations.store.ping() and main.jobs.store.ping())
+    checks = {'warm': main.ready.is_set(), 'draining': main.draining.is_set(),
+              'session_store': stores_ok, 'gemini_api_key': bool(main.GENAI_API_KEY)}
+    ok = checks['warm'] and not checks['draining'] and checks['session_store']
+    return jsonify(dict(checks, ready=ok)), 200 if ok else 503
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    # Collectors read the session stores, which may hit SQLite or Redis
+    return Response(await asyncio.to_thread(metrics.render), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/debug/profiler', methods=['GET', 'POST'])
+async def debug_profiler():
+    if not profiler_authorized(request.headers):
+        return jsonify({'error': 'Not found'}), 404
+    if request.method == 'POST':
+        return jsonify(profiler_command((await request.get_json(silent=True)) or {}))
+    if request.args.get('format') == 'collapsed':
+        return Response(profiler.collapsed(), mimetype='text/plain')
+    return jsonify(profiler.status())
+
+
+@app.route('/api/token-usage', methods=['GET'])
+async def token_usage():
+    cache_stats = getattr(main.gemini.model_factory, 'stats', None)
+    return jsonify({'endpoints': main.token_meter.snapshot(), 'context_cache': cache_stats})
+
+
+@app.route('/api/chat/intent-stats', methods=['GET'])
+async def chat_intent_stats():
+    return jsonify(dict(main.intent_stats.snapshot(), enabled=main.INTENT_FILTER))
+
+
+@app.route('/api/chat/dispatch-stats', methods=['GET'])
+async def chat_dispatch_stats():
+    if chat_dispatcher is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(chat_dispatcher.stats.snapshot(), enabled=True, window_ms=main.CHAT_BATCH_WINDOW_MS))
+
+
+@app.route('/api/upload-cache-stats', methods=['GET'])
+async def upload_cache_stats():
+    return jsonify(dict(await asyncio.to_thread(main.uploads.stats), preprocess=pipeline_stats()))
+
+
+@app.route('/api/upstream-stats', methods=['GET'])
+async def upstream_stats():
+    return jsonify(dict(main.gemini.stats(), structured_output=structured_stats()))
+
+
+@app.route('/api/admission-stats', methods=['GET'])
+async def admission_stats():
+    return jsonify(admission.stats())
+
+
+@app.route('/api/report-issue', methods=['POST'])
+@admitted('report')
+async def report_issue():
+    try:
+        image_bytes, error = await read_upload()
+        if error:
+            return error
+
+        digest, stored = await run_in_pool(stored_answer, image_bytes, 'report', REPORT_VERSION)
+        if stored is not None:
+            return jsonify(dict(stored, cached=True))
+
+        prepared = await run_in_pool(prepare_upload, image_bytes, "photo", digest)
+        response = await main.gemini.generate_async(**report_call(prepared))
+        # Parsing stores the answer, and a malformed reply gets a (rare) repair call: both block
+        return jsonify(await asyncio.to_thread(report_reply, digest, response))
+
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except Exception as e:
+        log_exception('report_failed', e)
+        return jsonify({'error': 'Image processing failed', 'details': str(e)}), 500
+
+
+@app.route('/api/report-issue/batch', methods=['POST'])
+async def report_issue_batch():
+    """Async twin of main.report_issue_batch; main's line generator is stepped on a worker thread."""
+    files = batch_uploads(await request.files)
+    if not files:
+        return jsonify({'error': 'No image uploaded'}), 400
+    if len(files) > BATCH_MAX_IMAGES:
+        return jsonify({'error': f'At most {BATCH_MAX_IMAGES} images per batch'}), 413
+
+    try:
+        # Held until the stream ends, so it is released by the generator rather than a decorator
+        ticket = await admission.acquire_async('batch', client_id(request), batch_cost(files))
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+
+    uploaded = await run_in_pool(read_batch, files)
+
+    async def generate():
+        lines = main.batch_report_lines(uploaded)
+        try:
+            while True:
+                line = await asyncio.to_thread(next, lines, None)
+                if line is None:
+                    return
+                yield line
+        finally:
+            # On disconnect the generator is dropped between lines; photos already submitted still finish
+            admission.release(ticket)
+
+    response = Response(generate(), mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.timeout = None
+    return response
+
+
+@app.route('/api/analyze-document', methods=['POST'])
+@admitted('analyze')
+async def analyze_document():
+    try:
+        image_bytes, error = await read_upload()
+        if error:
+            return error
+        if wants_job(request):
+            return await submit_job('analyze', main.analyze_response, image_bytes)
+
+        digest, stored = await run_in_pool(stored_answer, image_bytes, 'analyze', ANALYZE_VERSION)
+        if stored is not None:
+            return jsonify(dict(stored, cached=True))
+
+        if is_pdf(image_bytes):
+            # Pages are rendered and analyzed by the bounded PDF page pool
+            return jsonify(await asyncio.to_thread(analyze_pdf_response, digest, image_bytes))
+
+        prepared = await run_in_pool(prepare_upload, image_bytes, "document", digest)
+        response = await main.gemini.generate_async(**analyze_call(prepared))
+        return jsonify(await run_in_pool(analyze_reply, digest, response))
+
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except Exception as e:
+        log_exception('analyze_failed', e)
+        return jsonify({'error': 'Document analysis failed', 'details': str(e)}), 500
+
+
+@app.route('/api/start-form-fill', methods=['POST'])
+@admitted('form')
+async def start_form_fill():
+    try:
+        image_bytes, error = await read_upload()
+        if error:
+            return error
+        if wants_job(request):
+            return await submit_job('form', main.form_fill_response, image_bytes)
+
+        # Session stores may hit disk/network; keep that off the loop as well
+        session_id = await run_in_pool(open_form_session, image_bytes)
+
+        digest, stored = await run_in_pool(stored_answer, image_bytes, 'form', FORM_VERSION)
+        if stored is not None:
+            return jsonify(form_fill_body(session_id, stored, True))
+
+        if is_pdf(image_bytes):
+            fields_data, cached, coverage = await asyncio.to_thread(extract_pdf_fields, image_bytes)
+            return jsonify(form_fill_body(session_id, fields_data, cached, coverage))
+
+        prepared = await run_in_pool(prepare_upload, image_bytes, "document", digest)
+        fields_data, fingerprint, call = await run_in_pool(form_fields_call, prepared, digest)
+        if call is None:
+            return jsonify(form_fill_body(session_id, fields_data, True))
+
+        response = await main.gemini.generate_async(**call)
+        fields_data = await asyncio.to_thread(form_fields_reply, call, fingerprint, digest, response)
+        return jsonify(form_fill_body(session_id, fields_data, False))
+
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except Exception as e:
+        log_exception('form_extraction_failed', e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+async def job_status(job_id):
+    job = await asyncio.to_thread(main.jobs.wait, job_id, job_wait_seconds(request))
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job.public())
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+async def job_events(job_id):
+    job = await asyncio.to_thread(main.jobs.get, job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+
+    async def generate(job):
+        yield ": stream-open\n\n"
+        last_status = None
+        while job is not None and not job.is_finished:
+            if job.status != last_status:
+                last_status = job.status
+                yield sse_event(job.public(), event='status')
+            else:
+                yield ": keep-alive\n\n"
+            job = await asyncio.to_thread(main.jobs.wait, job_id, 15, last_status)
+        if job is None:
+            yield sse_event({'error': 'Job not found or expired'}, event='error')
+        else:
+            yield sse_event(job.public(), event='done')
+
+    response = Response(generate(job), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.timeout = None
+    return response
+
+
+@app.route('/api/job-stats', methods=['GET'])
+async def job_stats():
+    return jsonify(dict(await asyncio.to_thread(main.jobs.stats), enabled=JOBS_ENABLED))
+
+
+@app.route('/api/fill-form', methods=['POST'])
+async def fill_form():
+    try:
+        data = await request.get_json()
+        session_id = data.get('session_id')
+        answers = data.get('answers', {})
+
+        image_bytes = await run_in_pool(form_sessions.get, session_id) if session_id else None
+        if image_bytes is None:
+            return jsonify({'error': 'Session expired or invalid'}), 400
+
+        fmt = requested_output_format(request)
+
+        if is_pdf(image_bytes):
+            with span('encode'):
+                pdf_bytes, first_page = await run_in_pool(render_filled_pdf, image_bytes, answers)
+            if fmt:
+                data, fmt = (pdf_bytes, fmt) if fmt == 'pdf' else (first_page, 'jpeg')
+                mimetype, headers = binary_form_output(fmt)
+                return Response(data, mimetype=mimetype, headers=headers)
+            return jsonify({
+                'filled_pdf_base64': f"data:application/pdf;base64,{base64.b64encode(pdf_bytes).decode()}",
+                'filled_image_base64': f"data:image/jpeg;base64,{base64.b64encode(first_page).decode()}",
+            })
+
+        with span('encode'):
+            data = await run_in_pool(render_filled_form, image_bytes, answers, fmt or 'jpeg')
+        if fmt:
+            mimetype, headers = binary_form_output(fmt)
+            return Response(data, mimetype=mimetype, headers=headers)
+        return jsonify({'filled_image_base64': f"data:image/jpeg;base64,{base64.b64encode(data).decode()}"})
+
+    except Exception as e:
+        log_exception('fill_form_failed', e)
+        return jsonify({'error': str(e)}), 500
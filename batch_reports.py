@@ -0,0 +1,140 @@
+"""
+Helpers for /api/report-issue/batch, where ward officers upload a folder of
+geotagged photos at once.
+
+- gps_coordinates() reads the EXIF GPS position, which replaces the
+  [Location] placeholder in each drafted complaint (fill_location).
+- cluster_photos() groups near-duplicate shots of the same issue. Photos are
+  duplicates when their dHash fingerprints (image_pipeline.image_fingerprint)
+  are close and, if both are geotagged, they were taken within
+  BATCH_CLUSTER_RADIUS_M of each other. Without GPS on both photos the hash
+  has to be twice as close. Each cluster gets one model call.
+- run_bounded() runs work on a shared pool, at most BATCH_WORKERS items per
+  batch at a time, and yields results as they finish, so the endpoint can
+  stream NDJSON lines in completion order.
+"""
+import contextvars
+import io
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from PIL import Image
+
+from civic_index import haversine_km
+from image_pipeline import hamming_distance
+
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "50"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+# Fine (256-bit) dHash distance for two shots of the same issue; the coarse hash only filters candidates
+BATCH_DUPLICATE_DISTANCE = int(os.getenv("BATCH_DUPLICATE_DISTANCE", "40"))
+BATCH_CLUSTER_RADIUS_M = float(os.getenv("BATCH_CLUSTER_RADIUS_M", "50"))
+COARSE_DISTANCE = 14
+ASPECT_TOLERANCE = 0.05
+
+GPS_IFD = 0x8825
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+LOCATION_PLACEHOLDER = '[Location]'
+
+# Shared by every batch; run_bounded() keeps each one to BATCH_WORKERS at a time
+_batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS * 4, thread_name_prefix="batch")
+
+
+def _degrees(value, ref):
+    degrees, minutes, seconds = (float(part) for part in value)
+    result = degrees + minutes / 60 + seconds / 3600
+    return -result if ref in ('S', 'W') else result
+
+
+def gps_coordinates(image_bytes):
+    """(lat, long) from the photo's EXIF GPS tags, or None. Reads the header only, no pixel decode."""
+    try:
+        gps = Image.open(io.BytesIO(image_bytes)).getexif().get_ifd(GPS_IFD)
+        lat = _degrees(gps[GPS_LATITUDE], gps.get(GPS_LATITUDE_REF, 'N'))
+        lon = _degrees(gps[GPS_LONGITUDE], gps.get(GPS_LONGITUDE_REF, 'E'))
+    except Exception:
+        return None  # No EXIF, no GPS block, or malformed rationals
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or (lat == 0 and lon == 0):
+        return None
+    return round(lat, 6), round(lon, 6)
+
+
+@dataclass
+class BatchPhoto:
+    index: int
+    filename: str
+    digest: str
+    prepared: object  # image_pipeline.PreparedImage
+    fingerprint: dict
+    coords: tuple = None
+
+
+def is_near_duplicate(a, b):
+    if hamming_distance(a.fingerprint['coarse'], b.fingerprint['coarse']) > COARSE_DISTANCE:
+        return False
+    if abs(a.fingerprint['aspect'] - b.fingerprint['aspect']) > ASPECT_TOLERANCE * a.fingerprint['aspect']:
+        return False
+    limit = BATCH_DUPLICATE_DISTANCE
+    if a.coords and b.coords:
+        if haversine_km(*a.coords, *b.coords) * 1000 > BATCH_CLUSTER_RADIUS_M:
+            return False
+    else:
+        limit //= 2
+    return hamming_distance(a.fingerprint['fine'], b.fingerprint['fine']) <= limit
+
+
+def cluster_photos(photos):
+    """Greedy clustering in upload order; the first photo of each cluster is the one sent to the model."""
+    clusters = []
+    for photo in sorted(photos, key=lambda p: p.index):
+        for cluster in clusters:
+            if is_near_duplicate(cluster[0], photo):
+                cluster.append(photo)
+                break
+        else:
+            clusters.append([photo])
+    return clusters
+
+
+def cluster_location(photo, cluster):
+    """The photo's own GPS position, else the first geotagged photo of its cluster."""
+    if photo.coords:
+        return photo.coords
+    return next((member.coords for member in cluster if member.coords), None)
+
+
+def location_label(coords, area=None):
+    lat, lon = coords
+    return f"{area} ({lat:.5f}, {lon:.5f})" if area else f"{lat:.5f}, {lon:.5f}"
+
+
+def fill_location(complaint, label):
+    """Copy of the complaint with [Location] replaced in every text field."""
+    return {key: value.replace(LOCATION_PLACEHOLDER, label) if isinstance(value, str) else value
+            for key, value in complaint.items()}
+
+
+def run_bounded(func, items, max_workers=BATCH_WORKERS):
+    """
+    Yields (item, result, error) for func(item), in completion order, with at
+    most max_workers calls running at once. Each call runs in the caller's
+    context so its spans and logs carry the request ID.
+    """
+    items = iter(items)
+    pending = {}
+
+    def submit_next():
+        for item in items:
+            future = _batch_pool.submit(contextvars.copy_context().run, func, item)
+            pending[future] = item
+            return
+
+    for _ in range(max_workers):
+        submit_next()
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = pending.pop(future)
+            submit_next()
+            error = future.exception()
+            yield item, (None if error else future.result()), error
@@ -0,0 +1,79 @@
+"""
+Benchmark for the /api/fill-form rendering engine.
+
+Fills the sample forms shipped with the repo with a grid of synthetic answers
+and reports fills per second for every output format, plus the size of the
+default base64 JSON payload compared with the binary response.
+
+Usage:
+    python bench_form_fill.py [--seconds 3]
+"""
+import argparse
+import base64
+import os
+import time
+
+from form_renderer import render_filled_form, render_filled_pdf
+from pdf_pages import is_pdf
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SAMPLES = [
+    os.path.join(ROOT, "dummy_form.jpg"),
+    os.path.join(ROOT, "sample govt forms", "APPLICATION_FOR_BIRTH_CERTIFICATE_page-0001.jpg"),
+    os.path.join(ROOT, "sample govt forms", "APPLICATION_FOR_BIRTH_CERTIFICATE.pdf"),
+]
+
+
+def synthetic_answers(rows=12, page=None):
+    """One answer per row in the left and right column, like a typical form."""
+    answers = {}
+    for row in range(rows):
+        ymin = 120 + row * 60
+        for col, (xmin, xmax) in enumerate([(100, 480), (520, 900)]):
+            box = [ymin, xmin, ymin + 35, xmax]
+            if page is not None:
+                box.append(page)
+            answers[f"field_{row}_{col}"] = {
+                "answer": "Ravi Kumar, H.No 1-2-34, Gachibowli, Hyderabad",
+                "box_2d": box,
+            }
+    return answers
+
+
+def run(func, seconds):
+    """Calls func repeatedly for about `seconds`; returns (fills per second, last result)."""
+    result = func()  # Warm-up: fills the font cache
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        result = func()
+        count += 1
+    return count / (time.perf_counter() - start), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=3.0, help="time budget per measurement")
+    args = parser.parse_args()
+
+    print(f"{'sample':<48} {'format':<6} {'fills/s':>8} {'bytes':>10} {'json bytes':>11}")
+    for path in SAMPLES:
+        with open(path, "rb") as f:
+            data = f.read()
+        name = os.path.basename(path)
+
+        if is_pdf(data):
+            answers = synthetic_answers(page=0)
+            rate, (pdf_bytes, _) = run(lambda: render_filled_pdf(data, answers), args.seconds)
+            json_bytes = len(base64.b64encode(pdf_bytes)) + len("data:application/pdf;base64,")
+            print(f"{name:<48} {'pdf':<6} {rate:>8.1f} {len(pdf_bytes):>10} {json_bytes:>11}")
+            continue
+
+        answers = synthetic_answers()
+        for fmt in ("jpeg", "png", "pdf"):
+            rate, output = run(lambda: render_filled_form(data, answers, fmt), args.seconds)
+            json_bytes = len(base64.b64encode(output)) + len("data:image/jpeg;base64,")
+            print(f"{name:<48} {fmt:<6} {rate:>8.1f} {len(output):>10} {json_bytes:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Calibration for the chat intent pre-classifier (intent_classifier.py).
+
+Runs every golden question through the classifier, offline and without any API
+calls. Items whose ideal answer is the "Data not available" refusal are the
+out-of-scope ones; everything else must reach the model.
+
+Reports, for a sweep of refusal thresholds:
+- false-refusal rate: in-scope questions the classifier would refuse (keep at 0),
+- refusal recall: out-of-scope questions refused without a model call,
+plus the per-question classification latency.
+
+REGRESSION_PROBES are added to the golden questions. The exit status is 1 when
+the current threshold refuses any in-scope question.
+
+Usage:
+    python calibrate_intent.py [--golden golden_dataset.jsonl] [--thresholds 1,1.5,2,2.5,3] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from intent_classifier import REFUSE_THRESHOLD, classify
+from latency_stats import percentile
+
+GOLDEN_PATH = os.getenv("EVAL_GOLDEN_PATH", "golden_dataset.jsonl")
+REFUSAL_PREFIXES = ("data not available", "डेटा उपलब्ध नहीं", "డేటా అందుబాటులో లేదు")
+
+# (question, out_of_scope) regression cases, evaluated with the golden set. These in-scope
+# questions share a word with the out-of-scope lists and were once refused.
+REGRESSION_PROBES = [
+    ("What is the STD code for landline numbers?", False),
+    ("Any good cooking classes?", False),
+    ("what is the java jazz festival date", False),
+    ("python snake in my house who to call", False),
+]
+
+
+def load_questions(path):
+    """(question, out_of_scope) pairs from the golden JSONL file."""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = json.loads(line)
+            out_of_scope = item["ideal_answer"].strip().lower().startswith(REFUSAL_PREFIXES)
+            items.append((item["question"], out_of_scope))
+    return items
+
+
+def evaluate(items, threshold):
+    in_scope = [question for question, oos in items if not oos]
+    out_of_scope = [question for question, oos in items if oos]
+    false_refusals = [question for question in in_scope if classify(question, threshold).refuse]
+    missed = [question for question in out_of_scope if not classify(question, threshold).refuse]
+    return {
+        'threshold': threshold,
+        'false_refusal_rate': round(len(false_refusals) / len(in_scope), 4) if in_scope else 0.0,
+        'refusal_recall': round(1 - len(missed) / len(out_of_scope), 4) if out_of_scope else 0.0,
+        'false_refusals': false_refusals,
+        'missed_out_of_scope': missed,
+    }
+
+
+def time_classifier(items, repeat=200):
+    latencies = []
+    for _ in range(repeat):
+        for question, _ in items:
+            start = time.perf_counter()
+            classify(question)
+            latencies.append(time.perf_counter() - start)
+    # Microseconds: summarize() rounds to 0.1ms, which is all of it
+    return {
+        'count': len(latencies),
+        'p50_us': round(percentile(latencies, 50) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 1),
+        'max_us': round(max(latencies) * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the chat intent pre-classifier on the golden set")
+    parser.add_argument("--golden", default=GOLDEN_PATH, help="JSONL golden dataset")
+    parser.add_argument("--thresholds", default="1,1.5,2,2.5,3", help="Comma-separated refusal thresholds")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    items = load_questions(args.golden) + REGRESSION_PROBES
+    sweep = [evaluate(items, float(value)) for value in args.thresholds.split(",")]
+    current = evaluate(items, REFUSE_THRESHOLD)
+    report = {
+        'questions': len(items),
+        'out_of_scope': sum(1 for _, oos in items if oos),
+        'current_threshold': REFUSE_THRESHOLD,
+        'current_false_refusals': current['false_refusals'],
+        'sweep': sweep,
+        'latency': time_classifier(items),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return 1 if current['false_refusals'] else 0
+
+    print(f"{report['questions']} questions, {report['out_of_scope']} out of scope "
+          f"(INTENT_REFUSE_THRESHOLD={REFUSE_THRESHOLD})")
+    print(f"{'threshold':>10} {'false refusals':>15} {'refusal recall':>15}")
+    for row in sweep:
+        print(f"{row['threshold']:>10} {row['false_refusal_rate']:>15.1%} {row['refusal_recall']:>15.1%}")
+    for row in sweep:
+        for question in row['false_refusals']:
+            print(f"  [{row['threshold']}] refused in-scope: {question}")
+        for question in row['missed_out_of_scope']:
+            print(f"  [{row['threshold']}] forwarded out-of-scope: {question}")
+    latency = report['latency']
+    print(f"Latency per question: p50 {latency['p50_us']}us, p99 {latency['p99_us']}us, max {latency['max_us']}us")
+    if current['false_refusals']:
+        print(f"FAIL: threshold {REFUSE_THRESHOLD} refuses {len(current['false_refusals'])} in-scope question(s)")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Offline civic knowledge index for /api/chat.
+
+Loads Hyderabad civic facts (emergency numbers, helplines, portals) and places
+(hospitals, police and fire stations, MeeSeva centres, metro stations,
+landmarks) from a versioned JSON file (CIVIC_DATA_PATH, civic_data.json) and
+builds:
+- an inverted keyword index over fact triggers and place names,
+- a grid spatial index per place category for nearest-N lookups around the
+  coordinates the frontend appends to the message, plus one over area
+  centroids that names the area the user is in (used by prompts.py).
+
+Short questions that ask for a matched fact itself (its number, helpline,
+portal or timings: an `ask_words` phrase or one of the fact's own `ask`
+phrases, and nothing from `detail_words` such as cost, delays or how to apply),
+and "nearest <place>" questions with coordinates, are answered straight from
+the index (CIVIC_DIRECT). Everything else, including questions that only
+mention a fact's topic, gets a few matching facts and places as compact
+reference lines in the prompt (CIVIC_CONTEXT), so Gemini has grounded numbers
+and names to work with.
+"""
+import json
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from observability import log
+from response_cache import detect_language, normalize_query
+
+CIVIC_DATA_PATH = os.getenv("CIVIC_DATA_PATH", "civic_data.json")
+CELL_DEGREES = 0.02  # ~2.2 km grid cells
+MAX_RADIUS_KM = float(os.getenv("CIVIC_MAX_RADIUS_KM", "15"))  # Farther places are not "nearby"
+AREA_RADIUS_KM = 4.0  # Coordinates farther than this from every area centroid get no area name
+NEAREST_COUNT = 3
+DIRECT_MAX_TOKENS = 14  # Longer questions need the model, even if they mention a fact
+CONTEXT_MAX_LINES = int(os.getenv("CIVIC_CONTEXT_LINES", "6"))
+MIN_PREFIX = 3
+EARTH_RADIUS_KM = 6371.0
+
+NEARBY_HEADERS = {
+    'en': "Nearest {label} to your location:",
+    'hi': "आपके स्थान के सबसे नजदीकी {label}:",
+    'te': "మీ స్థానానికి దగ్గరలో ఉన్న {label}:",
+}
+CATEGORY_LABELS = {
+    'en': {'hospital': "hospitals", 'police': "police stations", 'fire_station': "fire stations",
+           'meeseva': "MeeSeva centres", 'passport': "Passport Seva Kendras", 'rto': "RTO offices",
+           'ghmc': "GHMC offices", 'metro': "metro stations", 'landmark': "landmarks"},
+    'hi': {'hospital': "अस्पताल", 'police': "पुलिस स्टेशन", 'fire_station': "फायर स्टेशन",
+           'meeseva': "मीसेवा केंद्र", 'passport': "पासपोर्ट सेवा केंद्र", 'rto': "आरटीओ कार्यालय",
+           'ghmc': "जीएचएमसी कार्यालय", 'metro': "मेट्रो स्टेशन", 'landmark': "पर्यटन स्थल"},
+    'te': {'hospital': "ఆసుపత్రులు", 'police': "పోలీస్ స్టేషన్లు", 'fire_station': "అగ్నిమాపక కేంద్రాలు",
+           'meeseva': "మీసేవ కేంద్రాలు", 'passport': "పాస్‌పోర్ట్ సేవా కేంద్రాలు", 'rto': "ఆర్టీఓ కార్యాలయాలు",
+           'ghmc': "జీహెచ్ఎంసీ కార్యాలయాలు", 'metro': "మెట్రో స్టేషన్లు", 'landmark': "పర్యాటక ప్రదేశాలు"},
+}
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def tokenize(text):
+    """Normalized tokens; single ASCII letters (the "s" of "women's") are dropped."""
+    return [token for token in normalize_query(text).split() if len(token) > 1 or not token.isascii()]
+
+
+@dataclass
+class Place:
+    name: str
+    category: str
+    lat: float
+    lon: float
+    address: str = ''
+    phone: str = ''
+
+    def describe(self, distance_km=None):
+        parts = [self.name]
+        if distance_km is not None:
+            parts.append(f"{distance_km:.1f} km")
+        if self.address:
+            parts.append(self.address)
+        if self.phone:
+            parts.append(self.phone)
+        return " — ".join(parts)
+
+
+class GridIndex:
+    """Buckets places into CELL_DEGREES cells; nearest() searches outward ring by ring."""
+
+    def __init__(self, cell=CELL_DEGREES):
+        self.cell = cell
+        self.cells = {}
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell), math.floor(lon / self.cell))
+
+    def add(self, place):
+        self.cells.setdefault(self._cell(place.lat, place.lon), []).append(place)
+
+    def nearest(self, lat, lon, count=NEAREST_COUNT, max_km=MAX_RADIUS_KM):
+        """Up to `count` (distance_km, place) pairs within max_km, closest first."""
+        row, col = self._cell(lat, lon)
+        # Smallest distance one ring of cells is guaranteed to cover (longitude degrees shrink with latitude)
+        ring_km = self.cell * math.pi / 180 * EARTH_RADIUS_KM * math.cos(math.radians(min(abs(lat), 89)))
+        max_rings = int(max_km / ring_km) + 1
+        found = []
+        for ring in range(max_rings + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if max(abs(r - row), abs(c - col)) != ring:
+                        continue  # Inner rings were already searched
+                    for place in self.cells.get((r, c), ()):
+                        distance = haversine_km(lat, lon, place.lat, place.lon)
+                        if distance <= max_km:
+                            found.append((distance, place))
+            found.sort(key=lambda pair: pair[0])
+            # Anything in a later ring is at least ring * ring_km away
+            if len(found) >= count and found[count - 1][0] <= ring * ring_km:
+                break
+        return found[:count]
+
+
+class CivicIndex:
+    def __init__(self, data):
+        self.version = data.get('version', 'unversioned')
+        self.facts = data.get('facts', [])
+        self.places = [Place(**place) for place in data.get('places', [])]
+        self.tokens = {}  # token -> set of postings: ('fact', index) / ('place', index)
+        self.fact_triggers = []  # Per fact: list of trigger token sets
+        self.fact_asks = [self._phrases(fact.get('ask', [])) for fact in self.facts]
+        for index, fact in enumerate(self.facts):
+            triggers = [frozenset(tokenize(trigger)) for trigger in fact.get('triggers', [])]
+            self.fact_triggers.append([trigger for trigger in triggers if trigger])
+            for trigger in self.fact_triggers[-1]:
+                for token in trigger:
+                    self.tokens.setdefault(token, set()).add(('fact', index))
+
+        # Place names: index only tokens that identify a place ("golconda"), not shared
+        # words like "station" or "hospital", which the category lookup handles
+        name_tokens = [set(tokenize(place.name)) for place in self.places]
+        frequency = {}
+        for tokens in name_tokens:
+            for token in tokens:
+                frequency[token] = frequency.get(token, 0) + 1
+        self.place_names = []
+        for index, tokens in enumerate(name_tokens):
+            distinctive = frozenset(token for token in tokens if frequency[token] <= 2 and not token.isdigit())
+            self.place_names.append(distinctive)
+            for token in distinctive:
+                self.tokens.setdefault(token, set()).add(('place', index))
+
+        self.grids = {}
+        for place in self.places:
+            self.grids.setdefault(place.category, GridIndex()).add(place)
+        self.areas = GridIndex()
+        for area in data.get('areas', []):
+            self.areas.add(Place(category='area', **area))
+        self.category_phrases = [(frozenset(tokenize(phrase)), category)
+                                 for category, phrases in data.get('place_categories', {}).items()
+                                 for phrase in phrases]
+        self.nearby_phrases = self._phrases(data.get('nearby_words', []))
+        # A fact is only answered directly when the question asks for it, not when it just mentions it
+        self.ask_phrases = self._phrases(data.get('ask_words', []))
+        self.detail_phrases = self._phrases(data.get('detail_words', []))
+        self.vocabulary = set(self.tokens)
+        for phrase, _ in self.category_phrases:
+            self.vocabulary.update(phrase)
+        for phrases in [self.nearby_phrases, self.ask_phrases, self.detail_phrases] + self.fact_asks:
+            for phrase in phrases:
+                self.vocabulary.update(phrase)
+
+        self.lock = threading.Lock()
+        self.counts = {'lookups': 0, 'direct_facts': 0, 'direct_nearby': 0, 'context': 0, 'no_match': 0,
+                       'not_asked': 0}
+        self.total_seconds = 0.0
+
+    @classmethod
+    def load(cls, path=CIVIC_DATA_PATH):
+        if not path or not os.path.exists(path):
+            log('civic_data_missing', level='warning', path=path)
+            return cls({})
+        with open(path, "r", encoding="utf-8") as f:
+            index = cls(json.load(f))
+        log('civic_index_loaded', version=index.version, facts=len(index.facts), places=len(index.places))
+        return index
+
+    # --- matching ---
+
+    @staticmethod
+    def _phrases(words):
+        return [phrase for phrase in (frozenset(tokenize(word)) for word in words) if phrase]
+
+    def _canonical(self, token):
+        """Maps a query token onto the index vocabulary (plurals, Hindi/Telugu suffixes)."""
+        if token in self.vocabulary:
+            return token
+        if token.isascii():
+            return token[:-1] if token.endswith('s') and token[:-1] in self.vocabulary else token
+        for length in range(len(token) - 1, MIN_PREFIX - 1, -1):
+            if token[:length] in self.vocabulary:
+                return token[:length]
+        return token
+
+    def _matches(self, question):
+        tokens = {self._canonical(token) for token in tokenize(question)}
+        # Facts: fully matched triggers; a fact whose matched words are a subset of
+        # another's is dropped ("police emergency number" -> police, not the generic list)
+        covered = {}
+        for token in tokens:
+            for kind, index in self.tokens.get(token, ()):
+                if kind == 'fact' and index not in covered:
+                    matched = [trigger for trigger in self.fact_triggers[index] if trigger <= tokens]
+                    covered[index] = frozenset().union(*matched) if matched else frozenset()
+        full = {index: words for index, words in covered.items() if words}
+        facts = [index for index, words in full.items()
+                 if not any(words < other for other_index, other in full.items() if other_index != index)]
+
+        named = [index for index, name in enumerate(self.place_names)
+                 if name and len(name & tokens) * 2 >= len(name)]
+        categories = []
+        for phrase, category in self.category_phrases:
+            if phrase <= tokens and category not in categories:
+                categories.append(category)
+        nearby = any(phrase <= tokens for phrase in self.nearby_phrases)
+        return tokens, sorted(facts), named, categories, nearby
+
+    def _asks_for(self, tokens, index):
+        """Whether the question asks for fact `index` itself rather than something around its topic."""
+        if any(phrase <= tokens for phrase in self.detail_phrases):
+            return False
+        return any(phrase <= tokens for phrase in self.ask_phrases + self.fact_asks[index])
+
+    def nearest(self, category, coords, count=NEAREST_COUNT):
+        grid = self.grids.get(category)
+        if grid is None or not coords:
+            return []
+        try:
+            lat, lon = (float(value) for value in coords)
+        except (TypeError, ValueError):
+            return []
+        return grid.nearest(lat, lon, count)
+
+    def area_name(self, coords):
+        """Name of the area nearest to (lat, long), or None outside the covered city."""
+        try:
+            lat, lon = (float(value) for value in coords)
+        except (TypeError, ValueError):
+            return None
+        found = self.areas.nearest(lat, lon, 1, AREA_RADIUS_KM)
+        return found[0][1].name if found else None
+
+    # --- answers ---
+
+    def lookup(self, question, coords=None, direct=True, record=True):
+        """
+        Returns (direct answer or None, context lines). `question` is the message
+        without its coordinates; `coords` are the (lat, long) strings parsed from it.
+        record=False leaves the stats alone (admission cost estimates).
+        """
+        start = time.perf_counter()
+        language = detect_language(question)
+        tokens, facts, named, categories, nearby = self._matches(question)
+        answer, lines, outcome = None, [], 'no_match'
+        not_asked = False
+
+        if direct and len(tokens) <= DIRECT_MAX_TOKENS:
+            if nearby and coords and categories:
+                answer = self._nearby_answer(categories[0], coords, language)
+                outcome = 'direct_nearby' if answer else outcome
+            elif facts and not named:
+                # Mentioning a topic ("the ambulance came late") is not asking for its number
+                not_asked = not all(self._asks_for(tokens, index) for index in facts)
+                answers = [self.facts[index].get('answer', {}).get(language) for index in facts]
+                if not not_asked and all(answers):
+                    answer = "\n\n".join(answers)
+                    outcome = 'direct_facts'
+
+        if answer is None:
+            lines = [self.facts[index]['context'] for index in facts]
+            lines += [self.places[index].describe() for index in named]
+            for category in categories[:2]:
+                for distance, place in self.nearest(category, coords):
+                    lines.append(f"Near the user ({category}): {place.describe(distance)}")
+            lines = list(dict.fromkeys(lines))[:CONTEXT_MAX_LINES]
+            outcome = 'context' if lines else 'no_match'
+
+        elapsed = time.perf_counter() - start
+        if not record:
+            return answer, lines
+        with self.lock:
+            self.counts['lookups'] += 1
+            self.counts[outcome] += 1
+            self.counts['not_asked'] += int(not_asked)
+            self.total_seconds += elapsed
+        return answer, lines
+
+    def _nearby_answer(self, category, coords, language):
+        found = self.nearest(category, coords)
+        if not found:
+            return None
+        language = language if language in NEARBY_HEADERS else 'en'
+        label = CATEGORY_LABELS[language].get(category, category)
+        header = NEARBY_HEADERS[language].format(label=label)
+        rows = []
+        for distance, place in found:
+            details = f"{distance:.1f} km" + (f", {place.address}" if place.address else "")
+            if place.phone:
+                details += f" · 📞 {place.phone}"
+            rows.append(f"- **{place.name}** — {details}")
+        return f"**{header}**\n\n" + "\n".join(rows)
+
+    def context_block(self, lines):
+        if not lines:
+            return ""
+        return (f"REFERENCE DATA (CitiAssist civic index {self.version}; prefer these facts and places "
+                f"over memory):\n" + "\n".join(f"- {line}" for line in lines) + "\n\n")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts['lookups']
+            return dict(
+                self.counts,
+                version=self.version,
+                facts=len(self.facts),
+                places=len(self.places),
+                avg_us=round(self.total_seconds / lookups * 1e6, 1) if lookups else 0.0,
+            )
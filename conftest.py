@@ -0,0 +1,3 @@
+# test_backend.py, test_bbox.py and test_key_direct.py are manual scripts that call a
+# running server or the real Gemini API at import time; pytest only runs the offline tests.
+collect_ignore = ["test_backend.py", "test_bbox.py", "test_key_direct.py"]
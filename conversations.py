@@ -0,0 +1,258 @@
+"""
+Server-side chat conversations for /api/chat and /api/chat/stream.
+
+A conversation is a rolling summary of older turns plus the most recent turns
+verbatim. It is stored as JSON in a SessionStore (SESSION_BACKEND), so any
+worker can continue it, and idle conversations expire with the store's sliding
+TTL (CONVERSATION_TTL).
+
+Each follow-up sends the model the summary and recent turns in the chat API's
+multi-turn `contents` format, never the full transcript. When the stored
+history grows past CONVERSATION_TOKEN_BUDGET, the oldest turns are folded into
+the summary with one short model call. That call runs on a background thread
+after the turn is saved, so no response waits for it; the next turn picks up
+the summary. If it fails, the old turns are kept and summarizing is retried
+after the next turn. Until then each model call only gets the most recent
+turns that fit the budget.
+
+Only messages that refer back to the conversation (refers_back: pronouns,
+"what about ...", very short questions) are sent with the history. Standalone
+questions in a conversation are still recorded as turns, but they are answered
+like first messages, through the shared response cache and dispatcher.
+
+Saving re-reads the stored conversation and appends this request's turns to
+it, so a summary written by the background compaction in the meantime is kept.
+"""
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from admission import CHARS_PER_TOKEN
+from observability import log, log_exception
+from prompts import CONVERSATION_SUMMARY_PROMPT
+
+CONVERSATIONS = os.getenv("CONVERSATIONS", "1") == "1"
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "1800"))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "1500"))
+# Messages (user + model) that always stay verbatim when older ones are summarized
+CONVERSATION_KEEP_MESSAGES = int(os.getenv("CONVERSATION_KEEP_MESSAGES", "4"))
+SUMMARY_MAX_CHARS = 1500
+
+# Words and openings that only make sense with the earlier turns (English, Hinglish, Telugu in Latin script)
+REFERENCE_WORDS = re.compile(
+    r"\b(it|its|it's|that|this|these|those|they|them|their|he|she|him|her|his|same|above|previous|"
+    r"earlier|else|another|again|also|more|instead|ones|woh|wo|uska|uske|iska|iske|yeh|ye|vahan|wahan|"
+    r"adi|idi|daani|deeni|akkada|inka)\b", re.IGNORECASE)
+REFERENCE_OPENINGS = re.compile(r"^\s*(and|but|so|then|what about|how about|why|aur|mari)\b", re.IGNORECASE)
+SHORT_FOLLOW_UP_WORDS = 3  # "Timings?", "on Sunday?", "near Ameerpet" only make sense in context
+
+SUMMARY_PREFIX = "Summary of our conversation so far:\n"
+SUMMARY_ACK = "Understood. I'll keep that context in mind."
+
+
+def estimate_tokens(text):
+    return len(text or '') // CHARS_PER_TOKEN
+
+
+def refers_back(message):
+    """Whether a chat message depends on earlier turns to be understood."""
+    return (len(message.split()) <= SHORT_FOLLOW_UP_WORDS or bool(REFERENCE_OPENINGS.search(message))
+            or bool(REFERENCE_WORDS.search(message)))
+
+
+def summary_request(summary, messages):
+    """Prompt asking the model to fold `messages` ([role, text] pairs) into `summary`."""
+    lines = "\n".join(f"{'User' if role == 'user' else 'CitiAssist'}: {text}" for role, text in messages)
+    return CONVERSATION_SUMMARY_PROMPT.format(summary=summary or "(none)", messages=lines)
+
+
+@dataclass
+class Conversation:
+    id: str
+    summary: str = ''
+    messages: list = field(default_factory=list)  # [role, text] pairs, role is 'user' or 'model'
+    summarized: int = 0  # Messages folded into the summary so far
+    created: float = field(default_factory=time.time)
+    added: list = field(default_factory=list)  # Messages added since this copy was loaded; not stored
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(**json.loads(data))
+
+    def to_bytes(self):
+        stored = {name: value for name, value in self.__dict__.items() if name != 'added'}
+        return json.dumps(stored, ensure_ascii=False).encode('utf-8')
+
+    @property
+    def has_history(self):
+        return bool(self.summary or self.messages)
+
+    def history_tokens(self):
+        return estimate_tokens(self.summary) + sum(estimate_tokens(text) for _, text in self.messages)
+
+    def recent_messages(self, token_budget):
+        """The newest whole turns that fit in `token_budget` with the summary (at least the last turn)."""
+        budget = token_budget - estimate_tokens(self.summary)
+        recent = []
+        for start in range(len(self.messages) - 2, -1, -2):
+            turn = self.messages[start:start + 2]
+            tokens = sum(estimate_tokens(text) for _, text in turn)
+            if recent and tokens > budget:
+                break
+            budget -= tokens
+            recent[:0] = turn
+        return recent
+
+    def contents(self, prompt, token_budget=CONVERSATION_TOKEN_BUDGET):
+        """Multi-turn contents for the next model call: summary, recent messages, then `prompt`."""
+        contents = []
+        if self.summary:
+            contents.append({'role': 'user', 'parts': [SUMMARY_PREFIX + self.summary]})
+            contents.append({'role': 'model', 'parts': [SUMMARY_ACK]})
+        # Older turns still waiting for a summary stay stored but are not sent
+        contents += [{'role': role, 'parts': [text]} for role, text in self.recent_messages(token_budget)]
+        contents.append({'role': 'user', 'parts': [prompt]})
+        return contents
+
+    def add_turn(self, user_message, reply):
+        turn = [['user', user_message], ['model', reply]]
+        self.messages += turn
+        self.added += turn
+
+
+class ConversationStore:
+    """
+    Loads, compacts and saves conversations in a SessionStore.
+
+    `summarize(summary, messages)` returns the new summary text (or None); it is
+    only called, on a background thread, when a saved conversation is over the
+    token budget.
+    """
+
+    def __init__(self, store, summarize=None, token_budget=CONVERSATION_TOKEN_BUDGET,
+                 keep_messages=CONVERSATION_KEEP_MESSAGES):
+        self.store = store
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_messages = max(2, keep_messages - keep_messages % 2)  # Whole turns only
+        self._lock = threading.Lock()
+        # Serializes read-modify-write of stored conversations in this process (turns vs. summaries).
+        # Across workers, both sides re-read just before writing, which keeps the window small.
+        self._write_lock = threading.Lock()
+        self._compacting = set()
+        self._pool = None
+        self.counters = {'started': 0, 'resumed': 0, 'expired': 0, 'turns': 0,
+                         'summaries': 0, 'summary_failures': 0, 'summaries_superseded': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def open(self, conversation_id=None):
+        """The stored conversation, or a new one if the id is empty, unknown or expired."""
+        data = self.store.get(conversation_id) if conversation_id else None
+        if data is not None:
+            self._count('resumed')
+            return Conversation.from_bytes(data)
+        if conversation_id:
+            self._count('expired')
+        self._count('started')
+        return Conversation(uuid.uuid4().hex)
+
+    def _executor(self):
+        # Created on first use so a preloaded gunicorn master never forks with live pool threads
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation")
+            return self._pool
+
+    def save(self, conversation):
+        """
+        Appends the conversation's new turns to the stored copy (which a background
+        summary may have changed since it was loaded) and stores it; if it is then
+        over budget, its summary is updated in the background.
+        """
+        self._count('turns')
+        with self._write_lock:
+            data = self.store.get(conversation.id)
+            if data is not None:
+                latest = Conversation.from_bytes(data)
+                conversation.summary, conversation.summarized = latest.summary, latest.summarized
+                conversation.messages = latest.messages + conversation.added
+            conversation.added = []
+            self.store.put(conversation.id, conversation.to_bytes())
+        if self.summarize is None or not self._over_budget(conversation):
+            return
+        with self._lock:
+            if conversation.id in self._compacting:
+                return
+            self._compacting.add(conversation.id)
+        # A fresh context: the summary call is not part of the request that triggered it
+        self._executor().submit(contextvars.Context().run, self._compact_stored, conversation.id)
+
+    def delete(self, conversation_id):
+        with self._write_lock:
+            self.store.delete(conversation_id)
+
+    def _over_budget(self, conversation):
+        return (conversation.history_tokens() > self.token_budget
+                and len(conversation.messages) > self.keep_messages)
+
+    def _compact_stored(self, conversation_id):
+        try:
+            self.compact(conversation_id)
+        except Exception as e:
+            log_exception('conversation_compaction_failed', e, conversation_id=conversation_id)
+        finally:
+            with self._lock:
+                self._compacting.discard(conversation_id)
+
+    def compact(self, conversation_id):
+        """
+        Folds all but the most recent messages of a stored conversation into its
+        summary. Turns saved meanwhile are kept; on failure nothing changes.
+        Returns True if the summary was updated.
+        """
+        data = self.store.get(conversation_id)
+        conversation = Conversation.from_bytes(data) if data is not None else None
+        if conversation is None or not self._over_budget(conversation):
+            return False
+        old = conversation.messages[:-self.keep_messages]
+        summary = None
+        try:
+            summary = self.summarize(conversation.summary, old)
+        except Exception as e:
+            log_exception('conversation_summary_failed', e, conversation_id=conversation_id)
+        if not summary:
+            # Keep the turns; the next save retries, and contents() sends only what fits meanwhile
+            self._count('summary_failures')
+            log('conversation_summary_skipped', level='warning', conversation_id=conversation_id,
+                messages=len(old))
+            return False
+
+        with self._write_lock:
+            data = self.store.get(conversation_id)
+            latest = Conversation.from_bytes(data) if data is not None else None
+            if latest is None or latest.summary != conversation.summary or latest.messages[:len(old)] != old:
+                # Deleted, or summarized by another worker in the meantime
+                self._count('summaries_superseded')
+                return False
+            latest.summary = summary.strip()[:SUMMARY_MAX_CHARS]
+            latest.messages = latest.messages[len(old):]
+            latest.summarized += len(old)
+            self.store.put(conversation_id, latest.to_bytes())
+        self._count('summaries')
+        return True
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            compacting = len(self._compacting)
+        return dict(counters, compacting=compacting, token_budget=self.token_budget, keep_messages=self.keep_messages,
+                    store=self.store.stats())
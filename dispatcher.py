@@ -0,0 +1,257 @@
+"""
+Shared dispatcher for /api/chat upstream calls (optional, CHAT_DISPATCH=1).
+
+- Single-flight: concurrent requests with the same key (normalized question,
+  language, rounded location) wait on one upstream call instead of each making
+  their own.
+- Batching window: with CHAT_BATCH_WINDOW_MS > 0, distinct questions arriving
+  within the window are submitted together, in parallel, once it closes (or as
+  soon as CHAT_BATCH_MAX are waiting). Gemini has no synchronous batch endpoint,
+  so a "batch" is one parallel submission; the window mainly widens the chance
+  of coalescing and smooths bursts.
+- Deadlines: every waiter, including the one that started the call, gives up
+  after its own timeout; the upstream call runs on the dispatcher's pool (or
+  task) so nobody is tied to it. Queries whose waiters all gave up before
+  dispatch are dropped without calling upstream.
+
+stats() reports upstream calls saved and the queueing delay the window adds.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gemini_client import UpstreamUnavailable
+from latency_stats import summarize
+
+LATENCY_WINDOW = 1000
+
+
+class DispatchTimeout(UpstreamUnavailable):
+    """The request's own deadline passed while waiting for a shared upstream call."""
+
+
+class DispatchStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.dropped = 0  # Dispatched never: every waiter timed out first
+        self.timeouts = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self.queue_delays = []
+
+    def record(self, field, amount=1):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def record_start(self, queued_seconds):
+        with self.lock:
+            self.upstream_calls += 1
+            self.queue_delays.append(queued_seconds)
+            if len(self.queue_delays) > LATENCY_WINDOW:
+                del self.queue_delays[:len(self.queue_delays) - LATENCY_WINDOW]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'upstream_calls': self.upstream_calls,
+                'calls_saved': self.coalesced + self.dropped,
+                'coalesced': self.coalesced,
+                'dropped_expired': self.dropped,
+                'timeouts': self.timeouts,
+                'batches': self.batches,
+                'avg_batch_size': round(self.batched_queries / self.batches, 2) if self.batches else 0.0,
+                'queue_delay': summarize(list(self.queue_delays)),
+            }
+
+
+class _Flight:
+    """One upstream call and everyone waiting on it."""
+
+    __slots__ = ('key', 'prompt', 'waiters', 'submitted_at', 'done', 'result', 'error', 'context')
+
+    def __init__(self, key, prompt, done):
+        self.key = key
+        self.prompt = prompt
+        self.waiters = 0
+        self.submitted_at = time.monotonic()
+        self.done = done
+        self.result = None
+        self.error = None
+        # The first caller's context, so the upstream span lands in its request
+        self.context = contextvars.copy_context()
+
+
+class ChatDispatcher:
+    """
+    Thread-based dispatcher for the Flask app. `call(prompt)` makes the upstream
+    request on the pool; without a window it is submitted as soon as the first
+    caller for a key arrives.
+    """
+
+    def __init__(self, call, window_ms=0, max_batch=16, workers=32):
+        self.call = call
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.pending = []
+        self.timer = None
+        self.pool = ThreadPoolExecutor(max_workers=max(workers, self.max_batch), thread_name_prefix="chat-dispatch")
+        self.stats = DispatchStats()
+
+    def submit(self, key, prompt, timeout):
+        """Returns the upstream response for `prompt`, shared with identical in-flight requests."""
+        self.stats.record('requests')
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = _Flight(key, prompt, threading.Event())
+                flight.waiters += 1
+                self.flights[key] = flight
+                if self.window > 0:
+                    self._enqueue(flight)
+                else:
+                    self.pool.submit(flight.context.run, self._run, flight)
+            else:
+                self.stats.record('coalesced')
+                flight.waiters += 1
+
+        if not flight.done.wait(timeout):
+            with self.lock:
+                flight.waiters -= 1
+            self.stats.record('timeouts')
+            raise DispatchTimeout(f"No answer within {timeout:.0f}s", retry_after=5)
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _enqueue(self, flight):
+        """Adds a flight to the open batch (lock held)."""
+        self.pending.append(flight)
+        if len(self.pending) >= self.max_batch:
+            self._flush_locked()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.window, self._flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self.stats.record('batches')
+        self.stats.record('batched_queries', len(batch))
+        for flight in batch:
+            # Flushed from the timer thread too, so run in the context captured at submit
+            self.pool.submit(flight.context.run, self._run, flight)
+
+    def _run(self, flight):
+        with self.lock:
+            if flight.waiters == 0:
+                # Everyone gave up while it was queued: don't spend quota on it
+                del self.flights[flight.key]
+                self.stats.record('dropped')
+                return
+        self.stats.record_start(time.monotonic() - flight.submitted_at)
+        try:
+            flight.result = self.call(flight.prompt)
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self.lock:
+                self.flights.pop(flight.key, None)
+            flight.done.set()
+
+
+class AsyncChatDispatcher:
+    """Same behaviour for the Quart app: `call(prompt)` is a coroutine function, waiting never blocks the loop."""
+
+    def __init__(self, call, window_ms=0, max_batch=16):
+        self.call = call
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.flights = {}
+        self.pending = []
+        self.timer = None
+        self.tasks = set()  # The loop only keeps weak references to tasks; hold them until they finish
+        self.stats = DispatchStats()
+
+    def _start(self, flight):
+        task = asyncio.ensure_future(self._run(flight))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def submit(self, key, prompt, timeout):
+        self.stats.record('requests')
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = _Flight(key, prompt, asyncio.get_running_loop().create_future())
+            # Followers may all time out; don't let an unread exception warn at shutdown
+            flight.done.add_done_callback(lambda future: future.cancelled() or future.exception())
+            self.flights[key] = flight
+            if self.window > 0:
+                self._enqueue(flight)
+            else:
+                self._start(flight)
+        else:
+            self.stats.record('coalesced')
+        flight.waiters += 1
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.done), timeout)
+        except asyncio.TimeoutError:
+            flight.waiters -= 1
+            self.stats.record('timeouts')
+            raise DispatchTimeout(f"No answer within {timeout:.0f}s", retry_after=5)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            raise
+
+    def _enqueue(self, flight):
+        self.pending.append(flight)
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self.stats.record('batches')
+        self.stats.record('batched_queries', len(batch))
+        for flight in batch:
+            self._start(flight)
+
+    async def _run(self, flight):
+        if flight.waiters == 0:
+            del self.flights[flight.key]
+            self.stats.record('dropped')
+            flight.done.cancel()
+            return
+        self.stats.record_start(time.monotonic() - flight.submitted_at)
+        try:
+            result = await self.call(flight.prompt)
+        except Exception as e:
+            flight.done.set_exception(e)
+        else:
+            flight.done.set_result(result)
+        finally:
+            self.flights.pop(flight.key, None)
@@ -0,0 +1,188 @@
+"""
+Local stand-in for google.generativeai.GenerativeModel.
+
+Used by the load test and any offline experiment that must not touch the
+network or spend quota. Latency, jitter and failure rate are configurable,
+and replies are shaped like the real ones for each endpoint (complaint JSON,
+form-field arrays, Markdown chat answers) so the app's parsing code runs
+unchanged.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core import exceptions as api_exceptions
+
+CHAT_REPLY = (
+    "**Emergency numbers in Hyderabad**\n\n"
+    "- **Police**: 100\n- **Ambulance**: 108\n- **Fire**: 101\n\n"
+    "For non-emergencies you can visit the nearest police station or use the "
+    "[Hyderabad City Police](https://www.hyderabadpolice.gov.in/) portal."
+)
+
+REPORT_REPLY = {
+    "recipient_email": "commissioner@ghmc.gov.in",
+    "subject": "Complaint regarding pothole at [Location]",
+    "body": "Respected Sir/Madam,\n\nI observed a large pothole at [Location] that is a hazard to commuters. "
+            "Kindly arrange for its repair at the earliest.\n\nThank you.",
+    "response": "I found a **pothole** in the photo. A complaint draft addressed to GHMC is ready.",
+}
+
+FORM_REPLY = [
+    {"field_name": "applicant_name", "question": "What is your full name?", "box_2d": [180, 300, 215, 880]},
+    {"field_name": "shop_name", "question": "What is the name of your shop?", "box_2d": [280, 330, 315, 880]},
+    {"field_name": "phone_number", "question": "What is your phone number?", "box_2d": [380, 330, 415, 880]},
+    {"field_name": "ward_number", "question": "Which ward number do you live in?", "box_2d": [480, 320, 515, 500]},
+]
+
+DOCUMENT_REPLY = (
+    "## Trade License Application\n\n"
+    "1. **Applicant Full Name**: write your name as on your Aadhaar card.\n"
+    "2. **Shop / Business Name**: the name on your signboard.\n"
+    "3. **Owner Phone Number**: a 10-digit mobile number.\n"
+    "4. **Ward Number**: printed on your property tax receipt."
+)
+
+
+def _parts(contents):
+    """Flattens a generate_content payload, including multi-turn {'role', 'parts'} dicts."""
+    if isinstance(contents, str):
+        return [contents]
+    if isinstance(contents, dict) and 'parts' in contents:
+        return _parts(contents['parts'])
+    if isinstance(contents, (list, tuple)):
+        return [part for item in contents for part in _parts(item)]
+    return [contents]
+
+
+def _prompt_text(contents):
+    """Concatenates the text parts of a generate_content payload."""
+    return " ".join(part for part in _parts(contents) if isinstance(part, str))
+
+
+def _count_images(contents):
+    return sum(1 for part in _parts(contents) if not isinstance(part, str))
+
+
+def reply_for(contents):
+    """Picks a realistic reply for whichever endpoint built this prompt."""
+    prompt = _prompt_text(contents)
+    if "box_2d" in prompt:
+        return json.dumps(FORM_REPLY)
+    if "recipient_email" in prompt:
+        return json.dumps(REPORT_REPLY)
+    if _count_images(contents):
+        return DOCUMENT_REPLY
+    return CHAT_REPLY
+
+
+class FakeChunk:
+    """One streamed chunk: only .text and .parts."""
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = [SimpleNamespace(text=text)]
+
+
+class FakeResponse:
+    """Mimics GenerateContentResponse: .text, .parts, .candidates, .usage_metadata, iteration."""
+
+    def __init__(self, text, prompt_tokens, chunk_delay=0.0):
+        self.text = text
+        self.parts = [SimpleNamespace(text=text)] if text else []
+        self.candidates = [SimpleNamespace(finish_reason=SimpleNamespace(name="STOP"))]
+        self.prompt_feedback = None
+        output_tokens = max(1, len(text) // 4)
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+        self._chunk_delay = chunk_delay
+
+    def _chunks(self):
+        """Splits the reply into chunks of a few words, like a streamed response."""
+        words = self.text.split(" ")
+        step = 8
+        for i in range(0, len(words), step):
+            chunk = " ".join(words[i:i + step])
+            if i + step < len(words):
+                chunk += " "
+            yield FakeChunk(chunk)
+
+    def __iter__(self):
+        for chunk in self._chunks():
+            time.sleep(self._chunk_delay)
+            yield chunk
+
+    def __aiter__(self):
+        async def generate():
+            for chunk in self._chunks():
+                await asyncio.sleep(self._chunk_delay)
+                yield chunk
+        return generate()
+
+    def resolve(self):
+        pass
+
+
+class FakeGenerativeModel:
+    """
+    Drop-in replacement for genai.GenerativeModel.
+
+    latency/jitter are in seconds (uniform jitter around the mean). failure_rate
+    is the probability of raising a retryable upstream error (429 or 503), the
+    same exception classes the real SDK raises. A request_options timeout shorter
+    than the drawn latency ends the call with DeadlineExceeded, as the SDK does.
+    """
+
+    def __init__(self, model_name="gemini-2.5-flash", system_instruction=None,
+                 latency=0.5, jitter=0.2, failure_rate=0.0, seed=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _plan(self, contents, request_options=None):
+        """Returns (delay, error or None) for one call."""
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.failure_rate
+            error_class = self._random.choice(
+                [api_exceptions.ResourceExhausted, api_exceptions.ServiceUnavailable])
+        error = error_class(f"fake {self.model_name} upstream error") if failed else None
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and delay > timeout:
+            return timeout, api_exceptions.DeadlineExceeded(f"fake {self.model_name} timed out after {timeout}s")
+        return delay, error
+
+    def _response(self, contents, stream):
+        prompt_text = _prompt_text(contents) + (self.system_instruction or "")
+        prompt_tokens = len(prompt_text) // 4 + 258 * _count_images(contents)
+        chunk_delay = 0.02 if stream else 0.0
+        return FakeResponse(reply_for(contents), prompt_tokens, chunk_delay)
+
+    def generate_content(self, contents, *, stream=False, request_options=None, **kwargs):
+        delay, error = self._plan(contents, request_options)
+        time.sleep(delay)
+        if error:
+            raise error
+        return self._response(contents, stream)
+
+    async def generate_content_async(self, contents, *, stream=False, request_options=None, **kwargs):
+        delay, error = self._plan(contents, request_options)
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return self._response(contents, stream)
+
+    def count_tokens(self, contents, **kwargs):
+        return SimpleNamespace(total_tokens=len(_prompt_text(contents)) // 4 + 258 * _count_images(contents))
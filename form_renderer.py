@@ -0,0 +1,201 @@
+"""
+Rendering engine for /api/fill-form.
+
+- Fonts are loaded once per (font file, size) and cached for the process.
+- Each answer is fitted to its box_2d: the largest font size whose word-wrapped
+  lines fit inside the box width and height is used.
+- Output can be JPEG, PNG or PDF bytes; the endpoint decides whether to wrap
+  them in base64 JSON or send them as a binary response.
+"""
+import functools
+import io
+import os
+
+from PIL import ImageDraw, ImageFont
+
+from image_pipeline import load_upright
+from pdf_pages import images_to_pdf, iter_pdf_pages
+from response_cache import detect_language
+
+INK_COLOR = (0, 0, 150)  # Dark blue ink
+MIN_FONT_SIZE = 10
+MAX_FONT_SIZE = 72
+BOX_PADDING = 0.08  # Fraction of the box height kept clear on each side
+REFERENCE_SIZE = 100
+WIDTH_SAFETY = 1.03  # Hinting makes small sizes slightly wider than linear scaling predicts
+
+# First font file that exists wins; Hindi/Telugu answers need fonts with those scripts
+FONT_CANDIDATES = {
+    'en': [
+        "arial.ttf",
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/TTF/DejaVuSans.ttf",
+        "/Library/Fonts/Arial.ttf",
+        "C:\\Windows\\Fonts\\arial.ttf",
+    ],
+    'hi': [
+        "/usr/share/fonts/truetype/noto/NotoSansDevanagari-Regular.ttf",
+        "/usr/share/fonts/noto/NotoSansDevanagari-Regular.ttf",
+        "C:\\Windows\\Fonts\\Nirmala.ttf",
+    ],
+    'te': [
+        "/usr/share/fonts/truetype/noto/NotoSansTelugu-Regular.ttf",
+        "/usr/share/fonts/noto/NotoSansTelugu-Regular.ttf",
+        "C:\\Windows\\Fonts\\Nirmala.ttf",
+    ],
+}
+
+OUTPUT_FORMATS = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'pdf': 'application/pdf',
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _font_path(language):
+    override = os.getenv("FORM_FONT_PATH")
+    candidates = ([override] if override else []) + FONT_CANDIDATES.get(language, []) + FONT_CANDIDATES['en']
+    for path in candidates:
+        try:
+            ImageFont.truetype(path, MIN_FONT_SIZE)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+@functools.lru_cache(maxsize=512)
+def get_font(path, size):
+    """Process-wide font cache keyed by (font file, size)."""
+    if path is None:
+        # Pillow's bundled scalable font (needs FreeType); bitmap font as a last resort
+        try:
+            return ImageFont.load_default(size=size)
+        except (TypeError, AttributeError):
+            return ImageFont.load_default()
+    return ImageFont.truetype(path, size)
+
+
+@functools.lru_cache(maxsize=8192)
+def _reference_width(font_path, text):
+    """Advance width of `text` at REFERENCE_SIZE; widths scale linearly with size."""
+    return get_font(font_path, REFERENCE_SIZE).getlength(text)
+
+
+def _wrap(words, word_widths, space_width, max_width):
+    """Greedy word wrap on precomputed widths. Returns None if a single word is too wide."""
+    lines, current, current_width = [], [], 0.0
+    for word, width in zip(words, word_widths):
+        if width > max_width:
+            return None
+        candidate_width = current_width + space_width + width if current else width
+        if candidate_width <= max_width:
+            current.append(word)
+            current_width = candidate_width
+            continue
+        lines.append(" ".join(current))
+        current, current_width = [word], width
+    lines.append(" ".join(current))
+    return lines
+
+
+def fit_text(text, box_width, box_height, font_path):
+    """
+    Returns (font, lines, line_height) for the largest size that fits the box.
+    Falls back to a single line at the minimum size when nothing fits.
+
+    Word widths are measured once at REFERENCE_SIZE and scaled, so the size
+    search never goes back to FreeType.
+    """
+    words = text.split()
+    word_widths = [_reference_width(font_path, word) for word in words]
+    space_width = _reference_width(font_path, " ")
+
+    upper = max(MIN_FONT_SIZE, min(MAX_FONT_SIZE, int(box_height)))
+    lower = MIN_FONT_SIZE
+    best = None
+    # Binary search on font size: fits(size) is monotonic
+    while lower <= upper:
+        size = (lower + upper) // 2
+        scale = size / REFERENCE_SIZE * WIDTH_SAFETY
+        line_height = int(size * 1.2)
+        lines = _wrap(words, [w * scale for w in word_widths], space_width * scale, box_width)
+        if lines is not None and len(lines) * line_height <= box_height:
+            best = (size, lines, line_height)
+            lower = size + 1
+        else:
+            upper = size - 1
+    if best is None:
+        best = (MIN_FONT_SIZE, [text], int(MIN_FONT_SIZE * 1.2))
+    size, lines, line_height = best
+    return get_font(font_path, size), lines, line_height
+
+
+def draw_answers(image, answers, page=0):
+    """Draws the wizard answers that belong to `page` onto a PIL image in place."""
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+
+    for field_data in answers.values():
+        text_value = str(field_data.get('answer', '')).strip()
+        box_normalized = field_data.get('box_2d', [0, 0, 0, 0])
+        if len(box_normalized) not in (4, 5) or not text_value:
+            continue
+        # PDF fields carry their page index as a fifth element
+        box_page = box_normalized[4] if len(box_normalized) == 5 else 0
+        if box_page != page:
+            continue
+
+        # Convert from 1000x1000 normalized scale back to actual image pixels
+        ymin, xmin, ymax, xmax = (float(value) for value in box_normalized[:4])
+        left, right = xmin / 1000.0 * width, xmax / 1000.0 * width
+        top, bottom = ymin / 1000.0 * height, ymax / 1000.0 * height
+        padding = max(2, (bottom - top) * BOX_PADDING)
+        box_width = max(1, right - left - 2 * padding)
+        box_height = max(1, bottom - top - 2 * padding)
+
+        font_path = _font_path(detect_language(text_value))
+        font, lines, line_height = fit_text(text_value, box_width, box_height, font_path)
+
+        # Centre the text block vertically inside the box
+        y = top + padding + max(0, (box_height - len(lines) * line_height) / 2)
+        for line in lines:
+            draw.text((left + padding, y), line, fill=INK_COLOR, font=font)
+            y += line_height
+
+
+def encode_image(image, fmt='jpeg', quality=85):
+    buffered = io.BytesIO()
+    # Ensure image is in a saveable mode
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if fmt == 'png':
+        image.save(buffered, format="PNG", compress_level=3)
+    else:
+        image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def render_filled_form(image_bytes, answers, fmt='jpeg'):
+    """Fills a single-image form and returns it encoded as jpeg, png or pdf bytes."""
+    # Upright, like the preprocessed copy the model saw, so box_2d lines up
+    image = load_upright(image_bytes).convert("RGB")
+    draw_answers(image, answers)
+    if fmt == 'pdf':
+        return images_to_pdf([(encode_image(image), image.size)])
+    return encode_image(image, fmt)
+
+
+def render_filled_pdf(pdf_bytes, answers):
+    """
+    Renders every page with its answers and rebuilds a PDF, one page in memory
+    at a time. Returns (pdf bytes, first page as JPEG bytes for previews).
+    """
+    pages = []
+    for page_index, image in iter_pdf_pages(pdf_bytes):
+        image = image.convert("RGB")
+        draw_answers(image, answers, page=page_index)
+        pages.append((encode_image(image), image.size))
+        del image
+    return images_to_pdf(pages), pages[0][0]
@@ -0,0 +1,113 @@
+"""
+Template index for /api/start-form-fill.
+
+Citizens keep uploading the same handful of government forms. Each page is
+fingerprinted (image_pipeline.image_fingerprint) and the extracted
+field_name / question / box_2d list is stored against that fingerprint, so
+a later upload of the same form is answered from the index instead of a
+multi-second layout extraction call.
+
+A match needs all three checks to pass:
+1. coarse 64-bit dHash within COARSE_DISTANCE bits (cheap candidate filter),
+2. aspect ratio within ASPECT_TOLERANCE (same page shape, so the normalized
+   1000x1000 boxes land in the same place at any scale),
+3. fine 256-bit dHash within FINE_DISTANCE bits (alignment check).
+"""
+import json
+import os
+import threading
+import time
+
+from image_pipeline import hamming_distance, image_fingerprint
+from observability import log
+
+COARSE_DISTANCE = 6
+FINE_DISTANCE = int(os.getenv("FORM_TEMPLATE_DISTANCE", "20"))
+ASPECT_TOLERANCE = 0.02
+
+
+class TemplateIndex:
+    """Fingerprint -> extracted fields, bounded by LRU and persisted as JSON."""
+
+    def __init__(self, path=None, max_templates=256):
+        self.path = path
+        self.max_templates = max_templates
+        self._templates = []
+        self._lock = threading.Lock()
+        self._loaded_mtime = None
+        self.hits = 0
+        self.misses = 0
+        self._reload()
+
+    def _reload(self):
+        """Picks up templates written by other workers sharing the same file."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        mtime = os.path.getmtime(self.path)
+        if mtime == self._loaded_mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log('form_templates_load_failed', level='warning', path=self.path, error=f"{type(e).__name__}: {e}")
+            return
+        self._templates = [dict(t, coarse=int(t['coarse'], 16), fine=int(t['fine'], 16))
+                           for t in data.get('templates', [])]
+        self._loaded_mtime = mtime
+
+    def _save(self):
+        if not self.path:
+            return
+        data = {'version': 1, 'templates': [
+            dict(t, coarse=f"{t['coarse']:016x}", fine=f"{t['fine']:064x}") for t in self._templates
+        ]}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        self._loaded_mtime = os.path.getmtime(self.path)
+
+    def _find(self, fingerprint):
+        best, best_distance = None, FINE_DISTANCE + 1
+        for template in self._templates:
+            if hamming_distance(template['coarse'], fingerprint['coarse']) > COARSE_DISTANCE:
+                continue
+            if abs(template['aspect'] - fingerprint['aspect']) > ASPECT_TOLERANCE * fingerprint['aspect']:
+                continue
+            distance = hamming_distance(template['fine'], fingerprint['fine'])
+            if distance < best_distance:
+                best, best_distance = template, distance
+        return best
+
+    def lookup(self, image):
+        """Returns (fields or None, fingerprint). Pass the fingerprint back to add()."""
+        fingerprint = image_fingerprint(image)
+        with self._lock:
+            self._reload()
+            template = self._find(fingerprint)
+            if template is None:
+                self.misses += 1
+                return None, fingerprint
+            self.hits += 1
+            template['hits'] = template.get('hits', 0) + 1
+            template['last_used'] = time.time()
+            return template['fields'], fingerprint
+
+    def add(self, fingerprint, fields):
+        if not fields:
+            return
+        with self._lock:
+            self._reload()
+            if self._find(fingerprint) is not None:
+                return
+            now = time.time()
+            self._templates.append(dict(fingerprint, fields=fields, hits=0, created=now, last_used=now))
+            if len(self._templates) > self.max_templates:
+                self._templates.sort(key=lambda t: t['last_used'])
+                del self._templates[:len(self._templates) - self.max_templates]
+            self._save()
+
+    def stats(self):
+        with self._lock:
+            return {'templates': len(self._templates), 'hits': self.hits, 'misses': self.misses}
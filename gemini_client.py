@@ -0,0 +1,450 @@
+"""
+Resilient access to Gemini for every endpoint.
+
+Each call runs under a named policy (chat, stream, vision, form, repair) that sets a
+per-attempt timeout, an overall deadline, how many jittered retries are allowed
+on retryable errors (429, 503, timeouts) and, for chat, whether to hedge a slow
+attempt with a second concurrent one.
+
+Models are tried in order (GEMINI_MODEL, then GEMINI_FALLBACK_MODELS). Each model
+has a circuit breaker: after GEMINI_BREAKER_THRESHOLD consecutive upstream
+failures it fails fast for GEMINI_BREAKER_RESET seconds and then lets a single
+probe through. When every model is exhausted or open, UpstreamUnavailable is
+raised, which the endpoints turn into a 503 with Retry-After.
+
+The SDK is imported lazily (load_sdk). The model factory is injectable, so
+tests and the load test can run the same policies against
+fake_gemini.FakeGenerativeModel. An optional usage meter
+(prompts.TokenMeter) receives each response's token usage under the caller's
+`endpoint` label, and non-streamed calls are timed as the "upstream" stage of
+the current request (observability.span); streaming callers time their own.
+"""
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass
+
+from google.api_core import exceptions as api_exceptions
+
+from latency_stats import summarize
+from observability import span
+
+PRIMARY_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+FALLBACK_MODELS = [name.strip() for name in os.getenv("GEMINI_FALLBACK_MODELS", "gemini-2.5-flash-lite").split(",")
+                   if name.strip()]
+BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+LATENCY_WINDOW = 1000  # Recent successful calls kept per policy for percentiles
+
+TIMEOUT_ERRORS = (api_exceptions.DeadlineExceeded, TimeoutError, FutureTimeout, asyncio.TimeoutError)
+RETRYABLE_ERRORS = TIMEOUT_ERRORS + (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.GatewayTimeout,
+    ConnectionError,
+)
+
+
+_sdk = None
+_sdk_lock = threading.Lock()
+
+
+def load_sdk():
+    """
+    Imports and configures google.generativeai on first use, once per process.
+    The import alone is most of the app's boot time, so nothing pays for it
+    until a model is built (or warm_up() runs).
+    """
+    global _sdk
+    if _sdk is None:
+        with _sdk_lock:
+            if _sdk is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                _sdk = genai
+    return _sdk
+
+
+def default_model_factory(**kwargs):
+    return load_sdk().GenerativeModel(**kwargs)
+
+
+class UpstreamUnavailable(Exception):
+    """Gemini could not answer within the policy's retries, deadline and fallbacks."""
+
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class CallPolicy:
+    name: str
+    timeout: float  # Per attempt, passed to the SDK as request_options timeout
+    deadline: float  # Whole call, including retries and fallbacks
+    retries: int
+    hedge_after: float = 0.0  # Seconds before a second concurrent attempt; 0 disables hedging
+    system_instruction: bool = True  # Whether the model gets the chat system instruction
+
+
+def default_policies():
+    retries = int(os.getenv("GEMINI_RETRIES", "2"))
+    timeout = float(os.getenv("GEMINI_TIMEOUT", "30"))
+    vision_timeout = float(os.getenv("GEMINI_VISION_TIMEOUT", "60"))
+    return {
+        'chat': CallPolicy('chat', timeout, timeout * 1.5, retries,
+                           hedge_after=float(os.getenv("GEMINI_HEDGE_MS", "0")) / 1000.0),
+        # Only the opening request is retried; a stream that fails midway is reported to the client
+        'stream': CallPolicy('stream', timeout, timeout * 1.5, min(retries, 1)),
+        'vision': CallPolicy('vision', vision_timeout, vision_timeout * 1.5, retries),
+        'form': CallPolicy('form', vision_timeout, vision_timeout * 1.5, retries, system_instruction=False),
+        # Targeted re-ask for the broken part of a structured reply (structured_output.py)
+        'repair': CallPolicy('repair', vision_timeout, vision_timeout * 1.5, retries, system_instruction=False),
+        # Rolling summary of older conversation turns (conversations.py)
+        'summary': CallPolicy('summary', timeout, timeout * 1.5, retries, system_instruction=False),
+    }
+
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures -> half-open after `reset_seconds` -> one probe."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at < self.reset_seconds:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self.lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until this breaker lets a probe through (0 when closed)."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_seconds - (self.clock() - self.opened_at))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None or self.probing:
+                    self.times_opened += 1
+                self.opened_at = self.clock()
+                self.probing = False
+
+    def stats(self):
+        with self.lock:
+            return {'state': self._state(), 'consecutive_failures': self.failures, 'times_opened': self.times_opened}
+
+
+class PolicyMetrics:
+    """Counters and recent latencies for one policy."""
+
+    FIELDS = ('calls', 'successes', 'unavailable', 'errors', 'attempts', 'retries', 'timeouts',
+              'hedges', 'hedge_wins', 'fallbacks', 'short_circuits')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        self.error_classes = {}  # Exception class name -> count, retried or not
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def inc(self, field, amount=1):
+        with self.lock:
+            self.counts[field] += amount
+
+    def error(self, error):
+        name = type(error).__name__
+        with self.lock:
+            self.error_classes[name] = self.error_classes.get(name, 0) + 1
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts['successes'] += 1
+            self.latencies.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts, error_classes=dict(self.error_classes), latency=summarize(list(self.latencies)))
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class GeminiClient:
+    """
+    Wraps generate_content / generate_content_async with the policies above.
+    Models are created lazily, once per (model name, system instruction).
+    """
+
+    def __init__(self, system_instruction=None, models=None, policies=None,
+                 model_factory=None, breaker_factory=CircuitBreaker, usage_meter=None):
+        self.system_instruction = system_instruction
+        self.models = list(models or [PRIMARY_MODEL] + [m for m in FALLBACK_MODELS if m != PRIMARY_MODEL])
+        self.policies = policies or default_policies()
+        self.model_factory = model_factory or default_model_factory
+        self.breakers = {name: breaker_factory() for name in self.models}
+        self.metrics = {name: PolicyMetrics() for name in self.policies}
+        self.usage_meter = usage_meter
+        self._instances = {}
+        self._instances_lock = threading.Lock()
+        self._hedge_pool = None
+
+    def _model(self, name, policy):
+        instruction = self.system_instruction if policy.system_instruction else None
+        key = (name, instruction)
+        with self._instances_lock:
+            if key not in self._instances:
+                if instruction:
+                    self._instances[key] = self.model_factory(model_name=name, system_instruction=instruction)
+                else:
+                    self._instances[key] = self.model_factory(model_name=name)
+            return self._instances[key]
+
+    def warm_up(self):
+        """Builds the primary chat model (importing the SDK) so the first request doesn't."""
+        self._model(self.models[0], self.policies['chat'])
+
+    def _request_kwargs(self, policy, kwargs, remaining):
+        options = dict(kwargs.pop('request_options', None) or {})
+        options['timeout'] = max(0.1, min(policy.timeout, remaining))
+        return dict(kwargs, request_options=options)
+
+    def _retry_after(self):
+        waits = [breaker.retry_after() for breaker in self.breakers.values()]
+        return max(1, math.ceil(min(waits))) if waits and min(waits) > 0 else 5
+
+    def _candidates(self, policy, metrics):
+        """Yields (index, name, breaker) for each model whose breaker lets the call through."""
+        for index, name in enumerate(self.models):
+            breaker = self.breakers[name]
+            if not breaker.allow():
+                metrics.inc('short_circuits')
+                continue
+            if index > 0:
+                metrics.inc('fallbacks')
+            yield index, name, breaker
+
+    def record_usage(self, endpoint, response, seconds=None):
+        """Token accounting; streamed responses are recorded by the caller once fully read."""
+        usage = getattr(response, 'usage_metadata', None)
+        if self.usage_meter is not None and usage is not None:
+            self.usage_meter.record(endpoint, usage, seconds)
+
+    def _unavailable(self, policy, metrics, last_error):
+        metrics.inc('unavailable')
+        reason = f"{type(last_error).__name__}: {last_error}" if last_error else "all models are failing fast"
+        return UpstreamUnavailable(f"Gemini unavailable for {policy.name} ({reason})", self._retry_after())
+
+    # --- sync ---
+
+    def generate(self, contents, policy='chat', endpoint=None, **kwargs):
+        """
+        generate_content under `policy`. Pass stream=True for a streamed response.
+        `endpoint` labels the token usage (defaults to the policy name).
+        """
+        if kwargs.get('stream'):
+            return self._generate(contents, policy, endpoint, **kwargs)
+        with span('upstream'):
+            return self._generate(contents, policy, endpoint, **kwargs)
+
+    def _generate(self, contents, policy, endpoint, **kwargs):
+        policy = self.policies[policy]
+        metrics = self.metrics[policy.name]
+        metrics.inc('calls')
+        start = time.monotonic()
+        deadline = start + policy.deadline
+        last_error = None
+
+        for _, name, breaker in self._candidates(policy, metrics):
+            model = self._model(name, policy)
+            for attempt in range(policy.retries + 1):
+                metrics.inc('attempts')
+                call_kwargs = self._request_kwargs(policy, dict(kwargs), deadline - time.monotonic())
+                try:
+                    if policy.hedge_after and not kwargs.get('stream'):
+                        response = self._hedged(model, contents, call_kwargs, policy, metrics)
+                    else:
+                        response = model.generate_content(contents, **call_kwargs)
+                except RETRYABLE_ERRORS as e:
+                    last_error = e
+                    metrics.error(e)
+                    breaker.record_failure()
+                    if isinstance(e, TIMEOUT_ERRORS):
+                        metrics.inc('timeouts')
+                    delay = backoff_delay(attempt)
+                    if attempt == policy.retries or time.monotonic() + delay >= deadline or not breaker.allow():
+                        break
+                    metrics.inc('retries')
+                    time.sleep(delay)
+                    continue
+                except Exception as e:
+                    # The upstream answered (bad request, safety, ...): not a health problem
+                    breaker.record_success()
+                    metrics.inc('errors')
+                    metrics.error(e)
+                    raise
+                breaker.record_success()
+                metrics.observe(time.monotonic() - start)
+                if not kwargs.get('stream'):
+                    self.record_usage(endpoint or policy.name, response, time.monotonic() - start)
+                return response
+            if time.monotonic() >= deadline:
+                break
+
+        raise self._unavailable(policy, metrics, last_error)
+
+    def _hedged(self, model, contents, call_kwargs, policy, metrics):
+        """Starts a second attempt if the first hasn't answered after hedge_after; first success wins."""
+        if self._hedge_pool is None:
+            with self._instances_lock:
+                if self._hedge_pool is None:
+                    self._hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("GEMINI_HEDGE_WORKERS", "32")),
+                                                          thread_name_prefix="hedge")
+        first = self._hedge_pool.submit(model.generate_content, contents, **call_kwargs)
+        try:
+            return first.result(timeout=policy.hedge_after)
+        except FutureTimeout:
+            pass
+        metrics.inc('hedges')
+        # The sync SDK can't cancel the slower attempt; it finishes in the background
+        second = self._hedge_pool.submit(model.generate_content, contents, **call_kwargs)
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        metrics.inc('hedge_wins')
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    # --- async ---
+
+    async def generate_async(self, contents, policy='chat', endpoint=None, **kwargs):
+        """generate_content_async under `policy`; the asyncio deadline also covers SDKs that ignore timeout."""
+        if kwargs.get('stream'):
+            return await self._generate_async(contents, policy, endpoint, **kwargs)
+        with span('upstream'):
+            return await self._generate_async(contents, policy, endpoint, **kwargs)
+
+    async def _generate_async(self, contents, policy, endpoint, **kwargs):
+        policy = self.policies[policy]
+        metrics = self.metrics[policy.name]
+        metrics.inc('calls')
+        start = time.monotonic()
+        deadline = start + policy.deadline
+        last_error = None
+
+        for _, name, breaker in self._candidates(policy, metrics):
+            model = self._model(name, policy)
+            for attempt in range(policy.retries + 1):
+                metrics.inc('attempts')
+                call_kwargs = self._request_kwargs(policy, dict(kwargs), deadline - time.monotonic())
+                timeout = call_kwargs['request_options']['timeout']
+                try:
+                    if policy.hedge_after and not kwargs.get('stream'):
+                        response = await self._hedged_async(model, contents, call_kwargs, timeout, policy, metrics)
+                    else:
+                        response = await asyncio.wait_for(model.generate_content_async(contents, **call_kwargs),
+                                                          timeout)
+                except RETRYABLE_ERRORS as e:
+                    last_error = e
+                    metrics.error(e)
+                    breaker.record_failure()
+                    if isinstance(e, TIMEOUT_ERRORS):
+                        metrics.inc('timeouts')
+                    delay = backoff_delay(attempt)
+                    if attempt == policy.retries or time.monotonic() + delay >= deadline or not breaker.allow():
+                        break
+                    metrics.inc('retries')
+                    await asyncio.sleep(delay)
+                    continue
+                except Exception as e:
+                    breaker.record_success()
+                    metrics.inc('errors')
+                    metrics.error(e)
+                    raise
+                breaker.record_success()
+                metrics.observe(time.monotonic() - start)
+                if not kwargs.get('stream'):
+                    self.record_usage(endpoint or policy.name, response, time.monotonic() - start)
+                return response
+            if time.monotonic() >= deadline:
+                break
+
+        raise self._unavailable(policy, metrics, last_error)
+
+    async def _hedged_async(self, model, contents, call_kwargs, timeout, policy, metrics):
+        first = asyncio.ensure_future(model.generate_content_async(contents, **call_kwargs))
+        done, _ = await asyncio.wait({first}, timeout=policy.hedge_after)
+        if done:
+            return first.result()
+        metrics.inc('hedges')
+        second = asyncio.ensure_future(model.generate_content_async(contents, **call_kwargs))
+        pending, error = {first, second}, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            metrics.inc('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {
+            'models': self.models,
+            'breakers': {name: breaker.stats() for name, breaker in self.breakers.items()},
+            'policies': {name: metrics.snapshot() for name, metrics in self.metrics.items()},
+        }
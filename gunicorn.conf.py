@@ -0,0 +1,88 @@
+"""
+Production server config: `gunicorn -c gunicorn.conf.py`
+
+Every request spends most of its time waiting on Gemini, so each worker runs
+many threads (gthread) rather than one request at a time. gevent is avoided
+because the Gemini SDK talks gRPC, which doesn't cooperate with its monkey
+patching. SERVER_MODE=asgi serves asgi.py through uvicorn workers instead,
+with one event loop per worker.
+
+With GUNICORN_PRELOAD=1 the app is imported and warmed up (SDK import, model
+construction) once in the master, and the forked workers share those pages
+copy-on-write. No network connection is opened before the fork.
+"""
+import os
+import signal
+
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi").lower()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Form sessions, jobs and conversations live in the SESSION_BACKEND store. The memory
+# backend is private to one process, so a second worker would lose them; refuse to start
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").lower()
+workers = int(os.getenv("WEB_CONCURRENCY", "1" if SESSION_BACKEND == "memory" else "2"))
+if workers > 1 and SESSION_BACKEND == "memory":
+    raise RuntimeError(f"WEB_CONCURRENCY={workers} needs a shared SESSION_BACKEND (sqlite or redis), not memory")
+
+if SERVER_MODE == "asgi":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "main:create_app()"
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "32"))
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+# Longer than the proxy's idle timeout (Render / most load balancers use 60s)
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+# Above the slowest Gemini deadline (vision policy + fallbacks)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# In-flight requests get this long to finish after SIGTERM
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+# Heartbeat files on tmpfs, so a slow disk can't get workers killed
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+# The app logs one JSON line per request itself (observability.py)
+accesslog = None
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def when_ready(server):
+    # Preloaded: warm up in the master so every forked worker starts ready
+    if preload_app:
+        import main
+        main.warm_up()
+
+
+def post_worker_init(worker):
+    import main
+    from observability import log, profiler
+
+    main.start_warm_up()
+    # Threads don't survive the fork; restart the profiler if PROFILER=1
+    if os.getenv("PROFILER", "0").lower() in ("1", "true", "yes") and not profiler.running:
+        profiler.start()
+
+    if SERVER_MODE != "asgi":
+        # Fail /readyz as soon as the drain starts, then let gunicorn finish in-flight requests
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def drain(signum, frame):
+            main.begin_drain()
+            if callable(previous):
+                previous(signum, frame)
+
+        signal.signal(signal.SIGTERM, drain)
+    log('worker_started', pid=worker.pid, mode=SERVER_MODE, workers=workers)
+
+
+def worker_exit(server, worker):
+    from observability import log, profiler
+
+    profiler.stop()
+    log('worker_stopped', pid=worker.pid)
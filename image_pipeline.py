@@ -0,0 +1,214 @@
+"""
+Shared pre-processing for uploaded images before they are sent to Gemini.
+
+Phone photos arrive as multi-megabyte JPEGs; the model does not need that
+resolution, so every image endpoint runs uploads through preprocess_image():
+
+1. Fast decode: for JPEGs, Image.draft() lets libjpeg decode at 1/2, 1/4 or
+   1/8 scale directly instead of decoding full size and then shrinking.
+2. EXIF orientation is applied so the model sees the photo upright.
+3. Downscale to a maximum dimension (aspect ratio preserved).
+4. Document mode: grayscale + autocontrast for cleaner text.
+5. Re-encode to IMAGE_FORMAT (JPEG, WEBP or PNG), lowering quality until
+   under a byte target. PNG is lossless, so it is encoded once.
+
+Scaling is uniform, so the 1000x1000 normalized box_2d coordinates the model
+returns map onto the full-resolution upright image unchanged. Use
+load_upright() to get that image when drawing on the original.
+"""
+import io
+import os
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+PHOTO_MAX_DIM = int(os.getenv("IMAGE_MAX_DIM", "1536"))
+DOCUMENT_MAX_DIM = int(os.getenv("DOCUMENT_MAX_DIM", "2048"))
+TARGET_BYTES = int(os.getenv("IMAGE_TARGET_BYTES", str(500 * 1024)))
+OUTPUT_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+
+QUALITY_STEPS = (85, 75, 65, 50)
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+LOSSY_FORMATS = ("JPEG", "WEBP")
+EXIF_ORIENTATION = 0x0112
+
+
+def check_format(fmt):
+    if fmt not in MIME_TYPES:
+        raise ValueError(f"Unsupported IMAGE_FORMAT: {fmt} (use one of {', '.join(MIME_TYPES)})")
+    return fmt
+
+
+check_format(OUTPUT_FORMAT)
+
+# Running totals across all requests in this process
+_totals_lock = threading.Lock()
+_totals = {'images': 0, 'passthrough': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+
+class PreparedImage:
+    """Result of preprocess_image(): encoded bytes ready for the model plus stats."""
+
+    def __init__(self, data, mime_type, size, stats, image=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+        self.stats = stats
+        # Decoded, upright, downsized image (None on passthrough until needed)
+        self._image = image
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = ImageOps.exif_transpose(Image.open(io.BytesIO(self.data)))
+        return self._image
+
+    def as_part(self):
+        """Inline blob accepted by generate_content in place of a PIL image."""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+def load_upright(image_bytes):
+    """Decodes at full resolution with EXIF orientation applied."""
+    image = Image.open(io.BytesIO(image_bytes))
+    return ImageOps.exif_transpose(image)
+
+
+def _encode(image, fmt, quality):
+    buffered = io.BytesIO()
+    if fmt == "WEBP":
+        image.save(buffered, format="WEBP", quality=quality, method=4)
+    elif fmt == "PNG":
+        image.save(buffered, format="PNG", optimize=True)  # Lossless: quality does not apply
+    else:
+        image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def preprocess_image(image_bytes, mode="photo", max_dim=None, target_bytes=None, fmt=None):
+    """
+    Prepares an uploaded image for inference.
+    mode is "photo" (colour kept) or "document" (grayscale, contrast stretched).
+    """
+    start_time = time.perf_counter()
+    max_dim = max_dim or (DOCUMENT_MAX_DIM if mode == "document" else PHOTO_MAX_DIM)
+    target_bytes = target_bytes or TARGET_BYTES
+    fmt = check_format((fmt or OUTPUT_FORMAT).upper())
+
+    image = Image.open(io.BytesIO(image_bytes))
+    source_format = image.format
+    original_size = image.size
+    rotated = image.getexif().get(EXIF_ORIENTATION, 1) != 1
+
+    # Can we hand the upload to the model untouched?
+    if (mode == "photo" and not rotated and source_format in MIME_TYPES
+            and len(image_bytes) <= target_bytes and max(original_size) <= max_dim):
+        return _finish(image_bytes, MIME_TYPES[source_format], original_size,
+                       original_size, len(image_bytes), start_time, passthrough=True)
+
+    if source_format == "JPEG" and max(original_size) > max_dim:
+        # Decode straight at a reduced scale (still >= the final size). draft()
+        # needs the target in both dimensions, so keep the aspect ratio here.
+        scale = max_dim / max(original_size)
+        draft_size = (int(original_size[0] * scale), int(original_size[1] * scale))
+        image.draft("L" if mode == "document" else "RGB", draft_size)
+
+    # Pillow decodes lazily; load here so decode time is reported apart from the resize/encode work
+    decode_start = time.perf_counter()
+    image.load()
+    decode_seconds = time.perf_counter() - decode_start
+    image = ImageOps.exif_transpose(image)
+    return _reencode(image, mode, max_dim, target_bytes, fmt, original_size, len(image_bytes), start_time,
+                     decode_seconds)
+
+
+def preprocess_decoded(image, mode="document", max_dim=None, target_bytes=None, fmt=None):
+    """preprocess_image() for an image that is already decoded, e.g. a rendered PDF page."""
+    start_time = time.perf_counter()
+    max_dim = max_dim or (DOCUMENT_MAX_DIM if mode == "document" else PHOTO_MAX_DIM)
+    raw_bytes = image.width * image.height * len(image.getbands())
+    fmt = check_format((fmt or OUTPUT_FORMAT).upper())
+    return _reencode(image, mode, max_dim, target_bytes or TARGET_BYTES, fmt,
+                     image.size, raw_bytes, start_time)
+
+
+def _reencode(image, mode, max_dim, target_bytes, fmt, original_size, bytes_in, start_time, decode_seconds=0.0):
+    if max(image.size) > max_dim:
+        image.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    if mode == "document":
+        image = ImageOps.autocontrast(image.convert("L"), cutoff=1)
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    data = b""
+    for quality in (QUALITY_STEPS if fmt in LOSSY_FORMATS else QUALITY_STEPS[:1]):
+        data = _encode(image, fmt, quality)
+        if len(data) <= target_bytes:
+            break
+
+    return _finish(data, MIME_TYPES[fmt], original_size,
+                   image.size, bytes_in, start_time, image=image, decode_seconds=decode_seconds)
+
+
+def _finish(data, mime_type, original_size, size, bytes_in, start_time, passthrough=False, image=None,
+            decode_seconds=0.0):
+    elapsed = time.perf_counter() - start_time
+    stats = {
+        'original_bytes': bytes_in,
+        'output_bytes': len(data),
+        'bytes_saved': bytes_in - len(data),
+        'original_size': list(original_size),
+        'output_size': list(size),
+        'passthrough': passthrough,
+        'elapsed_ms': round(elapsed * 1000, 2),
+        'decode_ms': round(decode_seconds * 1000, 2),
+    }
+    with _totals_lock:
+        _totals['images'] += 1
+        _totals['passthrough'] += int(passthrough)
+        _totals['bytes_in'] += bytes_in
+        _totals['bytes_out'] += len(data)
+        _totals['seconds'] += elapsed
+    return PreparedImage(data, mime_type, size, stats, image)
+
+
+def pipeline_stats():
+    """Aggregate bytes saved and time spent since process start."""
+    with _totals_lock:
+        totals = dict(_totals)
+    totals['bytes_saved'] = totals['bytes_in'] - totals['bytes_out']
+    totals['seconds'] = round(totals['seconds'], 3)
+    return totals
+
+
+def _dhash(gray, hash_size):
+    """Difference hash: one bit per horizontally adjacent pixel pair."""
+    pixels = list(gray.resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def image_fingerprint(image):
+    """
+    Perceptual fingerprint of a page or photo: a coarse 64-bit dHash for fast
+    candidate search, a fine 256-bit dHash for verification, and the aspect ratio.
+    Robust to re-encoding and rescaling, not to crops or perspective changes.
+    """
+    gray = image.convert("L")
+    # Shrink once so both hashes resize from a small image
+    gray.thumbnail((128, 128), Image.Resampling.BILINEAR)
+    return {
+        'coarse': _dhash(gray, 8),
+        'fine': _dhash(gray, 16),
+        'aspect': round(image.size[0] / image.size[1], 4),
+    }
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
@@ -0,0 +1,222 @@
+"""
+CPU-only intent pre-classifier for /api/chat.
+
+Scores the question against keyword and phrase lists for the six CitiAssist
+categories and for common out-of-scope topics, in English, Hindi and Telugu
+(including common romanized spellings). Clear out-of-scope questions get the
+same canned refusal the system instruction asks Gemini for, without a model
+call; everything else goes to the model, tagged with its best category.
+
+It is deliberately conservative, because a refusal never reaches the model and
+a false one is simply a wrong answer. A question is only refused when it has no
+in-scope signal at all (no civic keyword, no Hyderabad place name) and its
+out-of-scope score reaches INTENT_REFUSE_THRESHOLD (2.0). Words that also have
+civic uses ("code", "java", "cook") score below the threshold on their own, so
+those questions go to the model; only an unambiguous topic, or two signals
+together, is refused here. Use calibrate_intent.py to check the false-refusal
+rate on the golden set and its regression probes after changing the lists.
+"""
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+from response_cache import detect_language, normalize_query
+
+REFUSE_THRESHOLD = float(os.getenv("INTENT_REFUSE_THRESHOLD", "2.0"))
+MIN_PREFIX = 3  # Shortest keyword matched as a prefix (Hindi/Telugu suffixes, English plurals)
+
+REFUSALS = {
+    'en': "Data not available. My scope is strictly restricted to Civic and City Services for Hyderabad.",
+    'hi': "डेटा उपलब्ध नहीं है। मेरा दायरा केवल हैदराबाद की नागरिक और शहर सेवाओं तक सीमित है।",
+    'te': "డేటా అందుబాటులో లేదు. నా పరిధి హైదరాబాద్ పౌర మరియు నగర సేవలకు మాత్రమే పరిమితం.",
+}
+
+# Single words are matched against tokens (and as prefixes of tokens when at least
+# MIN_PREFIX long); entries with a space are matched as phrases in the normalized text.
+CATEGORY_KEYWORDS = {
+    'healthcare': [
+        'hospital', 'clinic', 'doctor', 'ambulance', '108', 'medical', 'medicine', 'pharmacy', 'chemist',
+        'health', 'blood bank', 'vaccine', 'vaccination', 'aarogyasri', 'nims', 'osmania', 'apollo',
+        'fever', 'dentist', 'maternity', 'icu', 'aspatal', 'aspatri', 'davakhana', 'dawakhana',
+        'अस्पताल', 'डॉक्टर', 'एम्बुलेंस', 'दवा', 'दवाई', 'इलाज', 'क्लिनिक', 'स्वास्थ्य', 'चिकित्सा',
+        'ఆసుపత్రి', 'ఆస్పత్రి', 'హాస్పిటల్', 'డాక్టర్', 'వైద్య', 'అంబులెన్స్', 'మందు', 'ఆరోగ్య',
+    ],
+    'transport': [
+        'metro', 'bus', 'tsrtc', 'tgsrtc', 'rtc', 'mmts', 'train', 'railway', 'station', 'auto', 'cab', 'taxi',
+        'route', 'traffic', 'airport', 'rgia', 'flyover', 'toll', 'commute', 'parking', 'bus pass',
+        'how to go', 'how to reach', 'shamshabad',
+        'मेट्रो', 'बस', 'ट्रेन', 'रेलवे', 'स्टेशन', 'ऑटो', 'रास्ता', 'यातायात', 'हवाई अड्डा', 'कैसे जा',
+        'మెట్రో', 'బస్సు', 'బస్', 'రైలు', 'స్టేషన్', 'ఆటో', 'దారి', 'ట్రాఫిక్', 'విమానాశ్రయ', 'వెళ్ళ', 'వెళ్ల',
+    ],
+    'safety': [
+        'police', 'crime', 'theft', 'stolen', 'fir', 'cyber', 'fraud', 'accident', 'fire', 'safety', 'safe',
+        'harassment', 'missing', 'dial 100', '112', 'she teams', 'emergency', 'helpline',
+        'पुलिस', 'चोरी', 'सुरक्षा', 'अपराध', 'आग', 'दुर्घटना', 'आपातकाल',
+        'పోలీస్', 'పోలీసు', 'దొంగతనం', 'భద్రత', 'నేరం', 'అగ్ని', 'ప్రమాదం', 'అత్యవసర',
+    ],
+    'utilities': [
+        'electricity', 'power', 'power cut', 'outage', 'bill', 'water', 'hmwssb', 'tsspdcl', 'tgspdcl',
+        'garbage', 'waste', 'trash', 'sewage', 'drainage', 'drain', 'pothole', 'streetlight', 'street light',
+        'road', 'ghmc', 'municipal', 'property tax', 'manhole', 'mosquito', 'lpg', 'gas cylinder', 'leak',
+        'supply', 'complaint', 'report', 'snap solve', 'landline', 'std code', 'pin code', 'pincode',
+        'बिजली', 'पानी', 'कचरा', 'सड़क', 'नाली', 'बिल', 'गड्ढा', 'नगर निगम', 'शिकायत',
+        'విద్యుత్', 'కరెంటు', 'కరెంట్', 'నీరు', 'నీటి', 'నీళ్ళు', 'చెత్త', 'రోడ్డు', 'గుంత', 'బిల్లు', 'మురుగు',
+        'ఫిర్యాదు',
+    ],
+    'government': [
+        'aadhaar', 'aadhar', 'pan card', 'voter', 'passport', 'license', 'licence', 'driving', 'certificate',
+        'ration', 'meeseva', 'mee seva', 'registration', 'rto', 'apply', 'application', 'form', 'document',
+        'scheme', 'pension', 'government', 'govt', 'collector', 'mandal', 'tahsildar', 'dharani', 'birth',
+        'death', 'caste', 'income', 'marriage', 'gst', 'trade license',
+        'आधार', 'पैन', 'पासपोर्ट', 'लाइसेंस', 'प्रमाण पत्र', 'प्रमाणपत्र', 'राशन', 'सरकारी', 'आवेदन', 'योजना',
+        'पेंशन', 'जन्म',
+        'ఆధార్', 'పాన్', 'పాస్‌పోర్ట్', 'పాస్పోర్ట్', 'లైసెన్స్', 'ధృవీకరణ', 'సర్టిఫికెట్', 'రేషన్', 'ప్రభుత్వ',
+        'దరఖాస్తు', 'పథకం', 'పింఛన్', 'జనన',
+    ],
+    'tourism': [
+        'charminar', 'golconda', 'hussain sagar', 'tank bund', 'salar jung', 'museum', 'ramoji', 'birla mandir',
+        'zoo', 'park', 'lake', 'tourist', 'tourism', 'visit', 'places', 'landmark', 'temple', 'mosque', 'church',
+        'bonalu', 'bathukamma', 'culture', 'history', 'heritage', 'shilparamam', 'necklace road', 'lumbini',
+        'chowmahalla', 'qutb shahi', 'festival', 'event', 'exhibition', 'numaish',
+        'पर्यटन', 'मंदिर', 'मस्जिद', 'झील', 'संग्रहालय', 'चारमीनार', 'घूमने',
+        'పర్యాటక', 'దేవాలయ', 'గుడి', 'మసీదు', 'సరస్సు', 'మ్యూజియం', 'చార్మినార్', 'గోల్కొండ',
+    ],
+    # Place names: in scope, but say nothing about the category
+    'city': [
+        'hyderabad', 'secunderabad', 'cyberabad', 'telangana', 'gachibowli', 'ameerpet', 'kukatpally',
+        'madhapur', 'hitech city', 'hitec city', 'banjara hills', 'jubilee hills', 'begumpet', 'lb nagar',
+        'dilsukhnagar', 'uppal', 'kondapur', 'miyapur', 'mehdipatnam', 'abids', 'koti', 'kothapet', 'nampally',
+        'tolichowki', 'manikonda', 'kompally', 'medchal', 'shamirpet', 'near me', 'nearest', 'current location',
+        'हैदराबाद', 'सिकंदराबाद', 'तेलंगाना',
+        'హైదరాబాద్', 'సికింద్రాబాద్', 'తెలంగాణ',
+    ],
+}
+
+# (keyword or phrase, weight). Unambiguous off-topic terms score 2.0 and are refused alone;
+# words with civic uses too (STD code, cooking classes, a festival's name, a snake) score 1.0-1.5
+# and need a second signal; generic question shapes score less.
+OUT_OF_SCOPE_KEYWORDS = [
+    ('cricket', 2.0), ('ipl', 2.0), ('world cup', 2.0), ('olympics', 2.0), ('lyrics', 2.0), ('recipe', 2.0),
+    ('javascript', 2.0), ('programming', 2.0), ('algorithm', 2.0), ('equation', 2.0),
+    ('integral', 2.0), ('derivative', 2.0), ('poem', 2.0), ('joke', 2.0), ('celebrity', 2.0),
+    ('bollywood', 2.0), ('bitcoin', 2.0), ('crypto', 2.0), ('stock market', 2.0), ('horoscope', 2.0),
+    ('astrology', 2.0), ('video game', 2.0), ('homework', 2.0), ('essay', 2.0), ('girlfriend', 2.0),
+    ('boyfriend', 2.0), ('capital of', 2.0), ('chatgpt', 2.0), ('netflix', 2.0),
+    ('football', 1.5), ('movie', 1.5), ('film', 1.5), ('actor', 1.5), ('actress', 1.5), ('song', 1.5),
+    ('coding', 1.5), ('python', 1.5), ('president of', 1.5),
+    ('cook', 1.0), ('java', 1.0), ('code', 1.0), ('math', 1.0),
+    ('who won', 0.5), ('who is', 0.3), ('tell me a', 0.5), ('write a', 0.5), ('how to make', 0.5),
+    ('meaning of', 0.5), ('solve', 0.5),
+    ('क्रिकेट', 2.0), ('चुटकुला', 2.0), ('रेसिपी', 2.0), ('कविता', 2.0), ('फिल्म', 1.5), ('गाना', 1.5),
+    ('క్రికెట్', 2.0), ('జోక్', 2.0), ('వంటకం', 2.0), ('కవిత', 2.0), ('సినిమా', 1.5), ('పాట', 1.5),
+]
+
+
+def _build_index(entries):
+    """Splits (keyword, value) pairs into a token dict and a phrase list."""
+    tokens, phrases = {}, []
+    for keyword, value in entries:
+        keyword = normalize_query(keyword)
+        if ' ' in keyword:
+            phrases.append((f" {keyword} ", value))
+        else:
+            tokens.setdefault(keyword, []).append(value)
+    return tokens, phrases
+
+
+_CATEGORY_TOKENS, _CATEGORY_PHRASES = _build_index(
+    (keyword, category) for category, keywords in CATEGORY_KEYWORDS.items() for keyword in keywords)
+_OOS_TOKENS, _OOS_PHRASES = _build_index(OUT_OF_SCOPE_KEYWORDS)
+
+
+def _token_matches(token, index):
+    """Values for `token`: exact match, else the longest keyword that prefixes it."""
+    if token in index:
+        return index[token]
+    for length in range(len(token) - 1, MIN_PREFIX - 1, -1):
+        values = index.get(token[:length])
+        if values:
+            return values
+    return ()
+
+
+@dataclass
+class Intent:
+    label: str  # 'in_scope', 'out_of_scope' or 'unknown'
+    category: str = None  # Best civic category for in-scope questions ('general' for place names only)
+    language: str = 'en'
+    scores: dict = field(default_factory=dict)
+    out_of_scope_score: float = 0.0
+
+    @property
+    def refuse(self):
+        return self.label == 'out_of_scope'
+
+    @property
+    def refusal(self):
+        return REFUSALS.get(self.language, REFUSALS['en'])
+
+
+def classify(text, threshold=None):
+    """Classifies one chat message; pure Python, a few microseconds per call."""
+    threshold = REFUSE_THRESHOLD if threshold is None else threshold
+    normalized = normalize_query(text)
+    padded = f" {normalized} "
+    tokens = normalized.split()
+
+    scores = {}
+    for token in tokens:
+        for category in _token_matches(token, _CATEGORY_TOKENS):
+            scores[category] = scores.get(category, 0.0) + 1.0
+    for phrase, category in _CATEGORY_PHRASES:
+        if phrase in padded:
+            scores[category] = scores.get(category, 0.0) + 1.0
+
+    out_of_scope = 0.0
+    for token in tokens:
+        weights = _token_matches(token, _OOS_TOKENS)
+        out_of_scope += max(weights) if weights else 0.0
+    for phrase, weight in _OOS_PHRASES:
+        if phrase in padded:
+            out_of_scope += weight
+
+    language = detect_language(text)
+    if scores:
+        civic = {name: score for name, score in scores.items() if name != 'city'}
+        category = max(civic, key=civic.get) if civic else 'general'
+        return Intent('in_scope', category, language, scores, out_of_scope)
+    if out_of_scope >= threshold:
+        return Intent('out_of_scope', None, language, scores, out_of_scope)
+    return Intent('unknown', None, language, scores, out_of_scope)
+
+
+class IntentStats:
+    """Counts per label/category and classification time, for the stats endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.total_seconds = 0.0
+        self.classified = 0
+
+    def classify(self, text):
+        start = time.perf_counter()
+        intent = classify(text)
+        elapsed = time.perf_counter() - start
+        key = intent.category or intent.label
+        with self.lock:
+            self.classified += 1
+            self.total_seconds += elapsed
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return intent
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'classified': self.classified,
+                'refused': self.counts.get('out_of_scope', 0),
+                'by_intent': dict(self.counts),
+                'avg_us': round(self.total_seconds / self.classified * 1e6, 1) if self.classified else 0.0,
+                'threshold': REFUSE_THRESHOLD,
+            }
@@ -0,0 +1,284 @@
+"""
+Background jobs for the slow upload endpoints (/api/analyze-document and
+/api/start-form-fill).
+
+With `?async=1` or `Prefer: respond-async`, the endpoint answers 202 with a job
+ID right away. A local pool of JOB_WORKERS threads then runs the same work the
+synchronous endpoint would. Clients fetch the result from /api/jobs/<id>
+(optionally long-polling with ?wait=) or subscribe to /api/jobs/<id>/events
+(SSE), so a flaky mobile connection never has to stay open for the model call.
+Admission control happens when a worker starts the job (main.job_work), not
+when it is queued, so waiting jobs hold no endpoint slot.
+
+Job records live in a SessionStore (SESSION_BACKEND), the same way form
+sessions do: memory keeps them per process, while sqlite or redis let any
+worker answer the poll. Results stay for JOB_RESULT_TTL seconds after they are
+last read. A job still running JOB_TIMEOUT seconds after it started, or still
+queued JOB_QUEUE_TIMEOUT seconds after it was submitted, is reported as failed
+(its worker process most likely died). If it finishes after all, the failure
+stands: a finished record is never overwritten.
+
+An `Idempotency-Key` header makes retried uploads safe. The same key from the
+same client for the same endpoint returns the original job instead of
+processing the upload again. Reusing a key with a different upload is a
+conflict. Keys are claimed under a process-local lock, so across processes
+this is best-effort.
+"""
+import contextvars
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+
+from latency_stats import summarize
+from observability import begin_request, finish_request, log, log_exception
+
+JOBS_ENABLED = os.getenv("JOBS_ENABLED", "1") == "1"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "64"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+# Longest run, counted from the start, and longest wait in the queue before a job counts as lost
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "300"))
+JOB_QUEUE_TIMEOUT = int(os.getenv("JOB_QUEUE_TIMEOUT", "900"))
+# Longest ?wait= a poll may block for, and how often waiters re-read the store
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "30"))
+JOB_POLL_INTERVAL = 0.5
+
+FINISHED = ('done', 'failed')
+
+
+class QueueFull(Exception):
+    """Too many jobs are queued in this process; retry later."""
+
+    def __init__(self, retry_after):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+
+class IdempotencyConflict(Exception):
+    """The Idempotency-Key was already used for a different upload."""
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@dataclass
+class Job:
+    id: str
+    endpoint: str
+    status: str = 'queued'  # queued -> running -> done | failed
+    created: float = field(default_factory=time.time)
+    started: float = None
+    finished: float = None
+    status_code: int = None  # HTTP status the synchronous endpoint would have returned
+    result: dict = None  # Its JSON body
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(**json.loads(data))
+
+    def to_bytes(self):
+        return json.dumps(self.__dict__, ensure_ascii=False).encode('utf-8')
+
+    @property
+    def is_finished(self):
+        return self.status in FINISHED
+
+    def public(self):
+        """The /api/jobs/<id> body."""
+        body = {'job_id': self.id, 'endpoint': self.endpoint, 'status': self.status, 'created': self.created}
+        if self.started:
+            body['queued_ms'] = round((self.started - self.created) * 1000, 1)
+        if self.finished:
+            body['run_ms'] = round((self.finished - (self.started or self.created)) * 1000, 1)
+            body['status_code'] = self.status_code
+            body['result'] = self.result
+        return body
+
+
+def _split_response(value):
+    """(body, status) from a Flask-style return value: body, (body, status) or (body, status, headers)."""
+    if isinstance(value, tuple):
+        return value[0], (value[1] if len(value) > 1 else 200)
+    return value, 200
+
+
+class JobQueue:
+    """
+    Runs submitted work on a thread pool and keeps each job's state in `store`.
+
+    `work(*args)` returns what the synchronous view would (a dict, or a
+    (body, status[, headers]) tuple) and must not need a request context.
+    """
+
+    def __init__(self, store, workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED, timeout=JOB_TIMEOUT,
+                 queue_timeout=JOB_QUEUE_TIMEOUT):
+        self.store = store
+        self.workers = workers
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self._pool = None
+        self._lock = threading.RLock()  # submit() reads jobs (which may count a lost one) under it
+        self._changed = threading.Condition(self._lock)
+        self._queued = 0
+        self._running = 0
+        self._run_times = deque(maxlen=1000)
+        self.counters = {'submitted': 0, 'replayed': 0, 'conflicts': 0, 'rejected': 0,
+                         'done': 0, 'failed': 0, 'lost': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _executor(self):
+        # Created on first use so a preloaded gunicorn master never forks with live pool threads
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        return self._pool
+
+    @staticmethod
+    def _idempotency_key(client, endpoint, key):
+        return 'idem:' + fingerprint(f"{client}\n{endpoint}\n{key}".encode('utf-8'))
+
+    def submit(self, endpoint, work, *args, client=None, idempotency_key=None, upload_hash=None):
+        """Queues `work(*args)` and returns (job, replayed). Raises QueueFull or IdempotencyConflict."""
+        with self._lock:
+            claim = None
+            if idempotency_key:
+                claim = self._idempotency_key(client, endpoint, idempotency_key)
+                data = self.store.get(claim)
+                if data is not None:
+                    record = json.loads(data)
+                    job = self.get(record['job_id'])
+                    if job is not None:
+                        if upload_hash and record.get('upload') not in (None, upload_hash):
+                            self.counters['conflicts'] += 1
+                            raise IdempotencyConflict("Idempotency-Key was already used for a different upload")
+                        self.counters['replayed'] += 1
+                        return job, True
+            if self._queued >= self.max_queued:
+                self.counters['rejected'] += 1
+                raise QueueFull(retry_after=self._retry_after())
+            job = Job(uuid.uuid4().hex, endpoint)
+            self.store.put(job.id, job.to_bytes())
+            if claim:
+                self.store.put(claim, json.dumps({'job_id': job.id, 'upload': upload_hash}).encode('utf-8'))
+            self._queued += 1
+            self.counters['submitted'] += 1
+            pool = self._executor()
+        # A fresh context per job: no request ID or stage timings leak in from the submitting request
+        pool.submit(contextvars.Context().run, self._run, replace(job), work, args)
+        return job, False
+
+    def _retry_after(self):
+        """Seconds until the queue has roughly drained, from recent run times."""
+        mean = sum(self._run_times) / len(self._run_times) if self._run_times else 5.0
+        return max(1, math.ceil(mean * self._queued / max(1, self.workers)))
+
+    def _save_unless_finished(self, job):
+        """Writes the job unless its stored record already finished (reported lost by get()). Lock held."""
+        data = self.store.get(job.id)
+        if data is not None and Job.from_bytes(data).is_finished:
+            return False
+        self.store.put(job.id, job.to_bytes())
+        return True
+
+    def _run(self, job, work, args):
+        begin_request(f"job:{job.endpoint}", 'JOB', job.id)
+        job.status = 'running'
+        job.started = time.time()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            try:
+                started = self._save_unless_finished(job)
+            except Exception as e:
+                log_exception('job_save_failed', e)
+                started = True
+        if not started:
+            # Waited past JOB_QUEUE_TIMEOUT and was already reported as failed: don't run it now
+            body, status = None, 504
+        else:
+            try:
+                body, status = _split_response(work(*args))
+            except Exception as e:
+                log_exception('job_failed', e)
+                body, status = {'error': 'Job failed', 'details': str(e)}, 500
+        job.status = 'done' if status < 400 else 'failed'
+        job.status_code = status
+        job.result = body
+        job.finished = time.time()
+        with self._changed:
+            if started:
+                try:
+                    if not self._save_unless_finished(job):
+                        log('job_finished_after_timeout', level='warning', job_id=job.id, status=job.status)
+                except Exception as e:
+                    log_exception('job_save_failed', e)
+                self.counters[job.status] += 1
+                self._run_times.append(job.finished - job.started)
+            self._running -= 1
+            self._changed.notify_all()
+        finish_request(status)
+
+    def get(self, job_id):
+        """The job, or None if it is unknown or its result expired."""
+        data = self.store.get(job_id) if job_id and not job_id.startswith('idem:') else None
+        if data is None:
+            return None
+        job = Job.from_bytes(data)
+        overdue = self._overdue(job)
+        if overdue:
+            with self._lock:
+                # Re-read under the lock so a job finishing right now in this process wins
+                job = Job.from_bytes(self.store.get(job_id) or data)
+                if not job.is_finished and self._overdue(job):
+                    # Its worker is gone (crash, redeploy): stop clients waiting forever
+                    job.status, job.status_code, job.finished = 'failed', 504, time.time()
+                    job.result = {'error': 'Job did not finish in time', 'status': overdue[0], 'timeout': overdue[1]}
+                    self.store.put(job.id, job.to_bytes())
+                    self.counters['lost'] += 1
+        return job
+
+    def _overdue(self, job):
+        """(status, limit) if an unfinished job is past its queue or run limit, else None."""
+        now = time.time()
+        if job.status == 'running' and now - (job.started or job.created) > self.timeout:
+            return 'running', self.timeout
+        if job.status == 'queued' and now - job.created > self.queue_timeout:
+            return 'queued', self.queue_timeout
+        return None
+
+    def wait(self, job_id, timeout, last_status=None):
+        """
+        Returns the job once it has finished, or its status differs from
+        `last_status`, or `timeout` seconds have passed. Local jobs wake waiters
+        directly; jobs run by other processes are seen by re-reading the store
+        every JOB_POLL_INTERVAL.
+        """
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.is_finished or remaining <= 0:
+                return job
+            if last_status is not None and job.status != last_status:
+                return job
+            with self._changed:
+                self._changed.wait(min(JOB_POLL_INTERVAL, remaining))
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            queued, running = self._queued, self._running
+            run_times = list(self._run_times)
+        return dict(counters, queued=queued, running=running, workers=self.workers, max_queued=self.max_queued,
+                    run_time=summarize(run_times), store=self.store.stats())
@@ -0,0 +1,27 @@
+"""Small helpers for summarizing latency samples (used by the benchmarks and evaluations)."""
+import math
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list; None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies, elapsed=None):
+    """p50/p95/p99/mean/max in milliseconds, plus throughput when elapsed seconds are given."""
+    summary = {'count': len(latencies)}
+    if latencies:
+        summary.update({
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+            'max_ms': round(max(latencies) * 1000, 1),
+        })
+    if elapsed:
+        summary['throughput_rps'] = round(len(latencies) / elapsed, 2)
+    return summary
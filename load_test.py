@@ -0,0 +1,299 @@
+"""
+Offline load test for the CitiAssist API.
+
+Starts the Flask app in-process on a local port with every Gemini model
+replaced by fake_gemini.FakeGenerativeModel, then replays a mixed workload
+against all endpoints using the sample images shipped with the repo.
+No network access or API key is needed.
+
+Reports per endpoint: p50/p95/p99 latency, throughput and error rate, plus
+the process memory high-water mark (server and load generator share the process).
+
+Usage:
+    python load_test.py --requests 500 --concurrency 32 --latency 0.8 --jitter 0.3
+    python load_test.py --mix chat=70,report=10,analyze=10,form=5,fill=5 --failure-rate 0.05 --json report.json
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# The app reads the key at import time; the fake model never uses it
+os.environ.setdefault("GEMINI_API_KEY", "offline-load-test")
+
+import google.generativeai as genai
+from werkzeug.serving import make_server
+
+import fake_gemini
+from admission import AdmissionController, EndpointLimit
+from gemini_client import GeminiClient
+from latency_stats import summarize
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_IMAGES = [
+    os.path.join(ROOT, "dummy_form.jpg"),
+    os.path.join(ROOT, "sample govt forms", "APPLICATION_FOR_BIRTH_CERTIFICATE_page-0001.jpg"),
+]
+CHAT_QUESTIONS = [
+    "What is the emergency number for police in Hyderabad?",
+    "How do I apply for a birth certificate?",
+    "Nearest government hospital (Current Location: 17.4401, 78.3489)",
+    "How to go from Ameerpet to Hitech City by metro?",
+    "Where can I pay my electricity bill?",
+    "Who won the cricket world cup in 2011?",
+]
+DEFAULT_MIX = "chat=60,stream=10,report=10,analyze=8,form=7,fill=5"
+
+
+def multipart_body(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+class Workload:
+    """Builds requests for each endpoint and runs them against base_url."""
+
+    def __init__(self, base_url, seed=None):
+        self.base_url = base_url
+        self.random = random.Random(seed)
+        self.images = []
+        for path in SAMPLE_IMAGES:
+            with open(path, "rb") as f:
+                self.images.append((os.path.basename(path), f.read()))
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+
+    def _post(self, path, body, content_type):
+        request = urllib.request.Request(self.base_url + path, data=body, method="POST",
+                                         headers={"Content-Type": content_type})
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return response.status, response.read()
+
+    def _post_json(self, path, payload):
+        return self._post(path, json.dumps(payload).encode(), "application/json")
+
+    def _post_image(self, path):
+        filename, data = self.random.choice(self.images)
+        body, content_type = multipart_body("image", filename, data)
+        return self._post(path, body, content_type)
+
+    def chat(self):
+        return self._post_json("/api/chat", {"message": self.random.choice(CHAT_QUESTIONS)})
+
+    def stream(self):
+        return self._post_json("/api/chat/stream", {"message": self.random.choice(CHAT_QUESTIONS)})
+
+    def report(self):
+        return self._post_image("/api/report-issue")
+
+    def analyze(self):
+        return self._post_image("/api/analyze-document")
+
+    def form(self):
+        status, body = self._post_image("/api/start-form-fill")
+        data = json.loads(body)
+        with self.sessions_lock:
+            self.sessions.append((data["session_id"], data["fields"]))
+        return status, body
+
+    def fill(self):
+        with self.sessions_lock:
+            session = self.random.choice(self.sessions) if self.sessions else None
+        if session is None:
+            # No session yet: start one first (counted under "form")
+            return None
+        session_id, fields = session
+        answers = {field["field_name"]: {"answer": "Ravi Kumar", "box_2d": field["box_2d"]} for field in fields}
+        return self._post_json("/api/fill-form", {"session_id": session_id, "answers": answers})
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def start_server(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def install_fake_models(main_module, latency, jitter, failure_rate, seed):
+    """Rebuilds the app's Gemini client on fake models; retry, breaker and fallback policies stay real."""
+    def factory(model_name="gemini-2.5-flash", **kwargs):
+        return fake_gemini.FakeGenerativeModel(model_name, latency=latency, jitter=jitter,
+                                               failure_rate=failure_rate, seed=seed, **kwargs)
+    genai.GenerativeModel = factory
+    main_module.gemini = GeminiClient(system_instruction=main_module.SYSTEM_INSTRUCTION, model_factory=factory,
+                                      usage_meter=main_module.token_meter)
+
+
+def run(args):
+    if args.dispatch is not None:
+        # Read by main at import time
+        os.environ["CHAT_DISPATCH"] = "1"
+        os.environ["CHAT_BATCH_WINDOW_MS"] = str(args.dispatch)
+    import main as app_main
+    install_fake_models(app_main, args.latency, args.jitter, args.failure_rate, args.seed)
+    if not args.cache:
+        app_main.CHAT_CACHE_ENABLED = False
+    if hasattr(app_main, "form_templates") and not args.cache:
+        app_main.form_templates.path = None
+        app_main.form_templates.max_templates = 0
+    if hasattr(app_main, "uploads") and not args.cache:
+        # The workload replays the same sample images; measure model calls, not stored answers
+        app_main.uploads.enabled = False
+    if not args.admission:
+        # Every simulated user shares 127.0.0.1, so measure the app without quota or fairness limits
+        app_main.admission = AdmissionController(
+            0, limits={name: EndpointLimit(10 ** 6) for name in app_main.admission.limits})
+
+    server, base_url = start_server(app_main.app)
+    workload = Workload(base_url, args.seed)
+    weights = parse_mix(args.mix)
+    names = list(weights)
+    chooser = random.Random(args.seed)
+
+    # fill-form needs at least one session to exist (injected failures may hit this too)
+    for _ in range(20):
+        with contextlib.suppress(urllib.error.HTTPError):
+            workload.form()
+            break
+
+    results = {name: {"latencies": [], "errors": 0, "error_kinds": {}} for name in names}
+    results_lock = threading.Lock()
+
+    def one_request(_):
+        name = chooser.choices(names, weights=[weights[n] for n in names])[0]
+        start = time.perf_counter()
+        error = None
+        try:
+            outcome = getattr(workload, name)()
+            if outcome is None:
+                return
+        except urllib.error.HTTPError as e:
+            error = f"HTTP {e.code}"
+        except Exception as e:
+            error = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with results_lock:
+            entry = results[name]
+            entry["latencies"].append(elapsed)
+            if error:
+                entry["errors"] += 1
+                entry["error_kinds"][error] = entry["error_kinds"].get(error, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one_request, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    report = {"elapsed_s": round(elapsed, 2), "concurrency": args.concurrency, "endpoints": {}}
+    all_latencies, all_errors = [], 0
+    for name in names:
+        entry = results[name]
+        summary = summarize(entry["latencies"], elapsed)
+        summary["error_rate"] = round(entry["errors"] / len(entry["latencies"]), 4) if entry["latencies"] else 0.0
+        summary["errors"] = entry["error_kinds"]
+        report["endpoints"][name] = summary
+        all_latencies += entry["latencies"]
+        all_errors += entry["errors"]
+    report["overall"] = summarize(all_latencies, elapsed)
+    report["overall"]["error_rate"] = round(all_errors / len(all_latencies), 4) if all_latencies else 0.0
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["upstream"] = app_main.gemini.stats()
+    report["admission"] = app_main.admission.stats()
+    if app_main.chat_dispatcher is not None:
+        report["dispatch"] = app_main.chat_dispatcher.stats.snapshot()
+    report["tokens"] = app_main.token_meter.snapshot()
+    report["memory_high_water_mb"] = round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    return report
+
+
+def print_report(report):
+    header = f"{'endpoint':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    rows = itertools.chain(report["endpoints"].items(), [("overall", report["overall"])])
+    for name, summary in rows:
+        if not summary["count"]:
+            continue
+        print(f"{name:<10} {summary['count']:>6} {summary['p50_ms']:>9} {summary['p95_ms']:>9} "
+              f"{summary['p99_ms']:>9} {summary['throughput_rps']:>8} {summary['error_rate']:>8.1%}")
+    upstream = report.get("upstream")
+    if upstream:
+        totals = {field: sum(policy[field] for policy in upstream["policies"].values())
+                  for field in ("attempts", "retries", "timeouts", "fallbacks", "short_circuits", "unavailable")}
+        print("\nUpstream: " + ", ".join(f"{field} {count}" for field, count in totals.items()))
+    dispatch = report.get("dispatch")
+    if dispatch:
+        delay = dispatch["queue_delay"]
+        print(f"Chat dispatcher: {dispatch['requests']} requests, {dispatch['upstream_calls']} upstream calls "
+              f"({dispatch['calls_saved']} saved), queue delay p50 {delay.get('p50_ms')} ms / p95 {delay.get('p95_ms')} ms")
+    tokens = report.get("tokens")
+    if tokens:
+        print("Tokens/request: " + ", ".join(
+            f"{name} {usage['avg_prompt_tokens']} in / {usage['avg_output_tokens']} out"
+            for name, usage in tokens.items()))
+    print(f"\nElapsed: {report['elapsed_s']}s   Memory high-water mark: {report['memory_high_water_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.5, help="mean fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="+/- uniform jitter in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of a 429/503 upstream error")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"endpoint weights (default {DEFAULT_MIX})")
+    parser.add_argument("--cache", action="store_true", help="keep the chat cache, form template index and upload store enabled")
+    parser.add_argument("--admission", action="store_true",
+                        help="keep admission control (ADMISSION_* limits) enabled; 429s count as errors")
+    parser.add_argument("--dispatch", type=float, metavar="WINDOW_MS",
+                        help="enable the chat dispatcher (single-flight) with this batching window")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", help="also write the report to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the app's request logs and tracebacks")
+    args = parser.parse_args()
+
+    print(f"Replaying {args.requests} requests, concurrency {args.concurrency}, "
+          f"fake latency {args.latency}s +/- {args.jitter}s, failure rate {args.failure_rate:.0%}")
+    if args.verbose:
+        report = run(args)
+    else:
+        # The app logs every request and prints tracebacks for injected failures
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            report = run(args)
+    print()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
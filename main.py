@@ -1,67 +1,468 @@
 import os
-from flask import Flask, request, jsonify
+import json
+import time
+import base64
+import functools
+import threading
+import uuid
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context
 from flask_cors import CORS
-import google.generativeai as genai
 from dotenv import load_dotenv
+import re
+from response_cache import ResponseCache
+from session_store import create_session_store
+from image_pipeline import image_fingerprint, pipeline_stats, preprocess_image
+from form_templates import TemplateIndex
+from batch_reports import (BATCH_MAX_IMAGES, BatchPhoto, cluster_location, cluster_photos, fill_location,
+                           gps_coordinates, location_label, run_bounded)
+from upload_store import UploadStore, upload_digest, version_tag
+from pdf_pages import PDF_MAX_PAGES, count_pages, is_pdf, map_pages, page_coverage
+from form_renderer import OUTPUT_FORMATS, render_filled_form, render_filled_pdf
+from gemini_client import GeminiClient, UpstreamUnavailable
+from admission import AdmissionController, AdmissionRejected, estimate_cost
+from dispatcher import ChatDispatcher
+from intent_classifier import IntentStats, classify
+from civic_index import CivicIndex
+from observability import (begin_request, finish_request, log, log_exception, metrics, observe_stage,
+                           profiler, profiler_authorized, profiler_command, redact, span)
+from job_queue import (JOB_MAX_WAIT, JOB_RESULT_TTL, JOBS_ENABLED, IdempotencyConflict, JobQueue, QueueFull,
+                       fingerprint)
+from conversations import CONVERSATIONS, CONVERSATION_TTL, ConversationStore, refers_back, summary_request
+from prompts import (ANALYZE_DOCUMENT_PROMPT, CONTEXT_CACHE, FORM_FIELDS_PROMPT, REPORT_ISSUE_PROMPT,
+                     SYSTEM_INSTRUCTION, CachedContentModels, TokenMeter, location_line, strip_location)
+from structured_output import (COMPLAINT_CONFIG, FORM_FIELDS_CONFIG, ComplaintResult, FieldsResult,
+                               structured_stats)
 
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
+# Every route lives on this blueprint; create_app() (bottom of the file) builds the Flask app around it
+api = Blueprint('api', __name__)
+
+# Request ID, latency histogram and one JSON access log line per request (observability.py)
+def start_request_context():
+    begin_request(request.url_rule.rule if request.url_rule else None, request.method,
+                  request.headers.get('X-Request-ID'))
 
-# Configure Gemini API
+def finish_request_context(response):
+    rid = finish_request(response.status_code)
+    if rid:
+        response.headers['X-Request-ID'] = rid
+    return response
+
+# The Gemini SDK is imported and configured on first use (gemini_client.load_sdk)
 GENAI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GENAI_API_KEY:
-    print("Warning: GEMINI_API_KEY not found in environment variables.")
-else:
-    print(f"Draft loaded API Key starting with: {GENAI_API_KEY[:5]}...  (Length: {len(GENAI_API_KEY)})")
-
-
-genai.configure(api_key=GENAI_API_KEY)
-
-# System Instruction
-SYSTEM_INSTRUCTION = """
-You are CitiAssist, a helpful Smart City guide for the city of Hyderabad only.
-Your scope is STRICTLY restricted to the following topics:
-1. Hospitals & Healthcare
-2. Public Transport (Metro, Buses, Trains)
-3. Police & Safety
-4. Utilities (Electricity, Water, Waste Management, Municipal Services)
-5. Government Services & Documentation (Aadhar, PAN, Voter ID, Driving License, Passport, etc.)
-6. Tourism, Landmarks, and City Culture (Professional city information)
-
-Rules:
-- If a user asks about anything OUTSIDE these 6 categories (e.g. general programming, math, pop culture, recipes, or general chit-chat), explicitly state "Data not available. My scope is strictly restricted to Civic and City Services for Hyderabad."
-- DETECT the language of the user's query and RESPOND IN THE SAME LANGUAGE.
-- **FORMATTING**: Use Markdown. **Bold** names/headers. Lists for readability.
-
-### TRANSIT & ROUTING RULES (A to B Queries)
-If the user asks how to get from one place to another (e.g. "How to go from X to Y" or "Route to Z"):
-1. Provide a **Cost-Optimized, Multi-Modal Route**: Suggest the best mix of TSRTC Buses, Hyderabad Metro, and MMTS.
-2. Structure the response strictly as:
-   - **Overview**: Total Estimated Time and best modes of transport.
-   - **Step-by-Step Breakdown**: Clear numbered steps (e.g., "1. Take bus 218 from X to Y. 2. Board the Red Line Metro at Y.").
-   - **Estimated Cost**: State the total estimated price in INR.
-3. EXCEPTION: Do **NOT** provide external links to TSRTC or Metro websites for routing queries. Give the user all the information directly in the chat text so they don't have to leave the app.
-
-### STANDARD LINKING RULE (For Non-Routing Queries)
-- If discussing general hospitals, police stations, or government portals, you MUST provide a clickable link.
-- **Locations**: `[Apollo Hospital](https://www.google.com/maps/search/?api=1&query=Apollo+Hospital)`
-- **Services**: `[Meeseva Portal](https://ts.meeseva.gov.in/)`
-
-### LOCATION/GPS HANDLING
-- If the user provides "Current Location: [Lat], [Long]", USE these coordinates to identify the area (e.g., Gachibowli, Jubilee Hills).
-- Provide results *specifically* near that determined location. Do NOT ask for their location again.
-
-Keep answers concise, helpful, and polite.
-"""
-
-model = genai.GenerativeModel(
-    model_name="gemini-2.5-flash",
-    system_instruction=SYSTEM_INSTRUCTION
+    log('gemini_api_key_missing', level='warning')
+
+# Every Gemini call goes through this client: per-call deadlines, jittered retries,
+# circuit breaking and fallback to a lighter model (GEMINI_* env vars).
+# Form field extraction uses the "form" policy, which runs without the chat system instruction.
+# The system instruction is sent as cached content when GEMINI_CONTEXT_CACHE is on,
+# and every response's token usage is counted per endpoint (/api/token-usage).
+token_meter = TokenMeter()
+gemini = GeminiClient(system_instruction=SYSTEM_INSTRUCTION,
+                      model_factory=CachedContentModels() if CONTEXT_CACHE else None,
+                      usage_meter=token_meter)
+
+SAFETY_BLOCK_MESSAGE = "I apologize, but I cannot answer that query due to safety or policy restrictions. Please try rephrasing."
+DOCUMENT_BLOCK_MESSAGE = "Could not analyze document due to safety settings."
+UPSTREAM_UNAVAILABLE_MESSAGE = "The assistant is busy right now. Please try again in a few seconds."
+
+def upstream_unavailable(error):
+    """503 + Retry-After for when Gemini is overloaded or down (works as a Flask or Quart return value)."""
+    log('upstream_unavailable', level='warning', error=str(error))
+    body = {'error': UPSTREAM_UNAVAILABLE_MESSAGE, 'details': str(error), 'retry_after': error.retry_after}
+    return body, 503, {'Retry-After': str(error.retry_after)}
+
+# One shared GEMINI_API_KEY quota: token bucket + per-endpoint concurrency limits
+# + per-client fair queuing for every model-backed endpoint (ADMISSION_* env vars)
+admission = AdmissionController.from_env()
+
+def client_id(req):
+    """Caller's IP; behind Render's proxy the client is the first X-Forwarded-For hop."""
+    return (req.access_route[0] if req.access_route else req.remote_addr) or 'unknown'
+
+def too_many_requests(error):
+    """429 + Retry-After when admission control turns a request away (Flask or Quart return value)."""
+    body = {'error': 'Too many requests right now. Please try again shortly.',
+            'details': error.reason, 'retry_after': error.retry_after}
+    return body, 429, {'Retry-After': str(error.retry_after)}
+
+def bytes_cost(endpoint, data):
+    """Estimated tokens for image/PDF bytes; PDFs are charged per page."""
+    pages = 1
+    if is_pdf(data):
+        try:
+            pages = min(count_pages(data), PDF_MAX_PAGES)
+        except Exception:
+            pass  # Unreadable PDF: the endpoint reports it
+    return estimate_cost(endpoint, pages=pages)
+
+def upload_cost(endpoint, upload):
+    """Estimated tokens for an image/PDF upload. Leaves the file rewound."""
+    if upload is None:
+        return estimate_cost(endpoint)
+    head = upload.read(8)
+    data = head + upload.read() if is_pdf(head) else head
+    upload.seek(0)
+    return bytes_cost(endpoint, data)
+
+def estimate_request_cost(endpoint, req):
+    if endpoint in ('chat', 'stream'):
+        data = req.args if req.method == 'GET' else (req.get_json(silent=True) or {})
+        return chat_cost(endpoint, str(data.get('message', '')))
+    if endpoint == 'batch':
+        return batch_cost(batch_uploads(req.files))
+    return upload_cost(endpoint, req.files.get('image'))
+
+def admitted(endpoint):
+    """
+    Runs the view only once admission control lets the request through; 429 otherwise.
+    Requests for a background job skip it: the job is admitted when a worker starts it (job_work).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if endpoint in JOB_ENDPOINTS and wants_job(request):
+                return view(*args, **kwargs)
+            try:
+                ticket = admission.acquire(endpoint, client_id(request), estimate_request_cost(endpoint, request))
+            except AdmissionRejected as e:
+                return too_many_requests(e)
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                admission.release(ticket)
+                raise
+            if response.is_streamed:
+                # Hold the slot until the stream is finished or the client goes away
+                response.call_on_close(lambda: admission.release(ticket))
+            else:
+                admission.release(ticket)
+            return response
+        return wrapper
+    return decorator
+
+# Repeat uploads (same bytes) reuse their preprocessed image and finished answers (upload_store.py)
+uploads = UploadStore.from_env()
+
+# Stored answers are only reused while the prompt, output config and model stay the same
+REPORT_VERSION = version_tag(REPORT_ISSUE_PROMPT, COMPLAINT_CONFIG, gemini.models[0])
+ANALYZE_VERSION = version_tag(ANALYZE_DOCUMENT_PROMPT, gemini.models[0])
+FORM_VERSION = version_tag(FORM_FIELDS_PROMPT, FORM_FIELDS_CONFIG, gemini.models[0])
+
+def prepare_upload(image_bytes, mode, digest=None):
+    """Runs an upload through the image pipeline, or reuses the last run on the same bytes; returns the PreparedImage."""
+    prepared, reused = uploads.prepared(digest or upload_digest(image_bytes), mode,
+                                        lambda: preprocess_image(image_bytes, mode))
+    if reused:
+        log('image_pipeline', mode=mode, reused=True, bytes_out=len(prepared.data))
+        return prepared
+    stats = prepared.stats
+    observe_stage('decode', stats['decode_ms'] / 1000)
+    observe_stage('preprocess', (stats['elapsed_ms'] - stats['decode_ms']) / 1000)
+    log('image_pipeline', mode=mode, bytes_in=stats['original_bytes'], bytes_out=stats['output_bytes'],
+        size_in=stats['original_size'], size_out=stats['output_size'], elapsed_ms=stats['elapsed_ms'])
+    return prepared
+
+# Re-ask only for the broken part of a malformed structured reply (one extra, smaller call)
+STRUCTURED_REPAIR = os.getenv("STRUCTURED_REPAIR", "1").lower() not in ("0", "false", "no")
+
+def finish_report(text):
+    """Returns (complaint, complete) for the report-issue reply; missing keys are re-asked for, text only."""
+    with span('parse'):
+        result = ComplaintResult(text)
+    if not result.needs_repair or not STRUCTURED_REPAIR:
+        return result.value(), not result.missing
+    try:
+        repair = gemini.generate(result.repair_prompt(), policy='repair', endpoint='report',
+                                 generation_config=result.repair_config())
+        complaint = result.merge(repair.text)
+    except Exception as e:
+        log('repair_failed', level='warning', target='complaint', error=f"{type(e).__name__}: {e}")
+        complaint = result.repair_failed()
+    return complaint, not result.missing
+
+def finish_form_fields(text, image_part):
+    """Returns (fields, complete). Broken or cut-off fields are re-asked for with the same image."""
+    with span('parse'):
+        result = FieldsResult(text)
+    if result.complete:
+        return result.fields, True
+    if not STRUCTURED_REPAIR:
+        return result.repair_failed(), False
+    try:
+        repair = gemini.generate([image_part, result.repair_prompt()], policy='repair', endpoint='form',
+                                 generation_config=FORM_FIELDS_CONFIG)
+        fields = result.merge(repair.text)
+    except Exception as e:
+        log('repair_failed', level='warning', target='form_fields', error=f"{type(e).__name__}: {e}")
+        fields = result.repair_failed()
+    return fields, result.complete
+
+# The request-independent halves of the upload endpoints, called by both main.py and asgi.py:
+# stored_answer() before any model call, *_call() for its arguments and *_reply() for its result
+
+def stored_answer(image_bytes, endpoint, version):
+    """(digest, stored answer or None) for an upload."""
+    digest = upload_digest(image_bytes)
+    return digest, uploads.result(digest, endpoint, version)
+
+def report_call(prepared):
+    """gemini.generate arguments for drafting a complaint from one photo."""
+    return dict(contents=[REPORT_ISSUE_PROMPT, prepared.as_part()], policy='vision', endpoint='report',
+                generation_config=COMPLAINT_CONFIG)
+
+def report_reply(digest, response):
+    """The complaint for a report-issue reply; stored for repeat uploads once complete."""
+    complaint, complete = finish_report(response.text)
+    if complete:
+        uploads.put_result(digest, 'report', REPORT_VERSION, complaint)
+    return complaint
+
+def analyze_call(prepared):
+    """gemini.generate arguments for explaining one document image."""
+    return dict(contents=[ANALYZE_DOCUMENT_PROMPT, prepared.as_part()], policy='vision', endpoint='analyze')
+
+def analyze_reply(digest, response):
+    """The analyze-document body for a reply; blocked replies get the safety message and aren't stored."""
+    if not response.parts:
+        return {'response': DOCUMENT_BLOCK_MESSAGE}
+    result = {'response': response.text}
+    uploads.put_result(digest, 'analyze', ANALYZE_VERSION, result)
+    return result
+
+# matches "(Current Location: 17.44, 78.34)" OR "near 17.44, 78.34"
+COORD_PATTERN = re.compile(r'(?:Current Location:|near)\s*([\d.-]+),\s*([\d.-]+)', re.IGNORECASE)
+
+def extract_coordinates(user_message):
+    """Returns (lat, long) strings if the message carries GPS coordinates, else None."""
+    coord_match = COORD_PATTERN.search(user_message)
+    return coord_match.groups() if coord_match else None
+
+def build_chat_prompt(user_message, reference=None):
+    """
+    Replaces GPS coordinates in the message with a one-line location context
+    naming the resolved area, and adds the civic index reference lines when given.
+    Returns the final prompt sent to the model.
+    """
+    # Smart Location Handling: Extract coordinates and force context
+    coords = extract_coordinates(user_message)
+
+    final_prompt = user_message
+    if coords:
+        lat, long = coords
+        area = civic_index.area_name(coords)
+        log('chat_location', area=area or 'unknown')
+        final_prompt = location_line(lat, long, area) + strip_location(user_message, COORD_PATTERN)
+
+    if reference:
+        final_prompt = civic_index.context_block(reference) + final_prompt
+    return final_prompt
+
+# Local knowledge base of Hyderabad civic facts and places (CIVIC_DATA_PATH).
+# CIVIC_DIRECT answers fact / "nearest X" questions without the model;
+# CIVIC_CONTEXT adds matching facts and nearby places to the prompt.
+civic_index = CivicIndex.load()
+CIVIC_DIRECT = os.getenv("CIVIC_DIRECT", "1").lower() in ("1", "true", "yes")
+CIVIC_CONTEXT = os.getenv("CIVIC_CONTEXT", "1").lower() in ("1", "true", "yes")
+
+def civic_lookup(user_message):
+    """Returns (direct answer or None, reference lines for the prompt)."""
+    if not (CIVIC_DIRECT or CIVIC_CONTEXT):
+        return None, []
+    answer, reference = civic_index.lookup(COORD_PATTERN.sub(' ', user_message),
+                                           extract_coordinates(user_message), direct=CIVIC_DIRECT)
+    return answer, reference if CIVIC_CONTEXT else []
+
+# Cache for repeated chat questions, keyed on the question without its coordinates
+# plus the detected language and a ~1 km location cell.
+# CHAT_CACHE_SIMILARITY (e.g. 0.85) enables near-duplicate matching; 0 disables the cache.
+chat_cache = ResponseCache(
+    max_entries=int(os.getenv("CHAT_CACHE_SIZE", "1024")),
+    ttl_seconds=int(os.getenv("CHAT_CACHE_TTL", "3600")),
+    similarity_threshold=float(os.getenv("CHAT_CACHE_SIMILARITY", "0")) or None,
 )
+CHAT_CACHE_ENABLED = chat_cache.max_entries > 0
+
+# Optional shared dispatcher: identical in-flight questions share one upstream call,
+# and CHAT_BATCH_WINDOW_MS groups distinct ones into a single parallel submission
+CHAT_DISPATCH = os.getenv("CHAT_DISPATCH", "0").lower() in ("1", "true", "yes")
+CHAT_BATCH_WINDOW_MS = float(os.getenv("CHAT_BATCH_WINDOW_MS", "0"))
+CHAT_BATCH_MAX = int(os.getenv("CHAT_BATCH_MAX", "16"))
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "45"))  # Seconds a request waits on a shared call
+chat_dispatcher = ChatDispatcher(
+    lambda prompt: gemini.generate(prompt, policy='chat'),
+    window_ms=CHAT_BATCH_WINDOW_MS,
+    max_batch=CHAT_BATCH_MAX,
+) if CHAT_DISPATCH else None
+
+# Local pre-classifier: clear out-of-scope questions get the canned refusal without
+# a model call; the rest are tagged with their civic category (INTENT_* env vars)
+INTENT_FILTER = os.getenv("INTENT_FILTER", "1").lower() in ("1", "true", "yes")
+intent_stats = IntentStats()
+
+# Server-side chat sessions: send "conversation_id" (null starts one) and follow-ups get
+# a rolling summary plus the recent turns as context (CONVERSATION_* env vars).
+# Stored in the SESSION_BACKEND store, so any worker can continue a conversation.
+def summarize_conversation(summary, messages):
+    response = gemini.generate(summary_request(summary, messages), policy='summary', endpoint='summary')
+    return response.text if response.parts else None
+
+conversations = ConversationStore(create_session_store("conversation", CONVERSATION_TTL), summarize_conversation)
+
+def open_conversation(data):
+    """Conversation for data['conversation_id'] (a new one for null or expired ids); None if the key is absent."""
+    if not CONVERSATIONS or 'conversation_id' not in data:
+        return None
+    return conversations.open(data.get('conversation_id'))
+
+def is_follow_up(conversation, user_message):
+    """
+    Whether the reply depends on earlier turns. Only follow-ups get the history and skip
+    the shared response cache and dispatcher; standalone questions are answered as usual.
+    """
+    return (conversation is not None and conversation.has_history
+            and refers_back(COORD_PATTERN.sub(' ', user_message)))
+
+def chat_contents(final_prompt, conversation, follow_up):
+    """The prompt alone, or the conversation's summary and recent turns followed by it."""
+    return conversation.contents(final_prompt, conversations.token_budget) if follow_up else final_prompt
+
+def remember_turn(conversation, user_message, reply, payload):
+    """Saves the turn (pass reply=None for blocked replies) and adds the conversation id to the response."""
+    if conversation is None:
+        return payload
+    if reply is not None:
+        conversation.add_turn(user_message, reply)
+    conversations.save(conversation)
+    return dict(payload, conversation_id=conversation.id)
+
+def screen_chat(user_message):
+    """Intent of a chat message (coordinates stripped), or None when INTENT_FILTER is off."""
+    if not INTENT_FILTER:
+        return None
+    return intent_stats.classify(COORD_PATTERN.sub(' ', user_message))
+
+def intent_fields(intent):
+    """Extra response keys describing the intent."""
+    if intent is None:
+        return {}
+    if intent.refuse:
+        return {'refused': True, 'intent': intent.label}
+    return {'intent': intent.label, 'category': intent.category}
+
+def chat_cost(endpoint, user_message):
+    """Admission cost of a chat message; refusals and civic index answers are local and cost no quota."""
+    if not user_message:
+        return estimate_cost(endpoint)
+    question = COORD_PATTERN.sub(' ', user_message)
+    if INTENT_FILTER and classify(question).refuse:
+        return 0
+    if CIVIC_DIRECT and civic_index.lookup(question, extract_coordinates(user_message), record=False)[0]:
+        return 0
+    return estimate_cost(endpoint, text=user_message)
+
+def chat_cache_lookup(user_message, follow_up=False):
+    """Returns (cached reply or None, cache query, coords)."""
+    coords = extract_coordinates(user_message)
+    cache_query = COORD_PATTERN.sub(' ', user_message)
+    if not CHAT_CACHE_ENABLED or follow_up:
+        return None, cache_query, coords
+    return chat_cache.get(cache_query, coords), cache_query, coords
+
+def sse_event(payload, event=None):
+    """Formats one Server-Sent Events frame."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
-@app.route('/api/chat', methods=['POST'])
+class ChatTurn:
+    """
+    One chat message through everything except the model call, shared by the
+    chat endpoints here and in asgi.py: screening, civic index answers, the
+    response cache and the conversation. Opening and finishing a turn may touch
+    the session stores, so asgi.py runs those steps off the event loop.
+    """
+
+    def __init__(self, data):
+        self.message = data.get('message', '')
+        self.conversation = open_conversation(data)
+        self.follow_up = is_follow_up(self.conversation, self.message)
+        self.intent = screen_chat(self.message)
+        self.instant = None  # (reply, extra response fields) when the model isn't needed
+        self.prompt = self.cache_query = self.coords = None
+        reference = []
+        if self.intent is not None and self.intent.refuse:
+            self.instant = (self.intent.refusal, {})
+        else:
+            direct_reply, reference = civic_lookup(self.message)
+            if direct_reply is not None:
+                self.instant = (direct_reply, {'source': 'civic_index'})
+        if self.instant is None:
+            cached_reply, self.cache_query, self.coords = chat_cache_lookup(self.message, self.follow_up)
+            if cached_reply is not None:
+                self.instant = (cached_reply, {'cached': True})
+            else:
+                self.prompt = build_chat_prompt(self.message, reference)
+
+    @property
+    def contents(self):
+        return chat_contents(self.prompt, self.conversation, self.follow_up)
+
+    @property
+    def dispatch_key(self):
+        """Key for the chat dispatcher, or None when the reply depends on earlier turns."""
+        return None if self.follow_up else chat_cache.make_key(self.cache_query, self.coords)
+
+    def _finish(self, reply, payload):
+        """Saves the turn (reply=None for blocked replies); returns the body with the intent fields."""
+        return remember_turn(self.conversation, self.message, reply, dict(payload, **intent_fields(self.intent)))
+
+    def _keep(self, reply_text):
+        if CHAT_CACHE_ENABLED and not self.follow_up:
+            chat_cache.put(self.cache_query, reply_text, self.coords)
+
+    def instant_body(self, **fields):
+        """Body (or stream 'done' frame fields) for a reply that needed no model call."""
+        reply, extra = self.instant
+        return self._finish(reply, dict(extra, **fields))
+
+    def reply_body(self, response):
+        """/api/chat body for the model's response."""
+        if not response.parts:
+            log('response_blocked', level='warning', feedback=str(response.prompt_feedback))
+            return self._finish(None, {'response': SAFETY_BLOCK_MESSAGE})
+        self._keep(response.text)
+        return self._finish(response.text, {'response': response.text})
+
+    def stream_end(self, response, parts, start_time, first_chunk_ms):
+        """
+        Closing SSE frames once a model stream is fully read: the safety message
+        if nothing came back, then 'done' with the finish reason, timings and usage.
+        """
+        frames = []
+        if parts:
+            self._keep(''.join(parts))
+        else:
+            log('response_blocked', level='warning', feedback=str(response.prompt_feedback))
+            frames.append(sse_event({'text': SAFETY_BLOCK_MESSAGE}))
+        elapsed = time.perf_counter() - start_time
+        gemini.record_usage('stream', response, elapsed)
+        observe_stage('upstream', elapsed)
+        finish_reason = response.candidates[0].finish_reason.name if response.candidates else None
+        usage = getattr(response, 'usage_metadata', None)
+        frames.append(sse_event(self._finish(''.join(parts) or None, {
+            'finish_reason': finish_reason,
+            'chunks': len(parts),
+            'first_chunk_ms': first_chunk_ms,
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'prompt_tokens': getattr(usage, 'prompt_token_count', None),
+            'output_tokens': getattr(usage, 'candidates_token_count', None),
+        }), event='done'))
+        return frames
+
+@api.route('/api/chat', methods=['POST'])
+@admitted('chat')
 def chat():
     try:
         data = request.json
@@ -70,51 +471,237 @@ def chat():
         if not user_message:
             return jsonify({'error': 'Message is required'}), 400
 
-        print(f"DEBUG: Received message: {user_message}")
+        log('chat_message', message=redact(user_message), conversation='conversation_id' in data)
 
-        # Debug: Print received message
-        print(f"DEBUG: Received message: {user_message}")
-
-        # Smart Location Handling: Extract coordinates and force context
-        import re
-        # matches "(Current Location: 17.44, 78.34)" OR "near 17.44, 78.34"
-        coord_match = re.search(r'(?:Current Location:|near)\s*([\d.-]+),\s*([\d.-]+)', user_message, re.IGNORECASE)
-        
-        final_prompt = user_message
-        if coord_match:
-            lat, long = coord_match.groups()
-            print(f"DEBUG: Detected Coordinates - Lat: {lat}, Long: {long}")
-            
-            # Create a strong context prefix
-            location_context = (
-                f"SYSTEM QUERY CONTEXT: The user is currently located at Latitude {lat}, Longitude {long}. "
-                f"You MUST provide results specifically near these coordinates. "
-                f"Do not ask for location again. Assume this is the user's precise location.\n\n"
-            )
-            final_prompt = location_context + user_message
+        turn = ChatTurn(data)
+        if turn.instant is not None:
+            return jsonify(turn.instant_body(response=turn.instant[0]))
 
         # Generate content
-        response = model.generate_content(final_prompt)
-        
-        # Check if response has content (might be blocked by safety settings)
-        if response.parts:
-            reply_text = response.text
+        if chat_dispatcher is not None and turn.dispatch_key is not None:
+            response = chat_dispatcher.submit(turn.dispatch_key, turn.prompt, CHAT_DEADLINE)
         else:
-            # Handle safety block or empty response
-            print("Response blocked or empty:", response.prompt_feedback)
-            reply_text = "I apologize, but I cannot answer that query due to safety or policy restrictions. Please try rephrasing."
-
-        return jsonify({
-            'response': reply_text
-        })
+            response = gemini.generate(turn.contents, policy='chat')
+        return jsonify(turn.reply_body(response))
 
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"FULL ERROR: {e}")
+        log_exception('chat_failed', e)
         return jsonify({'error': 'An error occurred', 'details': str(e)}), 500
 
-@app.route('/api/report-issue', methods=['POST'])
+def _cancel_stream(response):
+    """Best-effort cancel of the upstream gRPC stream so Gemini stops generating."""
+    cancel = getattr(getattr(response, '_iterator', None), 'cancel', None)
+    if callable(cancel):
+        try:
+            cancel()
+        except Exception:
+            pass
+
+def stream_error(error):
+    """The 'error' frame for a chat stream that failed before its 'done' frame."""
+    if isinstance(error, UpstreamUnavailable):
+        return sse_event({'error': UPSTREAM_UNAVAILABLE_MESSAGE, 'details': str(error),
+                          'retry_after': error.retry_after}, event='error')
+    log_exception('stream_failed', error)
+    return sse_event({'error': 'An error occurred', 'details': str(error)}, event='error')
+
+@api.route('/api/chat/stream', methods=['GET', 'POST'])
+@admitted('stream')
+def chat_stream():
+    """
+    Streaming variant of /api/chat. Emits the reply as Server-Sent Events:
+      data: {"text": "..."}            one frame per model chunk
+      event: done / data: {...}        final metadata frame
+      event: error / data: {...}       if generation fails mid-stream
+    GET (?message=...) is accepted so the browser EventSource API can be used.
+    """
+    data = request.args if request.method == 'GET' else (request.get_json(silent=True) or {})
+    user_message = data.get('message', '')
+
+    if not user_message:
+        return jsonify({'error': 'Message is required'}), 400
+
+    turn = ChatTurn(data)
+
+    def generate():
+        start_time = time.perf_counter()
+        first_chunk_ms = None
+        parts = []
+        response = None
+        finished = False
+        # Comment frame: pushes the headers out before the model answers
+        yield ": stream-open\n\n"
+        if turn.instant is not None:
+            yield sse_event({'text': turn.instant[0]})
+            yield sse_event(turn.instant_body(
+                chunks=1, elapsed_ms=round((time.perf_counter() - start_time) * 1000, 1)), event='done')
+            return
+        try:
+            response = gemini.generate(turn.contents, policy='stream', stream=True)
+            for chunk in response:
+                if not chunk.parts:
+                    continue
+                if first_chunk_ms is None:
+                    first_chunk_ms = round((time.perf_counter() - start_time) * 1000, 1)
+                parts.append(chunk.text)
+                yield sse_event({'text': chunk.text})
+            finished = True
+            yield from turn.stream_end(response, parts, start_time, first_chunk_ms)
+        except GeneratorExit:
+            # Client went away: stop paying for tokens nobody will read
+            log('stream_cancelled')
+            raise
+        except Exception as e:
+            finished = True
+            yield stream_error(e)
+        finally:
+            if response is not None and not finished:
+                _cancel_stream(response)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx / Render's proxy from buffering the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+@api.route('/api/chat/conversations/<conversation_id>', methods=['DELETE'])
+def end_conversation(conversation_id):
+    conversations.delete(conversation_id)
+    return jsonify({'deleted': conversation_id})
+
+@api.route('/api/chat/conversation-stats', methods=['GET'])
+def chat_conversation_stats():
+    return jsonify(dict(conversations.stats(), enabled=CONVERSATIONS))
+
+@api.route('/api/chat/cache-stats', methods=['GET'])
+def chat_cache_stats():
+    return jsonify(chat_cache.stats())
+
+@api.route('/api/chat/civic-stats', methods=['GET'])
+def chat_civic_stats():
+    return jsonify(dict(civic_index.stats(), direct=CIVIC_DIRECT, context=CIVIC_CONTEXT))
+
+@api.route('/api/chat/intent-stats', methods=['GET'])
+def chat_intent_stats():
+    return jsonify(dict(intent_stats.snapshot(), enabled=INTENT_FILTER))
+
+@api.route('/api/chat/dispatch-stats', methods=['GET'])
+def chat_dispatch_stats():
+    if chat_dispatcher is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(chat_dispatcher.stats.snapshot(), enabled=True, window_ms=CHAT_BATCH_WINDOW_MS))
+
+@api.route('/api/upload-cache-stats', methods=['GET'])
+def upload_cache_stats():
+    return jsonify(dict(uploads.stats(), preprocess=pipeline_stats()))
+
+@api.route('/api/upstream-stats', methods=['GET'])
+def upstream_stats():
+    return jsonify(dict(gemini.stats(), structured_output=structured_stats()))
+
+@api.route('/api/token-usage', methods=['GET'])
+def token_usage():
+    cache_stats = gemini.model_factory.stats if isinstance(gemini.model_factory, CachedContentModels) else None
+    return jsonify({'endpoints': token_meter.snapshot(), 'context_cache': cache_stats})
+
+def collect_metrics(emit):
+    """Scrape-time samples from the same stats the /api/*-stats routes serve."""
+    for policy, counts in gemini.stats()['policies'].items():
+        for field in ('calls', 'successes', 'attempts', 'retries', 'timeouts', 'fallbacks', 'unavailable', 'errors'):
+            emit(f'citiassist_upstream_{field}_total', counts[field], {'policy': policy}, 'counter')
+        for error, count in counts['error_classes'].items():
+            emit('citiassist_upstream_errors_by_class_total', count, {'policy': policy, 'error': error}, 'counter',
+                 'Upstream exceptions by class, including retried ones.')
+    for endpoint, usage in token_meter.snapshot().items():
+        for kind in ('prompt', 'cached', 'output'):
+            emit('citiassist_tokens_total', usage[f'{kind}_tokens'], {'endpoint': endpoint, 'kind': kind}, 'counter',
+                 'Gemini tokens by endpoint and kind.')
+
+    cache = chat_cache.stats()
+    templates = form_templates.stats()
+    lookups = [('chat', outcome, cache[outcome]) for outcome in ('hits', 'near_hits', 'misses')]
+    lookups += [('form_template', outcome, templates[outcome]) for outcome in ('hits', 'misses')]
+    upload_stats = uploads.stats()
+    for kind in ('variant', 'result'):
+        lookups += [(f'upload_{kind}', outcome, upload_stats[f'{kind}_{outcome}']) for outcome in ('hits', 'misses')]
+    for name, outcome, count in lookups:
+        emit('citiassist_cache_lookups_total', count, {'cache': name, 'outcome': outcome}, 'counter',
+             'Response and template cache lookups by outcome.')
+    emit('citiassist_cache_entries', cache['entries'], {'cache': 'chat'}, help_text='Entries held per cache.')
+    emit('citiassist_cache_entries', templates['templates'], {'cache': 'form_template'})
+    emit('citiassist_cache_entries', upload_stats['memory']['entries'], {'cache': 'upload_memory'})
+    emit('citiassist_cache_bytes', upload_stats['memory']['bytes'], {'cache': 'upload_memory'},
+         help_text='Bytes held per upload store tier.')
+    if upload_stats['disk'] is not None:
+        emit('citiassist_cache_entries', upload_stats['disk']['entries'], {'cache': 'upload_disk'})
+        emit('citiassist_cache_bytes', upload_stats['disk']['bytes'], {'cache': 'upload_disk'})
+    preprocess = pipeline_stats()
+    emit('citiassist_preprocess_images_total', preprocess['images'], kind='counter',
+         help_text='Uploaded images preprocessed before the Gemini call.')
+    emit('citiassist_preprocess_passthrough_total', preprocess['passthrough'], kind='counter',
+         help_text='Photos already small and upright enough to send as uploaded.')
+    for direction in ('in', 'out'):
+        emit('citiassist_preprocess_bytes_total', preprocess[f'bytes_{direction}'], {'direction': direction}, 'counter',
+             'Image bytes before and after preprocessing.')
+    emit('citiassist_preprocess_seconds_total', preprocess['seconds'], kind='counter',
+         help_text='Time spent preprocessing images.')
+    civic = civic_index.stats()
+    for outcome in ('direct_facts', 'direct_nearby', 'context', 'no_match'):
+        emit('citiassist_civic_lookups_total', civic[outcome], {'outcome': outcome}, 'counter',
+             'Civic index lookups by outcome.')
+    for label, count in intent_stats.snapshot()['by_intent'].items():
+        emit('citiassist_intent_total', count, {'intent': label}, 'counter', 'Chat messages by pre-classified intent.')
+
+    queue = jobs.stats()
+    for outcome in ('submitted', 'replayed', 'conflicts', 'rejected', 'done', 'failed', 'lost'):
+        emit('citiassist_jobs_total', queue[outcome], {'outcome': outcome}, 'counter',
+             'Background jobs by outcome.')
+    for state in ('queued', 'running'):
+        emit('citiassist_jobs_active', queue[state], {'state': state}, help_text='Jobs queued or running here.')
+
+    for name, store in (('form', form_sessions), ('conversation', conversations.store), ('job', jobs.store)):
+        stats = store.stats()
+        emit('citiassist_session_entries', stats['entries'], {'store': name},
+             help_text='Sessions held per store (NaN when the backend cannot tell).')
+        emit('citiassist_session_bytes', stats['bytes'], {'store': name}, help_text='Bytes held per session store.')
+        for event in ('hits', 'misses', 'expired', 'evictions'):
+            emit('citiassist_session_events_total', stats[event], {'store': name, 'event': event}, 'counter',
+                 'Session store reads and removals.')
+
+    admission_stats = admission.stats()
+    emit('citiassist_admission_tokens_available', admission_stats['tokens_available'],
+         help_text='Token bucket level of the shared Gemini quota.')
+    for endpoint, counts in admission_stats['endpoints'].items():
+        emit('citiassist_admission_in_flight', counts['in_flight'], {'endpoint': endpoint},
+             help_text='Admitted requests still running.')
+        emit('citiassist_admission_rejected_total', counts['rejected'], {'endpoint': endpoint}, 'counter',
+             'Requests turned away by admission control.')
+
+metrics.add_collector(collect_metrics)
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/debug/profiler', methods=['GET', 'POST'])
+def debug_profiler():
+    """Sampling profiler control, hidden unless PROFILER_TOKEN is set and sent as X-Profiler-Token."""
+    if not profiler_authorized(request.headers):
+        return jsonify({'error': 'Not found'}), 404
+    if request.method == 'POST':
+        return jsonify(profiler_command(request.get_json(silent=True) or {}))
+    if request.args.get('format') == 'collapsed':
+        return Response(profiler.collapsed(), mimetype='text/plain')
+    return jsonify(profiler.status())
+
+@api.route('/api/admission-stats', methods=['GET'])
+def admission_stats():
+    return jsonify(admission.stats())
+
+@api.route('/api/report-issue', methods=['POST'])
+@admitted('report')
 def report_issue():
     try:
         if 'image' not in request.files:
@@ -124,220 +711,532 @@ def report_issue():
         if file.filename == '':
             return jsonify({'error': 'No selected file'}), 400
 
-        # Read image
-        from PIL import Image
-        import io
+        # Read image and shrink it before upload
         image_bytes = file.read()
-        image = Image.open(io.BytesIO(image_bytes))
+        digest, stored = stored_answer(image_bytes, 'report', REPORT_VERSION)
+        if stored is not None:
+            return jsonify(dict(stored, cached=True))
+        prepared = prepare_upload(image_bytes, "photo", digest)
+        return jsonify(report_reply(digest, gemini.generate(**report_call(prepared))))
 
-        prompt = """
-        Analyze this image for civic issues (e.g., potholes, garbage, broken streetlights, traffic violations, parking issues). 
-        
-        RETURN A JSON OBJECT ONLY. NO MARKDOWN FORMATTING.
-        The JSON key 'response' should be in Markdown format for display.
-        
-        Result Format:
-        {
-            "recipient_email": "Official email of the relevant authority in Hyderabad (e.g., commissioner@ghmc.gov.in for GHMC, or Cyberabad Traffic Police email, etc.)",
-            "subject": "Formal subject line for the complaint - citing [Location]",
-            "body": "Formal complaint letter body. YOU MUST INCLUDE the exact text '[Location]' so the user can fill it in. Example: 'I observed a pothole at [Location]...'",
-            "response": "A polite summary to the user explaining the issue and that a draft is ready (Markdown supported)"
-        }
-        
-        If no civic issue is detected:
-        {
-            "recipient_email": "",
-            "subject": "",
-            "body": "",
-            "response": "No civic issue detected in this image."
-        }
-        """
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except Exception as e:
+        log_exception('report_failed', e)
+        return jsonify({'error': 'Image processing failed', 'details': str(e)}), 500
 
-        response = model.generate_content([prompt, image], generation_config={"response_mime_type": "application/json"})
-        
-        import json
+def batch_uploads(files):
+    """Non-empty uploads from repeated `images` (or `image`) form fields; Flask or Quart."""
+    return [upload for upload in files.getlist('images') + files.getlist('image') if upload.filename]
+
+def batch_cost(uploads_list):
+    return estimate_cost('batch', pages=len(uploads_list))
+
+def ndjson_line(payload):
+    return json.dumps(payload, ensure_ascii=False) + "\n"
+
+def read_batch(uploads_list):
+    """(filename, bytes) per upload. Read up front: the request's files are closed once the view returns."""
+    return [(upload.filename, upload.read()) for upload in uploads_list]
+
+def load_batch_photo(item):
+    """Preprocesses and fingerprints one batch upload."""
+    index, (filename, image_bytes) = item
+    digest = upload_digest(image_bytes)
+    prepared = prepare_upload(image_bytes, "photo", digest)
+    return BatchPhoto(index, filename, digest, prepared, image_fingerprint(prepared.image),
+                      gps_coordinates(image_bytes))
+
+def report_cluster(cluster):
+    """(complaint, cached) for a cluster of near-duplicates: one model call on its first photo at most."""
+    lead = cluster[0]
+    stored = uploads.result(lead.digest, 'report', REPORT_VERSION)
+    if stored is not None:
+        return stored, True
+    return report_reply(lead.digest, gemini.generate(**report_call(lead.prepared))), False
+
+def batch_report_lines(uploaded):
+    """
+    NDJSON body of /api/report-issue/batch. Every photo is preprocessed and
+    fingerprinted first (bounded pool), near-duplicates are clustered, then each
+    cluster's report is drafted (same pool) and its photos are sent as soon as
+    it finishes, with their own [Location]. Ends with a summary line.
+    """
+    start_time = time.perf_counter()
+    photos = []
+    counts = {'unreadable': 0, 'model_calls': 0, 'cached': 0, 'failed': 0}
+    for (index, (filename, _)), photo, error in run_bounded(load_batch_photo, enumerate(uploaded)):
+        if error is not None:
+            counts['unreadable'] += 1
+            log('batch_photo_unreadable', level='warning', index=index, error=f"{type(error).__name__}: {error}")
+            yield ndjson_line({'index': index, 'filename': filename, 'error': 'Could not read image'})
+            continue
+        photos.append(photo)
+
+    clusters = cluster_photos(photos)
+    for (cluster_index, cluster), result, error in run_bounded(lambda item: report_cluster(item[1]),
+                                                               enumerate(clusters)):
+        if error is not None:
+            counts['failed'] += 1
+            if not isinstance(error, UpstreamUnavailable):
+                log_exception('batch_report_failed', error)
+        else:
+            counts['cached' if result[1] else 'model_calls'] += 1
+        for photo in cluster:
+            line = {'index': photo.index, 'filename': photo.filename, 'cluster': cluster_index,
+                    'duplicate_of': None if photo is cluster[0] else cluster[0].index}
+            coords = cluster_location(photo, cluster)
+            area = civic_index.area_name(coords) if coords else None
+            if coords:
+                line['location'] = {'lat': coords[0], 'long': coords[1], 'area': area}
+            if isinstance(error, UpstreamUnavailable):
+                line.update(error=UPSTREAM_UNAVAILABLE_MESSAGE, retry_after=error.retry_after)
+            elif error is not None:
+                line.update(error='Image processing failed', details=str(error))
+            else:
+                complaint, cached = result
+                line.update(fill_location(complaint, location_label(coords, area)) if coords else complaint)
+                line['cached'] = cached
+            yield ndjson_line(line)
+
+    yield ndjson_line(dict(counts, done=True, images=len(uploaded), clusters=len(clusters),
+                           elapsed_ms=round((time.perf_counter() - start_time) * 1000, 1)))
+
+@api.route('/api/report-issue/batch', methods=['POST'])
+@admitted('batch')
+def report_issue_batch():
+    """
+    Drafts complaints for many photos (repeated `images` fields) in one request.
+    Streams NDJSON, one object per photo in completion order, then a summary:
+      {"index": 0, "filename": "...", "cluster": 0, "duplicate_of": null,
+       "location": {"lat": ..., "long": ..., "area": "..."}, "cached": false, "subject": "...", ...}
+      {"done": true, "images": 12, "clusters": 5, "model_calls": 5, ...}
+    Near-duplicate photos share their cluster's model call (duplicate_of is the photo that was sent).
+    """
+    files = batch_uploads(request.files)
+    if not files:
+        return jsonify({'error': 'No image uploaded'}), 400
+    if len(files) > BATCH_MAX_IMAGES:
+        return jsonify({'error': f'At most {BATCH_MAX_IMAGES} images per batch'}), 413
+
+    lines = batch_report_lines(read_batch(files))
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+# Async mode for the slow upload endpoints: 202 + job ID, result from /api/jobs/<id> (job_queue.py)
+jobs = JobQueue(create_session_store("job", JOB_RESULT_TTL))
+JOB_ENDPOINTS = ('analyze', 'form')
+
+def wants_job(req):
+    """?async=1 or `Prefer: respond-async` (RFC 7240) asks for a job instead of waiting (Flask or Quart)."""
+    return JOBS_ENABLED and (req.args.get('async') == '1' or 'respond-async' in req.headers.get('Prefer', ''))
+
+def job_accepted(job, replayed):
+    """202 pointing at the job's status URL."""
+    status_url = f"/api/jobs/{job.id}"
+    body = dict(job.public(), status_url=status_url, events_url=f"{status_url}/events")
+    headers = {'Location': status_url, 'Retry-After': '1'}
+    if replayed:
+        headers['Idempotent-Replayed'] = 'true'
+    return body, 202, headers
+
+def job_rejected(error):
+    """Flask or Quart return value for a job that could not be queued."""
+    if isinstance(error, IdempotencyConflict):
+        return {'error': str(error)}, 422
+    return {'error': UPSTREAM_UNAVAILABLE_MESSAGE, 'details': str(error), 'retry_after': error.retry_after}, \
+        503, {'Retry-After': str(error.retry_after)}
+
+def job_work(endpoint, work, client, cost):
+    """
+    `work` as run by a job worker: admitted like a request to `endpoint` when the worker
+    starts it, so queued jobs hold no endpoint slot. Busy periods are waited out until JOB_TIMEOUT.
+    """
+    def run(*args):
+        deadline = time.monotonic() + jobs.timeout
+        while True:
+            try:
+                ticket = admission.acquire(endpoint, client, cost)
+                break
+            except AdmissionRejected as e:
+                if time.monotonic() + e.retry_after >= deadline:
+                    return too_many_requests(e)
+                time.sleep(e.retry_after)
         try:
-            # Clean up potential markdown code blocks if the model ignores the instruction (though mime_type helps)
-            text_response = response.text.replace('```json', '').replace('```', '').strip()
-            response_json = json.loads(text_response)
-        except json.JSONDecodeError:
-            print("Failed to decode JSON from model")
-            response_json = {
-                "recipient_email": "",
-                "subject": "Civic Issue Report", 
-                "body": response.text,
-                "response": response.text
-            }
-
-        return jsonify(response_json)
+            return work(*args)
+        finally:
+            admission.release(ticket)
+    return run
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': 'Image processing failed', 'details': str(e)}), 500
+def queue_job(endpoint, work, image_bytes, client, idempotency_key=None):
+    """Queues `work(image_bytes)` as a job; returns the 202 (or rejection) for either app."""
+    try:
+        job, replayed = jobs.submit(endpoint, job_work(endpoint, work, client, bytes_cost(endpoint, image_bytes)),
+                                    image_bytes, client=client, idempotency_key=idempotency_key,
+                                    upload_hash=fingerprint(image_bytes))
+    except (IdempotencyConflict, QueueFull) as e:
+        return job_rejected(e)
+    return job_accepted(job, replayed)
 
-@app.route('/api/analyze-document', methods=['POST'])
-def analyze_document():
+def submit_job(endpoint, work, image_bytes):
+    return queue_job(endpoint, work, image_bytes, client_id(request), request.headers.get('Idempotency-Key'))
+
+def job_wait_seconds(req):
     try:
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image uploaded'}), 400
-            
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
+        return min(max(float(req.args.get('wait', 0)), 0.0), JOB_MAX_WAIT)
+    except ValueError:
+        return 0.0
 
-        # Read image
-        from PIL import Image
-        import io
-        image_bytes = file.read()
-        image = Image.open(io.BytesIO(image_bytes))
-
-        prompt = """
-        Analyze this government form or official document. 
-        1. Identify exactly what this document is.
-        2. Provide a comprehensive, step-by-step guide on how to fill it out.
-        3. Explain any complex legal terms or requirements in simple, easy-to-understand language.
-        4. If it contains instructions, summarize them clearly.
-        5. Output the response in Markdown format.
-        6. If this does not look like a form or official document, please state that.
-        """
+@api.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Job state, plus `status_code` and `result` once finished. ?wait=N long-polls up to N seconds."""
+    job = jobs.wait(job_id, job_wait_seconds(request))
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job.public())
 
-        response = model.generate_content([prompt, image])
-        
-        reply_text = response.text if response.parts else "Could not analyze document due to safety settings."
+@api.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Server-Sent Events for one job:
+      event: status / data: {...}      whenever the job moves (queued, running)
+      event: done / data: {...}        final frame with the result (also for failed jobs)
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+
+    def generate(job):
+        yield ": stream-open\n\n"
+        last_status = None
+        # Ends at the latest after JOB_QUEUE_TIMEOUT + JOB_TIMEOUT, when jobs.get() reports the job as failed
+        while job is not None and not job.is_finished:
+            if job.status != last_status:
+                last_status = job.status
+                yield sse_event(job.public(), event='status')
+            else:
+                yield ": keep-alive\n\n"
+            job = jobs.wait(job_id, 15, last_status)
+        if job is None:
+            yield sse_event({'error': 'Job not found or expired'}, event='error')
+        else:
+            yield sse_event(job.public(), event='done')
+
+    return Response(stream_with_context(generate(job)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@api.route('/api/job-stats', methods=['GET'])
+def job_stats():
+    return jsonify(dict(jobs.stats(), enabled=JOBS_ENABLED))
+
+def analyze_pdf(pdf_bytes):
+    """Analyzes every page of a PDF concurrently and merges the guides in page order."""
+    def analyze_page(index, prepared):
+        response = gemini.generate(**analyze_call(prepared))
+        return response.text if response.parts else DOCUMENT_BLOCK_MESSAGE
 
-        return jsonify({'response': reply_text})
+    coverage = page_coverage(pdf_bytes)
+    pages = map_pages(pdf_bytes, analyze_page)
+    if len(pages) == 1:
+        reply_text = pages[0]
+    else:
+        reply_text = "\n\n---\n\n".join(f"## Page {index + 1}\n\n{text}" for index, text in enumerate(pages))
+    if coverage['truncated']:
+        log('pdf_truncated', level='warning', endpoint='analyze', **coverage)
+        reply_text += (f"\n\n---\n\n_Only the first {coverage['max_pages']} of {coverage['page_count']} pages "
+                       f"were read. Upload the remaining pages separately._")
+    return dict(coverage, response=reply_text, pages=len(pages))
 
+def analyze_pdf_response(digest, pdf_bytes):
+    """The analyze-document body for a PDF; stored unless a page was blocked."""
+    result = analyze_pdf(pdf_bytes)
+    if DOCUMENT_BLOCK_MESSAGE not in result['response']:
+        uploads.put_result(digest, 'analyze', ANALYZE_VERSION, result)
+    return result
+
+def analyze_response(image_bytes):
+    """The /api/analyze-document body (or error tuple) for one upload; also run as a background job."""
+    try:
+        digest, stored = stored_answer(image_bytes, 'analyze', ANALYZE_VERSION)
+        if stored is not None:
+            return dict(stored, cached=True)
+
+        if is_pdf(image_bytes):
+            return analyze_pdf_response(digest, image_bytes)
+
+        # Read image and shrink it before upload
+        prepared = prepare_upload(image_bytes, "document", digest)
+        return analyze_reply(digest, gemini.generate(**analyze_call(prepared)))
+
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': 'Document analysis failed', 'details': str(e)}), 500
+        log_exception('analyze_failed', e)
+        return {'error': 'Document analysis failed', 'details': str(e)}, 500
 
-# Global dictionary to temporarily hold form images in memory for the wizard session
-# In production, this should be Redis or an S3 bucket
-form_sessions = {}
-import uuid
+@api.route('/api/analyze-document', methods=['POST'])
+@admitted('analyze')
+def analyze_document():
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
 
-@app.route('/api/start-form-fill', methods=['POST'])
-def start_form_fill():
+    file = request.files['image']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    image_bytes = file.read()
+    if wants_job(request):
+        return submit_job('analyze', analyze_response, image_bytes)
+    return analyze_response(image_bytes)
+
+# Holds the original (compressed) upload bytes for each form wizard session.
+# Backend, TTL and memory ceiling come from SESSION_* env vars; use sqlite or redis
+# so /api/fill-form works whichever gunicorn worker it lands on.
+form_sessions = create_session_store("form")
+
+# Fingerprint -> extracted fields for forms we've already seen. The JSON file is
+# shared by all workers; set FORM_TEMPLATE_INDEX to an empty string to keep it in memory.
+form_templates = TemplateIndex(
+    path=os.getenv("FORM_TEMPLATE_INDEX", "form_templates.json") or None,
+    max_templates=int(os.getenv("FORM_TEMPLATE_MAX", "256")),
+)
+def form_fields_call(prepared, digest=None):
+    """
+    (known fields, None, None) for a form we've seen before (stored under the upload
+    `digest`), else (None, template fingerprint, gemini.generate arguments).
+    """
+    # Known form? Reuse its extracted fields instead of a layout extraction call
+    fields_data, fingerprint = form_templates.lookup(prepared.image)
+    if fields_data is not None:
+        if digest:
+            uploads.put_result(digest, 'form', FORM_VERSION, fields_data)
+        return fields_data, None, None
+    return None, fingerprint, dict(contents=[prepared.as_part(), FORM_FIELDS_PROMPT], policy='form', endpoint='form',
+                                   generation_config=FORM_FIELDS_CONFIG)
+
+def form_fields_reply(call, fingerprint, digest, response):
+    """Fields for a form_fields_call() reply; a complete list is kept as a template and under `digest`."""
+    fields_data, complete = finish_form_fields(response.text, call['contents'][0])
+    # Only a complete field list is worth reusing for the next upload of this form
+    if complete:
+        form_templates.add(fingerprint, fields_data)
+        if digest:
+            uploads.put_result(digest, 'form', FORM_VERSION, fields_data)
+    return fields_data
+
+def extract_form_fields(prepared, digest=None):
+    """Returns (fields, cached) for one preprocessed page; complete fields are stored under the upload `digest`."""
+    fields_data, fingerprint, call = form_fields_call(prepared, digest)
+    if call is None:
+        return fields_data, True
+    return form_fields_reply(call, fingerprint, digest, gemini.generate(**call)), False
+
+def extract_pdf_fields(pdf_bytes):
+    """
+    Extracts fields from every page of a PDF concurrently and merges them.
+    The page index is appended to box_2d ([ymin, xmin, ymax, xmax, page]) so
+    fill-form knows where to draw; repeated field names get a page suffix.
+    Returns (fields, cached, page_coverage).
+    """
+    coverage = page_coverage(pdf_bytes)
+    if coverage['truncated']:
+        log('pdf_truncated', level='warning', endpoint='form', **coverage)
+    pages = map_pages(pdf_bytes, lambda index, prepared: extract_form_fields(prepared))
+
+    merged, seen = [], set()
+    for page_index, (fields, _) in enumerate(pages):
+        for field in fields:
+            field = dict(field, box_2d=list(field.get('box_2d', []))[:4] + [page_index])
+            if field.get('field_name') in seen:
+                field['field_name'] = f"{field['field_name']}_p{page_index + 1}"
+            seen.add(field.get('field_name'))
+            merged.append(field)
+    return merged, all(cached for _, cached in pages), coverage
+
+def open_form_session(image_bytes):
+    """Saves the original bytes (fill-form draws on the full-resolution image); returns the session id."""
+    session_id = str(uuid.uuid4())
+    form_sessions.put(session_id, image_bytes)
+    return session_id
+
+def form_fill_body(session_id, fields_data, cached, coverage=None):
+    result = dict(coverage or {}, session_id=session_id, fields=fields_data)
+    if cached:
+        result['cached'] = True
+    return result
+
+def form_fill_response(image_bytes):
+    """The /api/start-form-fill body (or error tuple) for one upload; also run as a background job."""
     try:
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image uploaded'}), 400
-            
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
+        session_id = open_form_session(image_bytes)
+        digest, fields_data = stored_answer(image_bytes, 'form', FORM_VERSION)
+        cached = fields_data is not None
+        coverage = {}
+        if fields_data is None and is_pdf(image_bytes):
+            fields_data, cached, coverage = extract_pdf_fields(image_bytes)
+        elif fields_data is None:
+            fields_data, cached = extract_form_fields(prepare_upload(image_bytes, "document", digest), digest)
+        return form_fill_body(session_id, fields_data, cached, coverage)
 
-        image_bytes = file.read()
-        from PIL import Image
-        import io
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Save session
-        session_id = str(uuid.uuid4())
-        form_sessions[session_id] = image
-        
-        prompt = """
-        You are an expert document analysis AI working for the government of Telangana, dedicated to accessibility.
-        Look at this image of a blank document or form. 
-        Identify every visual BLANK LINE or BLANK BOX where a citizen is expected to write their information.
-        
-        CRITICAL ACCESSIBILITY INSTRUCTION:
-        Forms often use complex bureaucratic or legal terms (e.g., "Domicile", "Remittance", "Kin", "Spouse", "NOC"). 
-        You MUST simplify these tough fields so common, everyday people can easily understand them. Translate complex legalese into plain language.
-        
-        RETURN ONLY A VERY STRICT JSON ARRAY OF OBJECTS. Do not include markdown formatting or backticks.
-        Each object must contain EXACTLY:
-        1. "field_name": A short programmatic name (e.g. "applicant_name").
-        2. "question": A friendly, conversational question asking the citizen for this data in VERY SIMPLE terms (e.g. Instead of "What is your domicile?", ask "What city or town do you permanently live in?").
-        3. "box_2d": An array of four integers [ymin, xmin, ymax, xmax] representing the bounding box of the BLANK AREA. 
-           These coordinates MUST be normalized to a 1000x1000 scale. For example, [200, 100, 250, 400].
-           
-        Example Output:
-        [
-          {"field_name": "first_name", "question": "What is your first name?", "box_2d": [150, 200, 180, 500]}
-        ]
-        """
-        
-        # Using flash as it proved sufficient and faster in testing
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content([image, prompt])
-        
-        import json
-        clean_json = response.text.strip().removeprefix("```json").removesuffix("```").strip()
-        fields_data = json.loads(clean_json)
-        
-        return jsonify({
-            'session_id': session_id,
-            'fields': fields_data
-        })
-        
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        log_exception('form_extraction_failed', e)
+        return {'error': str(e)}, 500
+
+@api.route('/api/start-form-fill', methods=['POST'])
+@admitted('form')
+def start_form_fill():
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    image_bytes = file.read()
+    if wants_job(request):
+        return submit_job('form', form_fill_response, image_bytes)
+    return form_fill_response(image_bytes)
+
+def requested_output_format(req):
+    """
+    Binary output format for fill-form from ?format= or the Accept header
+    (jpeg, png or pdf); None means the default base64 JSON response.
+    Works with both Flask and Quart requests.
+    """
+    fmt = req.args.get('format', '').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt in OUTPUT_FORMATS:
+        return fmt
+    accept = req.accept_mimetypes
+    for name, mime_type in OUTPUT_FORMATS.items():
+        if accept.quality(mime_type) > accept.quality('application/json') and mime_type in accept.values():
+            return name
+    return None
+
+def binary_form_output(fmt):
+    """(mimetype, headers) for a binary fill-form response."""
+    extension = 'jpg' if fmt == 'jpeg' else fmt
+    return OUTPUT_FORMATS[fmt], {'Content-Disposition': f'inline; filename="filled_form.{extension}"'}
 
-@app.route('/api/fill-form', methods=['POST'])
+def binary_form_response(data, fmt):
+    mimetype, headers = binary_form_output(fmt)
+    return Response(data, mimetype=mimetype, headers=headers)
+
+@api.route('/api/fill-form', methods=['POST'])
 def fill_form():
     try:
         data = request.json
         session_id = data.get('session_id')
         answers = data.get('answers', {}) # Dict of {field_name: {"answer": "value", "box_2d": [...]}}
         
-        if session_id not in form_sessions:
+        image_bytes = form_sessions.get(session_id) if session_id else None
+        if image_bytes is None:
             return jsonify({'error': 'Session expired or invalid'}), 400
             
-        image = form_sessions[session_id].copy()
-        
-        from PIL import ImageDraw, ImageFont
-        import base64
-        import io
-        draw = ImageDraw.Draw(image)
-        
-        width, height = image.size
-        
-        # Try to load a standard font
-        try:
-            # You might need to adjust the font size depending on the image resolution
-            font = ImageFont.truetype("arial.ttf", 24)
-        except IOError:
-            font = ImageFont.load_default()
-
-        # Iterate over the answers and draw them
-        for field_name, field_data in answers.items():
-            text_value = str(field_data.get('answer', ''))
-            box_normalized = field_data.get('box_2d', [0, 0, 0, 0])
-            if len(box_normalized) == 4 and text_value:
-                ymin, xmin, ymax, xmax = box_normalized
-                
-                # Convert from 1000x1000 normalized scale back to actual image pixels
-                actual_x = int((xmin / 1000.0) * width)
-                
-                # We want to place the text slightly above the bottom line (ymax)
-                # or aligned exactly with ymin. Let's align it with ymin + a tiny buffer
-                actual_y = int((ymin / 1000.0) * height)
-                
-                # Draw the text in black
-                draw.text((actual_x + 5, actual_y + 2), text_value, fill=(0, 0, 150), font=font) # Dark blue ink
-                
-        # Convert the modified PIL image to a base64 string
-        buffered = io.BytesIO()
-        # Ensure image is in a saveable mode
-        if image.mode in ("RGBA", "P"):
-            image = image.convert("RGB")
-        image.save(buffered, format="JPEG", quality=85)
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        # ?format=png|jpeg|pdf (or a matching Accept header) returns raw bytes,
+        # avoiding the ~33% base64 overhead of the JSON response
+        fmt = requested_output_format(request)
+
+        if is_pdf(image_bytes):
+            with span('encode'):
+                pdf_bytes, first_page = render_filled_pdf(image_bytes, answers)
+            if fmt == 'pdf':
+                return binary_form_response(pdf_bytes, fmt)
+            if fmt:
+                # Image formats get a JPEG preview of the first page
+                return binary_form_response(first_page, 'jpeg')
+            return jsonify({
+                'filled_pdf_base64': f"data:application/pdf;base64,{base64.b64encode(pdf_bytes).decode()}",
+                # First page preview keeps image-only clients working
+                'filled_image_base64': f"data:image/jpeg;base64,{base64.b64encode(first_page).decode()}"
+            })
+
+        with span('encode'):
+            if fmt:
+                return binary_form_response(render_filled_form(image_bytes, answers, fmt), fmt)
+            img_str = base64.b64encode(render_filled_form(image_bytes, answers)).decode()
         
         return jsonify({
             'filled_image_base64': f"data:image/jpeg;base64,{img_str}"
         })
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log_exception('fill_form_failed', e)
         return jsonify({'error': str(e)}), 500
 
+# --- lifecycle: warm-up, readiness and drain ---
+
+ready = threading.Event()  # Set once warm_up() has run in this process
+draining = threading.Event()  # Set on SIGTERM; /readyz fails so the proxy stops routing here
+_warm_up_lock = threading.Lock()
+_warm_up_pid = None
+
+def warm_up():
+    """Imports the Gemini SDK and builds the chat model, so the first chat request doesn't pay for it."""
+    start = time.perf_counter()
+    try:
+        gemini.warm_up()
+    except Exception as e:
+        log_exception('warm_up_failed', e)
+        return
+    ready.set()
+    log('warm_up', duration_ms=round((time.perf_counter() - start) * 1000, 1))
+
+def start_warm_up():
+    """Runs warm_up() in the background, once per process (forked workers start their own)."""
+    global _warm_up_pid
+    with _warm_up_lock:
+        if ready.is_set() or _warm_up_pid == os.getpid():
+            return
+        _warm_up_pid = os.getpid()
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+def begin_drain():
+    if not draining.is_set():
+        draining.set()
+        log('drain_started', in_flight={endpoint: counts['in_flight']
+                                        for endpoint, counts in admission.stats()['endpoints'].items()})
+
+@api.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return jsonify({'status': 'ok'})
+
+@api.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: warmed up, not draining and the session stores answer."""
+    start_warm_up()
+    checks = {'warm': ready.is_set(), 'draining': draining.is_set(),
+              'session_store': form_sessions.ping() and conversations.store.ping() and jobs.store.ping(),
+              'gemini_api_key': bool(GENAI_API_KEY)}
+    ok = checks['warm'] and not checks['draining'] and checks['session_store']
+    return jsonify(dict(checks, ready=ok)), 200 if ok else 503
+
+def create_app():
+    """
+    Application factory used by gunicorn.conf.py ("main:create_app()").
+    Module state (the Gemini client, caches, session stores) is shared by
+    every app built here, so a preloaded master sets it up once for all workers.
+    """
+    app = Flask(__name__)
+    CORS(app)
+    app.before_request(start_request_context)
+    app.after_request(finish_request_context)
+    app.register_blueprint(api)
+    return app
+
+# For `gunicorn main:app`, the load test and the Quart mirror's imports
+app = create_app()
+
 if __name__ == '__main__':
-    # Render provides PORT env var. Default to 5000 for local dev.
+    # Local development only; production runs `gunicorn -c gunicorn.conf.py`
     port = int(os.environ.get("PORT", 5000))
-    app.run(debug=True, host='0.0.0.0', port=port)
+    start_warm_up()
+    app.run(debug=os.getenv("FLASK_DEBUG", "0") == "1", host='0.0.0.0', port=port, threaded=True)
@@ -1,8 +1,29 @@
+"""
+Accuracy evaluation for the CitiAssist chat assistant (LLM-as-a-Judge).
+
+Items from the golden dataset run concurrently on a bounded worker pool behind a
+shared requests-per-minute limiter that also backs off when Gemini returns 429/503.
+Finished items are appended to a checkpoint file, so an interrupted run resumes
+where it stopped, and judge verdicts are cached on (question, actual answer).
+
+Usage:
+    python measure_accuracy.py [--golden golden_dataset.jsonl] [--workers 4] [--rpm 60]
+    python measure_accuracy.py --fresh --report eval_report.json
+"""
+import argparse
+import hashlib
 import os
 import google.generativeai as genai
 from dotenv import load_dotenv
 import json
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from google.api_core import exceptions as api_exceptions
+
+from latency_stats import summarize
 
 # Load environment variables
 load_dotenv()
@@ -14,8 +35,24 @@ if not API_KEY:
 
 genai.configure(api_key=API_KEY)
 
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "4"))
+EVAL_RPM = float(os.getenv("EVAL_RPM", "60"))  # Shared by the app model and the judge
+EVAL_MAX_RETRIES = int(os.getenv("EVAL_MAX_RETRIES", "4"))
+GOLDEN_PATH = os.getenv("EVAL_GOLDEN_PATH", "golden_dataset.jsonl")
+CHECKPOINT_PATH = os.getenv("EVAL_CHECKPOINT_PATH", "eval_checkpoint.jsonl")
+JUDGE_CACHE_PATH = os.getenv("EVAL_JUDGE_CACHE_PATH", "eval_judge_cache.json")
+REPORT_PATH = os.getenv("EVAL_REPORT_PATH", "eval_report.json")
+
+RETRYABLE_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.InternalServerError,
+)
+
 # 1. THE GOLDEN DATASET
 # A set of (Input, Ideal Output) pairs that defines "correct" behavior.
+# Used when no JSONL file is found at EVAL_GOLDEN_PATH.
 GOLDEN_DATASET = [
     {
         "question": "What is the emergency number for police in Hyderabad?",
@@ -31,8 +68,136 @@ GOLDEN_DATASET = [
     }
 ]
 
+
+def item_id(item):
+    """Stable id for a golden item, used for checkpoints and duplicate detection."""
+    return item.get("id") or hashlib.sha256(
+        f"{item['question']}\n{item['ideal_answer']}".encode("utf-8")).hexdigest()[:16]
+
+
+def load_golden_dataset(path=GOLDEN_PATH):
+    """Reads one {"question", "ideal_answer"[, "id"]} object per line; blank and # lines are skipped."""
+    if not path or not os.path.exists(path):
+        return list(GOLDEN_DATASET)
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = json.loads(line)
+            if "question" not in item or "ideal_answer" not in item:
+                raise ValueError(f"{path}:{line_number}: needs 'question' and 'ideal_answer'")
+            items.append(item)
+    return items
+
+
 from main import SYSTEM_INSTRUCTION
 
+# Created once and shared by all workers
+app_model = genai.GenerativeModel("gemini-2.5-flash", system_instruction=SYSTEM_INSTRUCTION)
+judge_model = genai.GenerativeModel("gemini-2.5-flash")
+
+
+class RateLimiter:
+    """
+    Spaces calls to at most `rpm` per minute across all workers. When the API
+    pushes back, backoff() delays every worker, not only the one that got the 429.
+    """
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def backoff(self, seconds):
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+limiter = RateLimiter(EVAL_RPM)
+
+
+def call_with_retries(func, *args, **kwargs):
+    """Runs func behind the shared limiter, retrying rate-limit and transient errors with jittered backoff."""
+    for attempt in range(EVAL_MAX_RETRIES + 1):
+        limiter.wait()
+        try:
+            return func(*args, **kwargs)
+        except RETRYABLE_ERRORS:
+            if attempt == EVAL_MAX_RETRIES:
+                raise
+            limiter.backoff(min(60.0, 2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+class JudgeCache:
+    """Judge verdicts keyed on (question, actual answer), persisted as JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.verdicts = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.verdicts = json.load(f)
+
+    @staticmethod
+    def key(question, actual):
+        return hashlib.sha256(f"{question}\n{actual.strip()}".encode("utf-8")).hexdigest()
+
+    def get(self, question, actual):
+        with self.lock:
+            verdict = self.verdicts.get(self.key(question, actual))
+            if verdict is not None:
+                self.hits += 1
+            return verdict
+
+    def put(self, question, actual, verdict):
+        with self.lock:
+            self.verdicts[self.key(question, actual)] = verdict
+            if not self.path:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.verdicts, f)
+            os.replace(temp_path, self.path)
+
+
+class Checkpoint:
+    """Append-only JSONL of finished items; the last record for an id wins."""
+
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        if path and fresh and os.path.exists(path):
+            os.remove(path)
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line from an interrupted run
+                    self.done[record["id"]] = record
+
+    def record(self, result):
+        with self.lock:
+            self.done[result["id"]] = result
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
 # 2. THE SYSTEM UNDER TEST (Your App's Logic)
 def get_citiassist_response(user_query):
     """
@@ -40,8 +205,7 @@ def get_citiassist_response(user_query):
     In a real test, you might hit your running local API: requests.post('http://localhost:5000/api/chat', ...)
     """
     # Using the REAL production system instruction for accurate testing
-    model = genai.GenerativeModel("gemini-2.5-flash", system_instruction=SYSTEM_INSTRUCTION)
-    response = model.generate_content(user_query)
+    response = app_model.generate_content(user_query)
     return response.text
 
 # 3. THE EVALUATOR (LLM-as-a-Judge)
@@ -50,73 +214,143 @@ def evaluate_response(question, ideal, actual):
     Asks an LLM to judge if the 'actual' answer conveys the same meaning as the 'ideal' answer.
     Returns: Score (0.0 to 1.0) and Reasoning.
     """
-    judge_model = genai.GenerativeModel("gemini-2.5-flash")
-    
     prompt = f"""
     You are an AI evaluator. Compare the ACTUAL ANSWER with the IDEAL ANSWER for the given QUESTION.
-    
+
     QUESTION: {question}
     IDEAL ANSWER: {ideal}
     ACTUAL ANSWER: {actual}
-    
+
     Task:
     1. Determine if the ACTUAL ANSWER is semantically correct based on the IDEAL ANSWER.
     2. Ignore minor wording differences. Focus on the key facts.
     3. If the IDEAL ANSWER says "Data not available" (out of scope), the ACTUAL ANSWER must also refuse to answer.
-    
+
     Output JSON ONLY:
     {{
         "score": (1.0 for precise match, 0.5 for partial, 0.0 for wrong),
         "reasoning": "Brief explanation"
     }}
     """
-    
+
     try:
-        result = judge_model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+        result = call_with_retries(judge_model.generate_content, prompt,
+                                   generation_config={"response_mime_type": "application/json"})
         return json.loads(result.text)
     except Exception as e:
-        return {"score": 0.0, "reasoning": f"Evaluation failed: {str(e)}"}
+        return {"score": 0.0, "reasoning": f"Evaluation failed: {str(e)}", "failed": True}
 
-# 4. RUN THE METRIC CALCULATION
-def calculate_accuracy():
-    print(f"Running Accuracy Test on {len(GOLDEN_DATASET)} items...\n")
-    
-    total_score = 0
-    results = []
-
-    for item in GOLDEN_DATASET:
-        print(f"Testing: '{item['question']}'")
-        
-        # Get actual response
-        start_time = time.time()
-        actual_response = get_citiassist_response(item['question'])
-        latency = time.time() - start_time
-        
-        # Evaluate
+
+def evaluate_item(item, judge_cache):
+    """Runs one golden item end to end. Latency is the successful app call only, not retries or limiter waits."""
+    def timed_response(question):
+        start_time = time.perf_counter()
+        return get_citiassist_response(question), time.perf_counter() - start_time
+
+    actual_response, latency = call_with_retries(timed_response, item['question'])
+
+    eval_result = judge_cache.get(item['question'], actual_response)
+    judge_cached = eval_result is not None
+    if not judge_cached:
         eval_result = evaluate_response(item['question'], item['ideal_answer'], actual_response)
-        
-        score = eval_result['score']
-        total_score += score
-        
-        print(f"  -> Actual: {actual_response.strip()[:50]}...")
-        print(f"  -> Score: {score} ({eval_result['reasoning']})")
-        print(f"  -> Latency: {latency:.2f}s\n")
-        
-        results.append({
-            "q": item['question'],
-            "score": score,
-            "latency": latency
-        })
+        # Failed judgements are not cached so the next run asks again
+        if not eval_result.get("failed"):
+            judge_cache.put(item['question'], actual_response, eval_result)
+
+    return {
+        "id": item_id(item),
+        "q": item['question'],
+        "actual": actual_response,
+        "score": float(eval_result.get('score', 0.0)),
+        "reasoning": eval_result.get('reasoning', ''),
+        "latency": latency,
+        "judge_cached": judge_cached,
+    }
+
+
+# 4. RUN THE METRIC CALCULATION
+def calculate_accuracy(golden_path=GOLDEN_PATH, workers=EVAL_WORKERS, checkpoint_path=CHECKPOINT_PATH,
+                       judge_cache_path=JUDGE_CACHE_PATH, report_path=REPORT_PATH, fresh=False):
+    dataset = load_golden_dataset(golden_path)
+    checkpoint = Checkpoint(checkpoint_path, fresh=fresh)
+    judge_cache = JudgeCache(judge_cache_path)
+
+    ids = [item_id(item) for item in dataset]
+    pending = [item for item, key in zip(dataset, ids) if key not in checkpoint.done]
+    print(f"Running Accuracy Test on {len(dataset)} items "
+          f"({len(dataset) - len(pending)} from checkpoint, {len(pending)} to run, {workers} workers)...\n")
+
+    errors = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(evaluate_item, item, judge_cache): item for item in pending}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # Not checkpointed: the next run retries it
+                errors.append({"q": item['question'], "error": f"{type(e).__name__}: {e}"})
+                print(f"Failed: '{item['question']}' ({type(e).__name__})\n")
+                continue
+            checkpoint.record(result)
+            print(f"Testing: '{result['q']}'")
+            print(f"  -> Actual: {result['actual'].strip()[:50]}...")
+            print(f"  -> Score: {result['score']} ({result['reasoning']})")
+            print(f"  -> Latency: {result['latency']:.2f}s\n")
+    elapsed = time.perf_counter() - start
+
+    # Report in dataset order, only for items that are in this dataset
+    results = [checkpoint.done[key] for key in ids if key in checkpoint.done]
+    if not results:
+        print("No items were evaluated.")
+        return None
 
     # Final Metric
-    avg_accuracy = (total_score / len(GOLDEN_DATASET)) * 100
-    avg_latency = sum(r['latency'] for r in results) / len(results)
-    
+    avg_accuracy = sum(r['score'] for r in results) / len(results) * 100
+    latency = summarize([r['latency'] for r in results])
+
+    report = {
+        "items": len(dataset),
+        "evaluated": len(results),
+        "failed": len(errors),
+        "accuracy_pct": round(avg_accuracy, 2),
+        "full_marks": sum(1 for r in results if r['score'] >= 1.0),
+        "partial": sum(1 for r in results if 0.0 < r['score'] < 1.0),
+        "wrong": sum(1 for r in results if r['score'] <= 0.0),
+        "latency": latency,
+        "run_elapsed_s": round(elapsed, 2),
+        "workers": workers,
+        "judge_cache_hits": judge_cache.hits,
+        "results": [{key: r[key] for key in ("id", "q", "score", "reasoning", "latency")} for r in results],
+        "errors": errors,
+    }
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
     print("-" * 30)
     print(f"FINAL METRICS:")
-    print(f"Average Accuracy: {avg_accuracy:.1f}%")
-    print(f"Average Latency:  {avg_latency:.2f}s")
+    print(f"Average Accuracy: {avg_accuracy:.1f}% ({len(results)}/{len(dataset)} items)")
+    print(f"Average Latency:  {latency['mean_ms'] / 1000:.2f}s")
+    print(f"Latency p50/p95/p99: {latency['p50_ms']:.0f} / {latency['p95_ms']:.0f} / {latency['p99_ms']:.0f} ms")
+    if errors:
+        print(f"Failed items:     {len(errors)} (re-run to retry them)")
+    if report_path:
+        print(f"Report written to {report_path}")
     print("-" * 30)
+    return report
 
 if __name__ == "__main__":
-    calculate_accuracy()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--golden", default=GOLDEN_PATH, help="JSONL golden dataset")
+    parser.add_argument("--workers", type=int, default=EVAL_WORKERS)
+    parser.add_argument("--rpm", type=float, default=EVAL_RPM, help="max Gemini calls per minute, app + judge")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--judge-cache", default=JUDGE_CACHE_PATH)
+    parser.add_argument("--report", default=REPORT_PATH)
+    parser.add_argument("--fresh", action="store_true", help="ignore the checkpoint and start over")
+    args = parser.parse_args()
+
+    limiter = RateLimiter(args.rpm)
+    calculate_accuracy(args.golden, args.workers, args.checkpoint, args.judge_cache, args.report, args.fresh)
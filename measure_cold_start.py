@@ -0,0 +1,118 @@
+"""
+Cold-start benchmark for the production server.
+
+Launches the server as a subprocess and times, from process start:
+  - /healthz answering (the app is imported and listening),
+  - /readyz answering 200 (the Gemini SDK is imported and the models built),
+  - the first /api/chat answer, which is served by the offline civic index
+    (see civic_index.py) so no API key or network access is needed,
+then sends SIGTERM and times the graceful shutdown. Reports the median of
+several runs.
+
+Usage:
+    python measure_cold_start.py --server gunicorn --runs 5
+    python measure_cold_start.py --server asgi --json cold_start.json
+    python measure_cold_start.py --server flask   # `python main.py`, for comparison
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIRST_QUESTION = "What is the emergency number for police?"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(server):
+    if server == "flask":
+        return [sys.executable, "main.py"], {}
+    mode = "asgi" if server == "asgi" else "wsgi"
+    return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"], {"SERVER_MODE": mode}
+
+
+def request(url, body=None, timeout=2.0):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None
+
+
+def wait_for(url, start, deadline, expect=200):
+    while time.perf_counter() < deadline:
+        if request(url) == expect:
+            return round((time.perf_counter() - start) * 1000, 1)
+        time.sleep(0.02)
+    raise TimeoutError(f"{url} did not return {expect}")
+
+
+def measure_once(args):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    command, extra_env = server_command(args.server)
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(args.workers), LOG_FORMAT="text", **extra_env)
+    env.setdefault("GEMINI_API_KEY", "cold-start-benchmark")
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + args.timeout
+        result = {"healthz_ms": wait_for(f"{base_url}/healthz", start, deadline),
+                  "readyz_ms": wait_for(f"{base_url}/readyz", start, deadline)}
+        status = request(f"{base_url}/api/chat", {"message": FIRST_QUESTION}, timeout=args.timeout)
+        if status != 200:
+            raise RuntimeError(f"first /api/chat returned {status}")
+        result["first_chat_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        stop = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=args.timeout)
+        result["shutdown_ms"] = round((time.perf_counter() - stop) * 1000, 1)
+        return result
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=["gunicorn", "asgi", "flask"], default="gunicorn")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="WEB_CONCURRENCY for gunicorn (more than 1 needs SESSION_BACKEND=sqlite or redis)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    runs = [measure_once(args) for _ in range(args.runs)]
+    report = {"server": args.server, "runs": runs,
+              "median": {key: statistics.median(run[key] for run in runs) for key in runs[0]}}
+
+    print(f"Cold start ({args.server}, {args.runs} runs, median)")
+    for key, value in report["median"].items():
+        print(f"  {key:<16} {value:>8.1f} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
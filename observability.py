@@ -0,0 +1,353 @@
+"""
+Metrics, timing spans, structured logs and an optional sampling profiler,
+shared by main.py (Flask) and asgi.py (Quart). No third-party dependencies.
+
+- metrics.render() is the Prometheus text exposition served at /metrics.
+  Request counters and histograms are recorded as requests finish; the
+  existing stats() objects (upstream policies, caches, session stores, ...)
+  are read at scrape time by registered collectors.
+- begin_request()/finish_request() keep a per-request context (request ID,
+  endpoint, stage timings) in a contextvar, so span('upstream') etc. can be
+  used anywhere below a view, including worker threads that copy the context.
+- log() writes one JSON line per event (LOG_FORMAT=text for key=value lines)
+  carrying the request ID. Free text from users goes through redact() first.
+- profiler samples every thread's stack at a fixed interval while enabled and
+  reports collapsed stacks (flamegraph.pl / speedscope input). It is toggled
+  at runtime through /api/debug/profiler when PROFILER_TOKEN is set.
+"""
+import contextvars
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_MESSAGE_CHARS = int(os.getenv("LOG_MESSAGE_CHARS", "120"))  # 0 leaves user text out of the logs
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+
+# Seconds; wide enough for sub-millisecond stages and minute-long vision calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGES = ('decode', 'preprocess', 'upstream', 'parse', 'encode')
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# --- PII redaction ---
+
+REDACTIONS = (
+    (re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+'), '[email]'),
+    (re.compile(r'\b[A-Z]{5}\d{4}[A-Z]\b'), '[pan]'),
+    (re.compile(r'\b\d{4}[\s-]?\d{4}[\s-]?\d{4}\b'), '[aadhaar]'),
+    (re.compile(r'(?:\+91[\s-]?|\b0)?\b[6-9]\d{4}[\s-]?\d{5}\b'), '[phone]'),
+    (re.compile(r'-?\d{1,3}\.\d+\s*,\s*-?\d{1,3}\.\d+'), '[coords]'),
+)
+
+
+def redact(text, limit=LOG_MESSAGE_CHARS):
+    """User text safe for logs: emails, PAN/Aadhaar/phone numbers and coordinates masked, then truncated."""
+    if not text or not limit:
+        return ''
+    text = str(text)
+    for pattern, mask in REDACTIONS:
+        text = pattern.sub(mask, text)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+# --- metrics ---
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """Counters and histograms recorded in-process, plus scrape-time collectors."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}  # name -> {label key: value}
+        self._histograms = {}  # name -> {label key: [bucket counts..., +Inf count, sum]}
+        self._collectors = []
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, labels=None, amount=1):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, seconds, labels=None):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += seconds
+
+    def add_collector(self, collector):
+        """`collector(emit)` calls emit(name, value, labels=None, kind='gauge', help_text='') per sample."""
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: list(counts) for key, counts in series.items()}
+                          for name, series in self._histograms.items()}
+
+        for name, series in sorted(counters.items()):
+            header(name, 'counter')
+            lines += [f"{name}{_format_labels(key)} {_format_value(value)}" for key, value in sorted(series.items())]
+
+        for name, series in sorted(histograms.items()):
+            header(name, 'histogram')
+            for key, counts in sorted(series.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {counts[-2]}")
+                lines.append(f"{name}_count{_format_labels(key)} {counts[-2]}")
+                lines.append(f"{name}_sum{_format_labels(key)} {round(counts[-1], 6)}")
+
+        samples = {}
+
+        def emit(name, value, labels=None, kind='gauge', help_text=''):
+            if help_text:
+                self._help.setdefault(name, help_text)
+            samples.setdefault(name, (kind, []))[1].append((_label_key(labels), value))
+
+        for collector in self._collectors:
+            try:
+                collector(emit)
+            except Exception as e:
+                log('metrics_collector_failed', level='error', error=f"{type(e).__name__}: {e}")
+        for name, (kind, series) in samples.items():
+            header(name, kind)
+            lines += [f"{name}{_format_labels(key)} {_format_value(value)}" for key, value in series]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+metrics.describe('citiassist_requests_total', 'HTTP requests by endpoint, method and status.')
+metrics.describe('citiassist_request_seconds',
+                 'Request latency by endpoint, up to the response headers (first byte for streams).')
+metrics.describe('citiassist_stage_seconds',
+                 'Time spent per request stage: decode, preprocess, upstream, parse, encode.')
+
+
+# --- request context and spans ---
+
+@dataclass
+class RequestContext:
+    request_id: str
+    endpoint: str
+    method: str = ''
+    start: float = field(default_factory=time.perf_counter)
+    stages: dict = field(default_factory=dict)  # stage -> seconds
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)  # PDF pages add stages concurrently
+
+
+_context = contextvars.ContextVar('citiassist_request', default=None)
+
+
+def request_id():
+    context = _context.get()
+    return context.request_id if context else None
+
+
+def begin_request(endpoint, method='', incoming_id=None):
+    """Starts the context for one request; a sane incoming X-Request-ID is kept, otherwise one is generated."""
+    rid = incoming_id if incoming_id and REQUEST_ID_PATTERN.match(incoming_id) else uuid.uuid4().hex[:16]
+    context = RequestContext(rid, endpoint or 'unmatched', method)
+    _context.set(context)
+    return context
+
+
+def finish_request(status):
+    """Records the request's counter, latency and access log line; returns its request ID."""
+    context = _context.get()
+    if context is None:
+        return None
+    elapsed = time.perf_counter() - context.start
+    labels = {'endpoint': context.endpoint}
+    metrics.inc('citiassist_requests_total', dict(labels, method=context.method, status=str(status)))
+    metrics.observe('citiassist_request_seconds', elapsed, labels)
+    log('request', level='error' if status >= 500 else 'info', method=context.method, status=status,
+        duration_ms=round(elapsed * 1000, 1),
+        stages_ms={stage: round(seconds * 1000, 1) for stage, seconds in context.stages.items()})
+    return context.request_id
+
+
+def observe_stage(stage, seconds):
+    """Adds `seconds` to a stage of the current request (or the 'background' endpoint outside one)."""
+    context = _context.get()
+    metrics.observe('citiassist_stage_seconds', seconds,
+                    {'endpoint': context.endpoint if context else 'background', 'stage': stage})
+    if context is not None:
+        with context.lock:
+            context.stages[stage] = context.stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+# --- logs ---
+
+_log_lock = threading.Lock()
+
+
+def log(event, level='info', **fields):
+    """One structured log line. Callers pass user text through redact()."""
+    context = _context.get()
+    record = {'ts': round(time.time(), 3), 'level': level, 'event': event}
+    if context is not None:
+        record['request_id'] = context.request_id
+        record['endpoint'] = context.endpoint
+    record.update(fields)
+    if LOG_FORMAT == 'text':
+        line = ' '.join(f"{key}={value}" for key, value in record.items())
+    else:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+    with _log_lock:
+        print(line, flush=True)
+
+
+def log_exception(event, error, **fields):
+    """Error log with the exception class and a redacted message and traceback."""
+    trace = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+    log(event, level='error', error=type(error).__name__, details=redact(str(error), 500),
+        traceback=redact(trace, 4000), **fields)
+
+
+# --- sampling profiler ---
+
+class SamplingProfiler:
+    """
+    Samples every thread's Python stack each `interval` seconds while running
+    and counts collapsed stacks ("outer;inner;leaf count" lines). Costs one
+    sys._current_frames() walk per interval, nothing while stopped.
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL_MS / 1000.0, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.sample_count = 0
+        self.started_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None, reset=True):
+        with self._lock:
+            if interval:
+                self.interval = interval
+            if reset:
+                self.samples.clear()
+                self.sample_count = 0
+            if self.running:
+                return
+            self._stop.clear()
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=1.0)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(names)))
+            with self._lock:
+                self.samples.update(stacks)
+                self.sample_count += 1
+
+    def collapsed(self, limit=None):
+        """Collapsed stacks, most frequent first."""
+        with self._lock:
+            top = self.samples.most_common(limit)
+        return '\n'.join(f"{stack} {count}" for stack, count in top) + '\n'
+
+    def status(self):
+        with self._lock:
+            return {'running': self.running, 'interval_ms': round(self.interval * 1000, 2),
+                    'samples': self.sample_count, 'distinct_stacks': len(self.samples),
+                    'started_at': self.started_at}
+
+
+profiler = SamplingProfiler()
+if os.getenv("PROFILER", "0").lower() in ("1", "true", "yes"):
+    profiler.start()
+
+
+def profiler_authorized(headers):
+    """Runtime profiler control needs PROFILER_TOKEN set and sent back in X-Profiler-Token."""
+    return bool(PROFILER_TOKEN) and headers.get('X-Profiler-Token') == PROFILER_TOKEN
+
+
+def profiler_command(payload):
+    """Applies {"enabled": bool, "interval_ms": float} and returns the status."""
+    interval_ms = payload.get('interval_ms')
+    if payload.get('enabled'):
+        profiler.start(interval=float(interval_ms) / 1000.0 if interval_ms else None,
+                       reset=payload.get('reset', True))
+    elif 'enabled' in payload:
+        profiler.stop()
+    return profiler.status()
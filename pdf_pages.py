@@ -0,0 +1,118 @@
+"""
+Multi-page PDF support for the document endpoints.
+
+Only the first PDF_MAX_PAGES pages are read; page_coverage() gives the
+fields that tell the client when a document was cut short.
+
+Pages are rasterized one at a time with pdfium and immediately re-encoded by
+the image pipeline, so only a bounded number of pages (PDF_PAGE_WORKERS) is
+ever held in memory, however long the document is. Each prepared page is
+handed to a shared worker pool, which is where the model calls happen.
+
+pdfium is not thread-safe, so every pdfium call goes through _pdfium_lock.
+"""
+import contextvars
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pypdfium2 as pdfium
+
+from image_pipeline import DOCUMENT_MAX_DIM, preprocess_decoded
+
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "20"))
+PDF_PAGE_WORKERS = int(os.getenv("PDF_PAGE_WORKERS", "4"))
+
+_pdfium_lock = threading.Lock()
+_page_pool = ThreadPoolExecutor(max_workers=PDF_PAGE_WORKERS * 4, thread_name_prefix="pdf-page")
+
+
+def is_pdf(data):
+    return data[:1024].lstrip().startswith(b"%PDF-")
+
+
+def count_pages(pdf_bytes):
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+
+def page_coverage(pdf_bytes, max_pages=PDF_MAX_PAGES):
+    """Response fields saying how much of the PDF is read: page_count, and truncated past max_pages."""
+    page_count = count_pages(pdf_bytes)
+    coverage = {'page_count': page_count, 'truncated': page_count > max_pages}
+    if coverage['truncated']:
+        coverage['max_pages'] = max_pages
+    return coverage
+
+
+def iter_pdf_pages(pdf_bytes, max_dim=DOCUMENT_MAX_DIM, grayscale=False, max_pages=PDF_MAX_PAGES):
+    """Yields (page_index, PIL image), rendering each page only when asked for it."""
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        page_count = min(len(pdf), max_pages)
+    try:
+        for index in range(page_count):
+            with _pdfium_lock:
+                page = pdf[index]
+                width, height = page.get_size()
+                # Render straight at the target resolution instead of resizing afterwards
+                bitmap = page.render(scale=max_dim / max(width, height), grayscale=grayscale)
+                image = bitmap.to_pil().copy()
+                bitmap.close()
+                page.close()
+            yield index, image
+    finally:
+        with _pdfium_lock:
+            pdf.close()
+
+
+def map_pages(pdf_bytes, handle_page, mode="document", max_workers=PDF_PAGE_WORKERS):
+    """
+    Calls handle_page(page_index, PreparedImage) for every page, up to
+    max_workers pages at a time, and returns the results in page order.
+    At most one raw page bitmap and max_workers encoded pages are alive at once.
+    """
+    slots = threading.BoundedSemaphore(max_workers)
+    futures = []
+    for index, image in iter_pdf_pages(pdf_bytes, grayscale=(mode == "document")):
+        if any(future.done() and future.exception() for future in futures):
+            break  # A page failed; don't render the rest of the document
+        prepared = preprocess_decoded(image, mode)
+        del image
+        slots.acquire()
+        # Each page runs in the request's context so its spans and logs carry the request ID
+        future = _page_pool.submit(contextvars.copy_context().run, handle_page, index, prepared)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    return [future.result() for future in futures]
+
+
+def images_to_pdf(pages):
+    """
+    Builds a PDF from (jpeg_bytes, (width, height)) pairs, one page each.
+    The pages are embedded as JPEG streams, so nothing is decoded here.
+    """
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument.new()
+        try:
+            for jpeg_bytes, (width, height) in pages:
+                # Keep A4-ish physical size: fit the long side to 842pt (A4 height)
+                scale = 842 / max(width, height)
+                page_width, page_height = width * scale, height * scale
+                page = pdf.new_page(page_width, page_height)
+                image = pdfium.PdfImage.new(pdf)
+                image.load_jpeg(io.BytesIO(jpeg_bytes), inline=True)
+                image.set_matrix(pdfium.PdfMatrix().scale(page_width, page_height))
+                page.insert_obj(image)
+                page.gen_content()
+                page.close()
+            buffered = io.BytesIO()
+            pdf.save(buffered)
+            return buffered.getvalue()
+        finally:
+            pdf.close()
@@ -0,0 +1,318 @@
+"""
+Prompt management for the Gemini calls.
+
+- Templates: every prompt lives here and is compiled once at import (dedented,
+  trailing spaces and blank-line runs removed). The image prompts rely on the
+  response schemas in structured_output.py for the JSON shape, so they only
+  describe the content of each key.
+- Location context: located chat questions get one short line with the area
+  name resolved from the coordinates (civic index area centroids) instead of a
+  three-sentence prefix that repeated the coordinates already in the message.
+- Context caching (GEMINI_CONTEXT_CACHE=1, off by default): CachedContentModels
+  is a model factory for GeminiClient that stores the static system instruction
+  once as Gemini cached content and builds models from it, refreshing the TTL
+  before it expires. Instructions estimated below GEMINI_CONTEXT_CACHE_MIN_TOKENS
+  (the API's minimum cacheable size) use a plain model without trying, as does
+  any model whose cache can't be created; Gemini 2.5 still applies implicit
+  prefix caching to the identical instruction.
+- TokenMeter: prompt, cached and output tokens plus latency per endpoint, read
+  from each response's usage_metadata, for /api/token-usage.
+"""
+import asyncio
+import math
+import os
+import re
+import textwrap
+import threading
+import time
+from collections import deque
+
+from google.api_core import exceptions as api_exceptions
+
+from admission import CHARS_PER_TOKEN
+from gemini_client import load_sdk
+from latency_stats import summarize
+from observability import log, redact
+
+CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# Explicit caches below this size are rejected by the API (1024 tokens for 2.5 Flash, 2048 for 2.5 Pro)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+CACHE_REFRESH_MARGIN = 300  # Seconds before expiry when the TTL is extended
+CACHE_RETRY_SECONDS = 600  # Wait before trying to create a cache again after a transient failure
+LATENCY_WINDOW = 1000
+PROMPT_SIZE_BUCKETS = (500, 1000, 2000, 4000)  # Prompt tokens; latency is reported per bucket
+
+
+def compile_prompt(text):
+    """Dedents, strips trailing whitespace and collapses blank-line runs."""
+    lines = [line.rstrip() for line in textwrap.dedent(text).splitlines()]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+SYSTEM_INSTRUCTION = compile_prompt("""
+You are CitiAssist, a helpful Smart City guide for the city of Hyderabad only.
+Your scope is STRICTLY restricted to the following topics:
+1. Hospitals & Healthcare
+2. Public Transport (Metro, Buses, Trains)
+3. Police & Safety
+4. Utilities (Electricity, Water, Waste Management, Municipal Services)
+5. Government Services & Documentation (Aadhar, PAN, Voter ID, Driving License, Passport, etc.)
+6. Tourism, Landmarks, and City Culture (Professional city information)
+
+Rules:
+- If a user asks about anything OUTSIDE these 6 categories (e.g. general programming, math, pop culture, recipes, or general chit-chat), explicitly state "Data not available. My scope is strictly restricted to Civic and City Services for Hyderabad."
+- DETECT the language of the user's query and RESPOND IN THE SAME LANGUAGE.
+- **FORMATTING**: Use Markdown. **Bold** names/headers. Lists for readability.
+
+### TRANSIT & ROUTING RULES (A to B Queries)
+If the user asks how to get from one place to another (e.g. "How to go from X to Y" or "Route to Z"):
+1. Provide a **Cost-Optimized, Multi-Modal Route**: Suggest the best mix of TSRTC Buses, Hyderabad Metro, and MMTS.
+2. Structure the response strictly as:
+   - **Overview**: Total Estimated Time and best modes of transport.
+   - **Step-by-Step Breakdown**: Clear numbered steps (e.g., "1. Take bus 218 from X to Y. 2. Board the Red Line Metro at Y.").
+   - **Estimated Cost**: State the total estimated price in INR.
+3. EXCEPTION: Do **NOT** provide external links to TSRTC or Metro websites for routing queries. Give the user all the information directly in the chat text so they don't have to leave the app.
+
+### STANDARD LINKING RULE (For Non-Routing Queries)
+- If discussing general hospitals, police stations, or government portals, you MUST provide a clickable link.
+- **Locations**: `[Apollo Hospital](https://www.google.com/maps/search/?api=1&query=Apollo+Hospital)`
+- **Services**: `[Meeseva Portal](https://ts.meeseva.gov.in/)`
+
+### LOCATION/GPS HANDLING
+- A "User location:" line (area name and coordinates) or "Current Location: [Lat], [Long]" is the user's precise location.
+- Provide results *specifically* near that location. Do NOT ask for their location again.
+- Lines under "REFERENCE DATA" are verified local facts and places; prefer them.
+
+Keep answers concise, helpful, and polite.
+""")
+
+REPORT_ISSUE_PROMPT = compile_prompt("""
+    Analyze this image for civic issues (e.g., potholes, garbage, broken streetlights, traffic violations, parking issues).
+    Return the complaint object:
+    - "recipient_email": official email of the relevant Hyderabad authority (e.g., commissioner@ghmc.gov.in for GHMC, or the Cyberabad Traffic Police email).
+    - "subject": formal subject line for the complaint, citing [Location].
+    - "body": formal complaint letter. YOU MUST INCLUDE the exact text '[Location]' so the user can fill it in, e.g. 'I observed a pothole at [Location]...'.
+    - "response": polite Markdown summary for the user explaining the issue and that a draft is ready.
+    If no civic issue is detected, leave the first three empty and set "response" to "No civic issue detected in this image."
+    """)
+
+ANALYZE_DOCUMENT_PROMPT = compile_prompt("""
+    Analyze this government form or official document.
+    1. Identify exactly what this document is.
+    2. Provide a comprehensive, step-by-step guide on how to fill it out.
+    3. Explain any complex legal terms or requirements in simple, easy-to-understand language.
+    4. If it contains instructions, summarize them clearly.
+    5. Output the response in Markdown format.
+    6. If this does not look like a form or official document, please state that.
+    """)
+
+FORM_FIELDS_PROMPT = compile_prompt("""
+    You are an expert document analysis AI working for the government of Telangana, dedicated to accessibility.
+    Look at this image of a blank document or form.
+    Identify every visual BLANK LINE or BLANK BOX where a citizen is expected to write their information.
+
+    CRITICAL ACCESSIBILITY INSTRUCTION:
+    Forms often use complex bureaucratic or legal terms (e.g., "Domicile", "Remittance", "Kin", "Spouse", "NOC").
+    You MUST simplify these tough fields so common, everyday people can easily understand them. Translate complex legalese into plain language.
+
+    Return one object per blank field, top to bottom:
+    1. "field_name": A short programmatic name (e.g. "applicant_name").
+    2. "question": A friendly, conversational question asking the citizen for this data in VERY SIMPLE terms (e.g. Instead of "What is your domicile?", ask "What city or town do you permanently live in?").
+    3. "box_2d": [ymin, xmin, ymax, xmax] of the BLANK AREA, normalized to a 1000x1000 scale (e.g. [200, 100, 250, 400]).
+    """)
+
+CONVERSATION_SUMMARY_PROMPT = compile_prompt("""
+    Update the running summary of a conversation between a citizen and CitiAssist, a Hyderabad civic services guide.
+    Keep every fact a follow-up question might depend on: places, areas, services, documents, dates, numbers and the user's situation.
+    Drop greetings and pleasantries. Write at most 120 words, in the language the user writes in. Return only the summary text.
+
+    Current summary:
+    {summary}
+
+    New messages to fold in:
+    {messages}
+    """)
+
+LOCATION_TEMPLATE = "User location: {place} ({lat}, {long}). Answer for this location.\n"
+
+# The frontend appends "(Current Location: lat, long)"; drop what is left of it once the coordinates are gone
+EMPTY_PARENS = re.compile(r'\(\s*\)')
+
+
+def location_line(lat, long, area=None):
+    """Short location context for a chat prompt; `area` is the resolved area name, if any."""
+    place = f"{area}, Hyderabad" if area else "Hyderabad"
+    return LOCATION_TEMPLATE.format(place=place, lat=lat, long=long)
+
+
+def strip_location(user_message, pattern):
+    """The message without its coordinate text (it is restated in the location line)."""
+    return EMPTY_PARENS.sub('', pattern.sub(' ', user_message)).strip()
+
+
+# --- context caching ---
+
+class CachedInstructionModel:
+    """
+    Behaves like GenerativeModel with a system instruction, but sends the
+    instruction as cached content while a cache is available.
+    """
+
+    def __init__(self, model_name, system_instruction, ttl=CONTEXT_CACHE_TTL, stats=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.ttl = ttl
+        self.stats = stats if stats is not None else {}
+        self.plain = load_sdk().GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+        self.cache = None
+        self.cached_model = None
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+        if len(system_instruction) // CHARS_PER_TOKEN < CONTEXT_CACHE_MIN_TOKENS:
+            # Creating the cache would be a blocking call that is sure to fail: never try
+            self.retry_at = math.inf
+            self._count('too_small')
+
+    def _count(self, field):
+        self.stats[field] = self.stats.get(field, 0) + 1
+
+    def _fresh(self):
+        return self.cached_model is not None and time.monotonic() < self.expires_at - CACHE_REFRESH_MARGIN
+
+    def _current(self):
+        """The cached-content model, creating or extending the cache when due; the plain model otherwise."""
+        if self._fresh():
+            return self.cached_model
+        with self.lock:
+            if self._fresh():
+                return self.cached_model
+            now = time.monotonic()
+            if now < self.retry_at:
+                return self.plain
+            try:
+                if self.cache is not None:
+                    self.cache.update(ttl=self.ttl)
+                    self._count('refreshed')
+                else:
+                    self.cache = load_sdk().caching.CachedContent.create(
+                        model=self.model_name, display_name="citiassist-system-instruction",
+                        system_instruction=self.system_instruction, ttl=self.ttl)
+                    self.cached_model = load_sdk().GenerativeModel.from_cached_content(self.cache)
+                    self._count('created')
+                self.expires_at = now + self.ttl
+                return self.cached_model
+            except api_exceptions.InvalidArgument as e:
+                # Too small to cache or not supported for this model: don't ask again
+                log('context_cache_unavailable', level='warning', model=self.model_name, details=redact(str(e)))
+                self.retry_at = math.inf
+            except Exception as e:
+                log('context_cache_failed', level='warning', model=self.model_name, error=type(e).__name__,
+                    details=redact(str(e)))
+                self.retry_at = now + CACHE_RETRY_SECONDS
+            self._count('fallbacks')
+            self.cache = self.cached_model = None
+            return self.plain
+
+    def _invalidate(self, model):
+        with self.lock:
+            if model is self.cached_model:
+                self.cache = self.cached_model = None
+                self._count('expired')
+
+    def generate_content(self, contents, **kwargs):
+        model = self._current()
+        try:
+            return model.generate_content(contents, **kwargs)
+        except api_exceptions.NotFound:
+            # Cache expired or was deleted server-side: answer with the plain instruction
+            if model is self.plain:
+                raise
+            self._invalidate(model)
+            return self.plain.generate_content(contents, **kwargs)
+
+    async def generate_content_async(self, contents, **kwargs):
+        if self._fresh():
+            model = self.cached_model
+        else:
+            # Creating the cache is a blocking API call; keep it off the event loop
+            model = await asyncio.get_running_loop().run_in_executor(None, self._current)
+        try:
+            return await model.generate_content_async(contents, **kwargs)
+        except api_exceptions.NotFound:
+            if model is self.plain:
+                raise
+            self._invalidate(model)
+            return await self.plain.generate_content_async(contents, **kwargs)
+
+
+class CachedContentModels:
+    """model_factory for GeminiClient: models with a system instruction use context caching."""
+
+    def __init__(self, ttl=CONTEXT_CACHE_TTL):
+        self.ttl = ttl
+        self.stats = {}
+
+    def __call__(self, model_name, system_instruction=None):
+        if not system_instruction:
+            return load_sdk().GenerativeModel(model_name=model_name)
+        return CachedInstructionModel(model_name, system_instruction, self.ttl, self.stats)
+
+
+# --- token accounting ---
+
+def _bucket(prompt_tokens):
+    for limit in PROMPT_SIZE_BUCKETS:
+        if prompt_tokens < limit:
+            return f"<{limit}"
+    return f">={PROMPT_SIZE_BUCKETS[-1]}"
+
+
+class TokenMeter:
+    """Per-endpoint token counts and latency, fed from usage_metadata."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, usage, seconds=None):
+        prompt = getattr(usage, 'prompt_token_count', 0) or 0
+        output = getattr(usage, 'candidates_token_count', 0) or 0
+        cached = getattr(usage, 'cached_content_token_count', 0) or 0
+        with self.lock:
+            entry = self.endpoints.get(endpoint)
+            if entry is None:
+                entry = self.endpoints[endpoint] = {
+                    'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0,
+                    'latencies': deque(maxlen=LATENCY_WINDOW), 'by_prompt_size': {},
+                }
+            entry['requests'] += 1
+            entry['prompt_tokens'] += prompt
+            entry['cached_tokens'] += cached
+            entry['output_tokens'] += output
+            if seconds is not None:
+                entry['latencies'].append(seconds)
+                size = entry['by_prompt_size'].setdefault(_bucket(prompt), [0, 0.0])
+                size[0] += 1
+                size[1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for endpoint, entry in self.endpoints.items():
+                requests = entry['requests']
+                result[endpoint] = {
+                    'requests': requests,
+                    'prompt_tokens': entry['prompt_tokens'],
+                    'cached_tokens': entry['cached_tokens'],
+                    'output_tokens': entry['output_tokens'],
+                    'avg_prompt_tokens': round(entry['prompt_tokens'] / requests, 1),
+                    'avg_output_tokens': round(entry['output_tokens'] / requests, 1),
+                    'latency': summarize(list(entry['latencies'])),
+                    'avg_latency_ms_by_prompt_tokens': {
+                        bucket: round(total / count * 1000, 1)
+                        for bucket, (count, total) in entry['by_prompt_size'].items()
+                    },
+                }
+            return result
@@ -0,0 +1,139 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Unicode ranges used for quick language detection (same three languages the UI offers)
+DEVANAGARI = re.compile(r'[ऀ-ॿ]')
+TELUGU = re.compile(r'[ఀ-౿]')
+
+# Strips everything except letters/digits (any script) and whitespace
+NON_WORD = re.compile(r'[^\w\s]+', re.UNICODE)
+WHITESPACE = re.compile(r'\s+')
+
+
+def detect_language(text):
+    """Cheap script-based detection: 'te', 'hi' or 'en'."""
+    if TELUGU.search(text):
+        return 'te'
+    if DEVANAGARI.search(text):
+        return 'hi'
+    return 'en'
+
+
+def normalize_query(text):
+    """Lowercases, drops punctuation and collapses whitespace."""
+    text = NON_WORD.sub(' ', text.lower())
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def round_coordinates(coords, precision=2):
+    """
+    Rounds (lat, long) so nearby users share cache entries.
+    2 decimal places is roughly a 1 km grid cell in Hyderabad.
+    """
+    if not coords:
+        return None
+    try:
+        lat, long = (round(float(value), precision) for value in coords)
+    except (TypeError, ValueError):
+        return None
+    return (lat, long)
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _similarity(a, b):
+    """Jaccard similarity of two trigram sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU + TTL cache for chat replies.
+
+    Entries are keyed on (normalized query, language, rounded coordinates).
+    With a similarity threshold set, a miss on the exact key falls back to the
+    closest cached query (character trigram Jaccard) in the same language and
+    location cell.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, similarity_threshold=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # key -> (expires_at, value, trigrams)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(query, coords=None):
+        return (normalize_query(query), detect_language(query), round_coordinates(coords))
+
+    def get(self, query, coords=None):
+        key = self.make_key(query, coords)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+            if self.similarity_threshold:
+                match = self._nearest(key, now)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.near_hits += 1
+                    return self._entries[match][1]
+
+            self.misses += 1
+            return None
+
+    def _nearest(self, key, now):
+        # Only compare against entries in the same language and location cell
+        query_grams = _trigrams(key[0])
+        best_key, best_score = None, self.similarity_threshold
+        for other_key, (expires_at, _, grams) in self._entries.items():
+            if expires_at <= now or other_key[1:] != key[1:]:
+                continue
+            score = _similarity(query_grams, grams)
+            if score >= best_score:
+                best_key, best_score = other_key, score
+        return best_key
+
+    def put(self, query, value, coords=None):
+        key = self.make_key(query, coords)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value, _trigrams(key[0]))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.near_hits) / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,287 @@
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+class SessionStore(ABC):
+    """
+    Byte-valued key/value store with a TTL, used for wizard sessions and other
+    short-lived state that has to survive between requests.
+
+    Values are stored as opaque bytes (e.g. the original compressed upload),
+    never as decoded objects, so any backend can hold them and any worker can
+    read them back. Reads refresh the TTL (sliding expiry).
+    """
+
+    def __init__(self, ttl_seconds=1800, max_bytes=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @abstractmethod
+    def get(self, key):
+        """The stored bytes (refreshing the TTL), or None if missing or expired."""
+
+    @abstractmethod
+    def put(self, key, value):
+        """Stores `value` (bytes) under `key` with a fresh TTL."""
+
+    @abstractmethod
+    def delete(self, key):
+        """Removes `key`; missing keys are ignored."""
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def ping(self):
+        """True if the backend answers; used by the /readyz check."""
+        return True
+
+    def _usage(self):
+        """Returns (entries, bytes) or (None, None) if the backend can't tell cheaply."""
+        return None, None
+
+    def stats(self):
+        entries, used_bytes = self._usage()
+        return {
+            'backend': type(self).__name__,
+            'entries': entries,
+            'bytes': used_bytes,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
+
+
+class MemorySessionStore(SessionStore):
+    """In-process LRU + TTL store bounded by entry count and total bytes."""
+
+    def __init__(self, ttl_seconds=1800, max_bytes=64 * 1024 * 1024, max_entries=10000):
+        super().__init__(ttl_seconds, max_bytes)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= now:
+                self._remove(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries[key] = (now + self.ttl_seconds, entry[1])
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._bytes += len(value)
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            self._remove(key)
+            self.expired += 1
+        # Least recently used first; the newest entry is always kept
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _usage(self):
+        with self._lock:
+            return len(self._entries), self._bytes
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite-backed store. Point every gunicorn worker at the same file to share
+    sessions between them on a single host.
+    """
+
+    def __init__(self, path, namespace='default', ttl_seconds=1800, max_bytes=256 * 1024 * 1024):
+        super().__init__(ttl_seconds, max_bytes)
+        self.path = path
+        self.namespace = namespace
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,"
+                " size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_lru ON sessions (namespace, accessed_at)")
+
+    def _connect(self):
+        # sqlite3 connections can't be shared across threads; keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM sessions WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1] <= now:
+                conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (self.namespace, key))
+                self.expired += 1
+                self.misses += 1
+                return None
+            conn.execute(
+                "UPDATE sessions SET expires_at = ?, accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now + self.ttl_seconds, now, self.namespace, key),
+            )
+        self.hits += 1
+        return bytes(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, key, sqlite3.Binary(value), len(value), now + self.ttl_seconds, now),
+            )
+            self._evict(conn, now, key)
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def _evict(self, conn, now, keep_key):
+        cursor = conn.execute(
+            "DELETE FROM sessions WHERE namespace = ? AND expires_at <= ?", (self.namespace, now)
+        )
+        self.expired += max(cursor.rowcount, 0)
+        if not self.max_bytes:
+            return
+        total = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM sessions WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute(
+            "SELECT key, size FROM sessions WHERE namespace = ? AND key != ? ORDER BY accessed_at",
+            (self.namespace, keep_key),
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (self.namespace, key))
+            total -= size
+            self.evictions += 1
+
+    def ping(self):
+        try:
+            with self._connect() as conn:
+                conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _usage(self):
+        with self._connect() as conn:
+            entries, used_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions WHERE namespace = ?",
+                (self.namespace,),
+            ).fetchone()
+        return entries, used_bytes
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis-backed store for sharing sessions across hosts. Takes any client with
+    the redis-py get/set/delete/expire API, so tests can pass fakeredis.FakeRedis().
+
+    Expiry is handled by Redis itself. The memory ceiling belongs to the Redis
+    server (maxmemory + an LRU eviction policy), so max_bytes is informational.
+    """
+
+    def __init__(self, client, namespace='default', ttl_seconds=1800, max_bytes=None):
+        super().__init__(ttl_seconds, max_bytes)
+        self.client = client
+        self.prefix = f"citiassist:{namespace}:"
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.client.expire(self.prefix + key, self.ttl_seconds)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl_seconds)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def ping(self):
+        try:
+            return bool(self.client.ping())
+        except Exception:
+            return False
+
+
+def create_session_store(namespace, ttl_seconds=None):
+    """
+    Builds the store selected by SESSION_BACKEND (memory | sqlite | redis).
+
+    SESSION_TTL and SESSION_MAX_BYTES set expiry and the memory ceiling,
+    SESSION_DB_PATH the SQLite file and REDIS_URL the Redis server.
+    """
+    backend = os.getenv("SESSION_BACKEND", "memory").lower()
+    ttl_seconds = ttl_seconds or int(os.getenv("SESSION_TTL", "1800"))
+    max_bytes = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+
+    if backend == "sqlite":
+        path = os.getenv("SESSION_DB_PATH", "citiassist_sessions.db")
+        return SQLiteSessionStore(path, namespace, ttl_seconds, max_bytes)
+    if backend == "redis":
+        import redis  # Optional dependency, only needed for this backend
+        client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        return RedisSessionStore(client, namespace, ttl_seconds, max_bytes)
+    if backend != "memory":
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    return MemorySessionStore(ttl_seconds, max_bytes)
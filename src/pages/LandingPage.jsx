@@ -30,6 +30,7 @@ const LandingPage = ({ isSeniorMode }) => {
     const [wizardReviewMode, setWizardReviewMode] = useState(false);
     const [filledFormImage, setFilledFormImage] = useState(null);
     const formInputRef = useRef(null);
+    const conversationIdRef = useRef(null); // Server-side chat session; the backend only sends history for follow-ups
 
     // Auth context for restricting specific actions
     const { currentUser } = useAuth();
@@ -272,10 +273,13 @@ const LandingPage = ({ isSeniorMode }) => {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ message: searchQuery }),
+                body: JSON.stringify({ message: searchQuery, conversation_id: conversationIdRef.current }),
             });
 
             const data = await response.json();
+            if (data.conversation_id) {
+                conversationIdRef.current = data.conversation_id;
+            }
             console.log('Backend response:', data);
 
             if (data.response) {
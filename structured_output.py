@@ -0,0 +1,304 @@
+"""
+Structured output for /api/report-issue and /api/start-form-fill.
+
+- Both calls send a response schema, so Gemini returns the complaint object and
+  the field array as JSON directly.
+- When the output is still not clean (truncated by max tokens, a stray fence,
+  one malformed item), the tolerant parser keeps every complete array element
+  or object member and collects the broken fragments.
+- Only the broken part is then re-asked: the missing complaint keys (text only,
+  no image), or the fields after the last good one plus the malformed ones. The
+  repaired part is merged with what was already salvaged.
+
+The caller makes the model calls; this module only builds prompts and parses,
+so the Flask and Quart apps share it.
+"""
+import json
+import re
+import threading
+
+from observability import log
+
+COMPLAINT_KEYS = ("recipient_email", "subject", "body", "response")
+
+COMPLAINT_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "string"} for key in COMPLAINT_KEYS},
+    "required": list(COMPLAINT_KEYS),
+}
+
+FORM_FIELD_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "field_name": {"type": "string"},
+        "question": {"type": "string"},
+        "box_2d": {"type": "array", "items": {"type": "integer"}, "min_items": 4, "max_items": 4},
+    },
+    "required": ["field_name", "question", "box_2d"],
+}
+
+FORM_FIELDS_SCHEMA = {"type": "array", "items": FORM_FIELD_SCHEMA}
+
+COMPLAINT_CONFIG = {"response_mime_type": "application/json", "response_schema": COMPLAINT_SCHEMA}
+FORM_FIELDS_CONFIG = {"response_mime_type": "application/json", "response_schema": FORM_FIELDS_SCHEMA}
+
+FENCE_PATTERN = re.compile(r"```(?:json)?", re.IGNORECASE)
+_decoder = json.JSONDecoder()
+
+_stats_lock = threading.Lock()
+_stats = {'clean': 0, 'salvaged': 0, 'repaired': 0, 'repair_failed': 0}
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def structured_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+# --- tolerant parsing ---
+
+def _skip(text, pos, chars=" \t\r\n"):
+    while pos < len(text) and text[pos] in chars:
+        pos += 1
+    return pos
+
+
+class ArrayParser:
+    """
+    Incremental parser for a JSON array of objects. feed() may be called with
+    streamed chunks and returns the elements completed so far; a malformed
+    element is skipped up to the next element and kept in .broken.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = None  # Index just after '[' once seen
+        self.items = []
+        self.broken = []
+        self.closed = False
+
+    def feed(self, chunk):
+        self.buffer += FENCE_PATTERN.sub("", chunk)
+        new_items = []
+        if self.pos is None:
+            start = self.buffer.find("[")
+            if start == -1:
+                return new_items
+            self.pos = start + 1
+        while not self.closed:
+            pos = _skip(self.buffer, self.pos, " \t\r\n,")
+            if pos >= len(self.buffer):
+                break
+            if self.buffer[pos] == "]":
+                self.closed = True
+                self.pos = pos + 1
+                break
+            try:
+                item, end = _decoder.raw_decode(self.buffer, pos)
+            except json.JSONDecodeError:
+                # Maybe just not arrived yet; if a later element has started, this one is broken
+                resync = self.buffer.find("{", pos + 1)
+                if resync == -1:
+                    break
+                self.broken.append(self.buffer[pos:resync].rstrip(" \t\r\n,"))
+                self.pos = resync
+                continue
+            new_items.append(item)
+            self.pos = end
+        self.items.extend(new_items)
+        return new_items
+
+    def tail(self):
+        """Unparsed text after the last complete element (a truncated element), or ''."""
+        if self.pos is None or self.closed:
+            return ""
+        return self.buffer[self.pos:].strip(" \t\r\n,")
+
+
+def salvage_object(text):
+    """
+    Returns (dict of complete members, broken tail text). Members after the
+    first malformed one are lost, which is what a truncated reply looks like.
+    """
+    text = FENCE_PATTERN.sub("", text)
+    start = text.find("{")
+    if start == -1:
+        return {}, text.strip()
+    try:
+        value, _ = _decoder.raw_decode(text, start)
+        if isinstance(value, dict):
+            return value, ""
+    except json.JSONDecodeError:
+        pass
+    members, pos = {}, start + 1
+    while True:
+        pos = _skip(text, pos, " \t\r\n,")
+        if pos >= len(text) or text[pos] == "}":
+            return members, ""
+        try:
+            key, pos = _decoder.raw_decode(text, pos)
+            pos = _skip(text, pos)
+            if not isinstance(key, str) or pos >= len(text) or text[pos] != ":":
+                raise json.JSONDecodeError("Expected ':'", text, pos)
+            value, pos = _decoder.raw_decode(text, _skip(text, pos + 1))
+        except json.JSONDecodeError:
+            return members, text[pos:].strip()
+        members[key] = value
+
+
+# --- validation ---
+
+def valid_field(item):
+    """True for {"field_name": str, "question": str, "box_2d": [ymin, xmin, ymax, xmax]} on the 0-1000 scale."""
+    if not isinstance(item, dict):
+        return False
+    name, question, box = item.get("field_name"), item.get("question"), item.get("box_2d")
+    if not (isinstance(name, str) and name.strip() and isinstance(question, str) and question.strip()):
+        return False
+    if not isinstance(box, list) or len(box) != 4:
+        return False
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= 1000
+               for value in box):
+        return False
+    return box[0] < box[2] and box[1] < box[3]
+
+
+def _missing_complaint_keys(complaint):
+    return [key for key in COMPLAINT_KEYS if not isinstance(complaint.get(key), str)]
+
+
+# --- complaint (report-issue) ---
+
+class ComplaintResult:
+    """Outcome of parsing the report-issue reply; repair_prompt is set when keys are missing."""
+
+    def __init__(self, text):
+        self.raw = text
+        members, self.tail = salvage_object(text)
+        self.complaint = {key: members[key] for key in COMPLAINT_KEYS if isinstance(members.get(key), str)}
+        self.missing = _missing_complaint_keys(self.complaint)
+        if not self.missing:
+            _count('clean' if not self.tail else 'salvaged')
+
+    @property
+    def needs_repair(self):
+        return bool(self.missing)
+
+    def repair_prompt(self):
+        """Text-only re-ask for just the missing keys; the salvaged keys and raw reply are the context."""
+        return f"""
+        A civic complaint draft about a photo was cut off or malformed. Keep what is already there
+        and produce ONLY the missing keys: {", ".join(self.missing)}.
+
+        Already written (do not repeat): {json.dumps(self.complaint, ensure_ascii=False)}
+        Broken part of the original reply: {(self.tail or self.raw)[:2000]}
+
+        Key meanings: "recipient_email" = official email of the relevant Hyderabad authority;
+        "subject" = formal subject line citing [Location]; "body" = formal complaint letter that
+        includes the exact text '[Location]'; "response" = short Markdown summary for the user.
+        Return a JSON object with only those keys.
+        """
+
+    def repair_config(self):
+        return {
+            "response_mime_type": "application/json",
+            "response_schema": {
+                "type": "object",
+                "properties": {key: {"type": "string"} for key in self.missing},
+                "required": list(self.missing),
+            },
+        }
+
+    def merge(self, repair_text):
+        members, _ = salvage_object(repair_text)
+        for key in self.missing:
+            if isinstance(members.get(key), str):
+                self.complaint[key] = members[key]
+        self.missing = _missing_complaint_keys(self.complaint)
+        _count('repaired' if not self.missing else 'repair_failed')
+        return self.value()
+
+    def repair_failed(self):
+        _count('repair_failed')
+        return self.value()
+
+    def value(self):
+        """The complaint with any still-missing keys filled like the old raw-text fallback."""
+        if not self.missing:
+            return dict(self.complaint)
+        log('complaint_incomplete', level='warning', missing=list(self.missing))
+        fallback_text = self.complaint.get("body") or self.raw
+        defaults = {
+            "recipient_email": "",
+            "subject": "Civic Issue Report",
+            "body": fallback_text,
+            "response": self.complaint.get("response") or fallback_text,
+        }
+        return {key: self.complaint.get(key, defaults[key]) for key in COMPLAINT_KEYS}
+
+
+# --- form fields (start-form-fill) ---
+
+class FieldsResult:
+    """Outcome of parsing the form-field array; repair_prompt is set when items are broken or missing."""
+
+    def __init__(self, text):
+        parser = ArrayParser()
+        parser.feed(text)
+        self.fields = [item for item in parser.items if valid_field(item)]
+        self.broken = parser.broken + [json.dumps(item, ensure_ascii=False)
+                                       for item in parser.items if not valid_field(item)]
+        self.truncated = parser.pos is not None and not parser.closed
+        self.tail = parser.tail()
+        self.unparsed = parser.pos is None
+        if self.complete:
+            _count('clean' if len(self.fields) == len(parser.items) else 'salvaged')
+
+    @property
+    def complete(self):
+        return not (self.broken or self.truncated or self.unparsed)
+
+    @property
+    def needs_repair(self):
+        return not self.complete
+
+    def repair_prompt(self):
+        """Asks (with the same image) only for the broken fields and those after the last good one."""
+        done = [field["field_name"] for field in self.fields]
+        problems = []
+        if self.broken:
+            problems.append("These entries were malformed; return corrected versions: " + " | ".join(
+                fragment[:300] for fragment in self.broken))
+        if self.truncated or self.unparsed:
+            after = f' after "{done[-1]}"' if done else ""
+            problems.append(f"The list was cut off{after}; return every remaining blank field{after}.")
+        return f"""
+        You are completing a list of the blank fields on this form image that a citizen must fill in.
+        Already extracted, DO NOT repeat: {json.dumps(done, ensure_ascii=False)}
+        {" ".join(problems)}
+        Each object: "field_name" (short programmatic name), "question" (simple friendly question),
+        "box_2d" ([ymin, xmin, ymax, xmax] of the blank area, normalized to 1000x1000).
+        Return a JSON array containing only the new or corrected fields.
+        """
+
+    def merge(self, repair_text):
+        parser = ArrayParser()
+        parser.feed(repair_text)
+        names = {field["field_name"] for field in self.fields}
+        added = [item for item in parser.items if valid_field(item) and item["field_name"] not in names]
+        if added:
+            self.fields.extend(added)
+            # Corrected fields belong mid-form: restore the top-to-bottom order the wizard asks in
+            self.fields.sort(key=lambda field: (field["box_2d"][0], field["box_2d"][1]))
+        repaired = parser.closed and not parser.broken
+        _count('repaired' if repaired else 'repair_failed')
+        self.broken, self.truncated, self.unparsed = [], not repaired, False
+        return self.fields
+
+    def repair_failed(self):
+        _count('repair_failed')
+        return self.fields
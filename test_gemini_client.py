@@ -0,0 +1,239 @@
+"""
+Behavior tests for gemini_client.py: retries, circuit breakers, model fallback
+and hedging, run against fake_gemini models with scripted outcomes.
+
+    python -m pytest test_gemini_client.py
+"""
+import asyncio
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+import gemini_client
+from fake_gemini import FakeGenerativeModel
+from gemini_client import CallPolicy, CircuitBreaker, GeminiClient, UpstreamUnavailable
+
+
+class ScriptedModel(FakeGenerativeModel):
+    """Plays back (delay, error) outcomes in call order, then answers instantly."""
+
+    def __init__(self, model_name, script=(), **kwargs):
+        super().__init__(model_name, latency=0.0, jitter=0.0, **kwargs)
+        self.script = list(script)
+        self.cancelled = 0
+
+    def _plan(self, contents, request_options=None):
+        with self._lock:
+            self.calls += 1
+            return self.script.pop(0) if self.script else (0.0, None)
+
+    async def generate_content_async(self, contents, **kwargs):
+        try:
+            return await super().generate_content_async(contents, **kwargs)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def unavailable(name='primary'):
+    return 0.0, api_exceptions.ServiceUnavailable(f"{name} is down")
+
+
+def make_client(models, retries=2, hedge_after=0.0, threshold=5, reset=30.0, clock=None):
+    """A client over `models` (name -> ScriptedModel) with one 'chat' policy."""
+    policy = CallPolicy('chat', timeout=5.0, deadline=10.0, retries=retries, hedge_after=hedge_after)
+    return GeminiClient(
+        models=list(models),
+        policies={'chat': policy},
+        model_factory=lambda model_name, **kwargs: models[model_name],
+        breaker_factory=lambda: CircuitBreaker(threshold, reset, clock or FakeClock()),
+    )
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(gemini_client, 'BACKOFF_BASE', 0.0)
+
+
+def test_retries_retryable_error_then_succeeds():
+    primary = ScriptedModel('primary', [unavailable(), (0.0, api_exceptions.ResourceExhausted("quota"))])
+    client = make_client({'primary': primary})
+
+    response = client.generate("How do I pay property tax?")
+
+    assert response.text
+    assert primary.calls == 3
+    counts = client.stats()['policies']['chat']
+    assert (counts['attempts'], counts['retries'], counts['successes']) == (3, 2, 1)
+    assert counts['error_classes'] == {'ServiceUnavailable': 1, 'ResourceExhausted': 1}
+    assert client.breakers['primary'].state == 'closed'
+
+
+def test_async_retries_retryable_error_then_succeeds():
+    primary = ScriptedModel('primary', [unavailable()])
+    client = make_client({'primary': primary})
+
+    response = asyncio.run(client.generate_async("How do I pay property tax?"))
+
+    assert response.text
+    assert primary.calls == 2
+    assert client.stats()['policies']['chat']['retries'] == 1
+
+
+def test_non_retryable_error_is_raised_without_retry_or_fallback():
+    primary = ScriptedModel('primary', [(0.0, api_exceptions.InvalidArgument("bad request"))])
+    fallback = ScriptedModel('fallback')
+    client = make_client({'primary': primary, 'fallback': fallback})
+
+    with pytest.raises(api_exceptions.InvalidArgument):
+        client.generate("hello")
+
+    assert (primary.calls, fallback.calls) == (1, 0)
+    # The upstream answered, so the breaker does not count it as a failure
+    assert client.breakers['primary'].stats()['consecutive_failures'] == 0
+
+
+def test_falls_back_when_primary_keeps_failing():
+    primary = ScriptedModel('primary', [unavailable()] * 3)
+    fallback = ScriptedModel('fallback')
+    client = make_client({'primary': primary, 'fallback': fallback})
+
+    response = client.generate("hello")
+
+    assert response.text
+    assert (primary.calls, fallback.calls) == (3, 1)
+    assert client.stats()['policies']['chat']['fallbacks'] == 1
+
+
+def test_unavailable_when_every_model_fails():
+    primary = ScriptedModel('primary', [unavailable()] * 3)
+    fallback = ScriptedModel('fallback', [unavailable('fallback')] * 3)
+    client = make_client({'primary': primary, 'fallback': fallback})
+
+    with pytest.raises(UpstreamUnavailable) as raised:
+        client.generate("hello")
+
+    assert 'ServiceUnavailable' in str(raised.value)
+    assert client.stats()['policies']['chat']['unavailable'] == 1
+
+
+def test_breaker_opens_and_short_circuits():
+    clock = FakeClock()
+    primary = ScriptedModel('primary', [unavailable()] * 2)
+    fallback = ScriptedModel('fallback')
+    client = make_client({'primary': primary, 'fallback': fallback}, retries=1, threshold=2, reset=30.0, clock=clock)
+
+    client.generate("first")  # Two failures open the primary's breaker; the fallback answers
+    assert client.breakers['primary'].state == 'open'
+
+    client.generate("second")
+    assert primary.calls == 2  # Not tried again while open
+    assert fallback.calls == 2
+    assert client.stats()['policies']['chat']['short_circuits'] == 1
+
+
+def test_open_breakers_fail_fast_with_retry_after():
+    clock = FakeClock()
+    primary = ScriptedModel('primary', [unavailable()] * 2)
+    client = make_client({'primary': primary}, retries=1, threshold=2, reset=30.0, clock=clock)
+
+    with pytest.raises(UpstreamUnavailable):
+        client.generate("first")
+    clock.now = 10.0
+    with pytest.raises(UpstreamUnavailable) as raised:
+        client.generate("second")
+
+    assert primary.calls == 2
+    assert raised.value.retry_after == 20
+
+
+def test_half_open_breaker_lets_one_probe_through():
+    clock = FakeClock()
+    primary = ScriptedModel('primary', [unavailable()] * 2)
+    client = make_client({'primary': primary}, retries=1, threshold=2, reset=30.0, clock=clock)
+    breaker = client.breakers['primary']
+    with pytest.raises(UpstreamUnavailable):
+        client.generate("first")
+
+    clock.now = 31.0
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()  # Only one probe at a time
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_failed_probe_reopens_breaker():
+    clock = FakeClock()
+    primary = ScriptedModel('primary', [unavailable()] * 3)
+    client = make_client({'primary': primary}, retries=1, threshold=2, reset=30.0, clock=clock)
+    with pytest.raises(UpstreamUnavailable):
+        client.generate("first")
+
+    clock.now = 31.0
+    with pytest.raises(UpstreamUnavailable):
+        client.generate("probe")
+
+    breaker = client.breakers['primary']
+    assert primary.calls == 3  # The probe, without a retry
+    assert breaker.state == 'open'
+    assert breaker.retry_after() == 30.0
+    assert breaker.stats()['times_opened'] == 2
+
+
+def test_successful_probe_closes_breaker():
+    clock = FakeClock()
+    primary = ScriptedModel('primary', [unavailable()] * 2)
+    client = make_client({'primary': primary}, retries=1, threshold=2, reset=30.0, clock=clock)
+    with pytest.raises(UpstreamUnavailable):
+        client.generate("first")
+
+    clock.now = 31.0
+    assert client.generate("probe").text
+    assert client.breakers['primary'].state == 'closed'
+
+
+def test_async_hedge_wins_and_cancels_the_slow_attempt():
+    primary = ScriptedModel('primary', [(2.0, None), (0.0, None)])
+    client = make_client({'primary': primary}, hedge_after=0.05)
+
+    async def call():
+        response = await client.generate_async("hello")
+        await asyncio.sleep(0)  # Let the cancellation reach the slow attempt
+        return response
+
+    response = asyncio.run(call())
+
+    assert response.text
+    assert primary.calls == 2
+    assert primary.cancelled == 1
+    counts = client.stats()['policies']['chat']
+    assert (counts['hedges'], counts['hedge_wins']) == (1, 1)
+
+
+def test_async_fast_first_attempt_is_not_hedged():
+    primary = ScriptedModel('primary')
+    client = make_client({'primary': primary}, hedge_after=0.5)
+
+    assert asyncio.run(client.generate_async("hello")).text
+    assert primary.calls == 1
+    assert client.stats()['policies']['chat']['hedges'] == 0
+
+
+def test_sync_hedge_returns_the_first_success():
+    primary = ScriptedModel('primary', [(0.5, None), (0.0, None)])
+    client = make_client({'primary': primary}, hedge_after=0.05)
+
+    response = client.generate("hello")
+
+    assert response.text
+    assert primary.calls == 2
+    assert client.stats()['policies']['chat']['hedge_wins'] == 1
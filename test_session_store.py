@@ -0,0 +1,365 @@
+"""
+Tests for session_store.py: TTL expiry and LRU eviction in the memory and
+SQLite backends, the Redis backend against a local fake, and backend selection.
+
+    python -m pytest test_session_store.py
+"""
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import session_store
+from session_store import MemorySessionStore, RedisSessionStore, SessionStore, SQLiteSessionStore, create_session_store
+
+
+class FakeClock:
+    """Stands in for both time.monotonic (memory backend) and time.time (SQLite backend)."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeRedis:
+    """The redis-py calls RedisSessionStore makes, with expiry on a FakeClock and a maxmemory-style byte cap."""
+
+    def __init__(self, clock, maxmemory=None):
+        self.clock = clock
+        self.maxmemory = maxmemory
+        self.data = {}  # key -> (value, expires_at)
+
+    def _live(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+            del self.data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        entry = self._live(key)
+        return entry[0] if entry else None
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (bytes(value), self.clock() + ex if ex else None)
+        # allkeys-lru stand-in: evict the oldest keys once over maxmemory, never the one just written
+        while self.maxmemory and sum(len(v) for v, _ in self.data.values()) > self.maxmemory and len(self.data) > 1:
+            del self.data[next(k for k in self.data if k != key)]
+        return True
+
+    def expire(self, key, seconds):
+        entry = self._live(key)
+        if entry is None:
+            return False
+        self.data[key] = (entry[0], self.clock() + seconds)
+        return True
+
+    def delete(self, key):
+        return 1 if self.data.pop(key, None) is not None else 0
+
+    def ping(self):
+        return True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(session_store, 'time', SimpleNamespace(monotonic=fake, time=fake))
+    return fake
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+# --- memory ---
+
+def test_memory_round_trip_and_counters(clock):
+    store = MemorySessionStore(ttl_seconds=60)
+    store.put('a', b'form bytes')
+
+    assert store.get('a') == b'form bytes'
+    assert store.get('missing') is None
+    stats = store.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (1, 1, 1, 10)
+
+
+def test_memory_entries_expire_after_ttl(clock):
+    store = MemorySessionStore(ttl_seconds=60)
+    store.put('a', b'x')
+
+    clock.advance(60)
+    assert store.get('a') is None
+    assert store.stats()['expired'] == 1
+    assert store.stats()['entries'] == 0
+
+
+def test_memory_reads_slide_the_expiry(clock):
+    store = MemorySessionStore(ttl_seconds=60)
+    store.put('a', b'x')
+
+    clock.advance(50)
+    assert store.get('a') == b'x'
+    clock.advance(50)
+    assert store.get('a') == b'x'
+    clock.advance(61)
+    assert store.get('a') is None
+
+
+def test_memory_put_reclaims_expired_entries(clock):
+    store = MemorySessionStore(ttl_seconds=60)
+    store.put('old', b'1234')
+    clock.advance(61)
+    store.put('new', b'56')
+
+    stats = store.stats()
+    assert (stats['entries'], stats['bytes'], stats['expired'], stats['evictions']) == (1, 2, 1, 0)
+
+
+def test_memory_evicts_least_recently_used_by_count(clock):
+    store = MemorySessionStore(ttl_seconds=60, max_entries=2)
+    store.put('a', b'1')
+    store.put('b', b'2')
+    store.get('a')  # 'b' is now the least recently used
+    store.put('c', b'3')
+
+    assert store.get('b') is None
+    assert (store.get('a'), store.get('c')) == (b'1', b'3')
+    assert store.stats()['evictions'] == 1
+
+
+def test_memory_evicts_least_recently_used_by_bytes(clock):
+    store = MemorySessionStore(ttl_seconds=60, max_bytes=10)
+    store.put('a', b'aaaa')
+    store.put('b', b'bbbb')
+    store.put('c', b'cccc')
+
+    assert store.get('a') is None
+    assert store.stats()['bytes'] == 8
+    assert store.stats()['evictions'] == 1
+
+
+def test_memory_keeps_newest_entry_even_over_the_ceiling(clock):
+    store = MemorySessionStore(ttl_seconds=60, max_bytes=10)
+    store.put('a', b'aaaa')
+    store.put('big', b'x' * 50)
+
+    assert store.get('a') is None
+    assert store.get('big') == b'x' * 50
+
+
+def test_memory_replacing_a_key_updates_its_size(clock):
+    store = MemorySessionStore(ttl_seconds=60)
+    store.put('a', b'12345678')
+    store.put('a', b'12')
+
+    assert store.stats()['bytes'] == 2
+    store.delete('a')
+    assert store.stats()['entries'] == 0
+    assert store.stats()['bytes'] == 0
+
+
+# --- SQLite ---
+
+def test_sqlite_round_trip_is_shared_between_instances(clock, db_path):
+    writer = SQLiteSessionStore(db_path, 'form', ttl_seconds=60)
+    reader = SQLiteSessionStore(db_path, 'form', ttl_seconds=60)  # Another worker on the same file
+    writer.put('a', b'\x00form bytes\xff')
+
+    assert reader.get('a') == b'\x00form bytes\xff'
+    assert isinstance(reader.get('a'), bytes)
+    assert reader.stats()['entries'] == 1
+    assert reader.ping()
+
+
+def test_sqlite_namespaces_are_separate(clock, db_path):
+    forms = SQLiteSessionStore(db_path, 'form', ttl_seconds=60)
+    jobs = SQLiteSessionStore(db_path, 'job', ttl_seconds=60)
+    forms.put('a', b'form')
+
+    assert jobs.get('a') is None
+    assert jobs.stats()['entries'] == 0
+    jobs.put('a', b'job')
+    assert (forms.get('a'), jobs.get('a')) == (b'form', b'job')
+
+
+def test_sqlite_entries_expire_after_ttl(clock, db_path):
+    store = SQLiteSessionStore(db_path, ttl_seconds=60)
+    store.put('a', b'x')
+
+    clock.advance(60)
+    assert store.get('a') is None
+    assert store.stats()['expired'] == 1
+    assert store.stats()['entries'] == 0
+
+
+def test_sqlite_reads_slide_the_expiry(clock, db_path):
+    store = SQLiteSessionStore(db_path, ttl_seconds=60)
+    store.put('a', b'x')
+
+    clock.advance(50)
+    assert store.get('a') == b'x'
+    clock.advance(50)
+    assert store.get('a') == b'x'
+    clock.advance(61)
+    assert store.get('a') is None
+
+
+def test_sqlite_put_reclaims_expired_entries(clock, db_path):
+    store = SQLiteSessionStore(db_path, ttl_seconds=60)
+    store.put('old', b'1234')
+    clock.advance(61)
+    store.put('new', b'56')
+
+    stats = store.stats()
+    assert (stats['entries'], stats['bytes'], stats['expired'], stats['evictions']) == (1, 2, 1, 0)
+
+
+def test_sqlite_evicts_least_recently_used_by_bytes(clock, db_path):
+    store = SQLiteSessionStore(db_path, ttl_seconds=60, max_bytes=10)
+    store.put('a', b'aaaa')
+    clock.advance(1)
+    store.put('b', b'bbbb')
+    clock.advance(1)
+    store.get('a')  # 'b' is now the least recently used
+    clock.advance(1)
+    store.put('c', b'cccc')
+
+    assert store.get('b') is None
+    assert (store.get('a'), store.get('c')) == (b'aaaa', b'cccc')
+    assert store.stats()['evictions'] == 1
+    assert store.stats()['bytes'] == 8
+
+
+def test_sqlite_keeps_newest_entry_even_over_the_ceiling(clock, db_path):
+    store = SQLiteSessionStore(db_path, ttl_seconds=60, max_bytes=10)
+    store.put('a', b'aaaa')
+    clock.advance(1)
+    store.put('big', b'x' * 50)
+
+    assert store.get('a') is None
+    assert store.get('big') == b'x' * 50
+
+
+def test_sqlite_works_from_other_threads(clock, db_path):
+    store = SQLiteSessionStore(db_path, ttl_seconds=60)
+    store.put('a', b'x')
+    results = []
+
+    def read():
+        results.append(store.get('a'))
+        store.delete('a')
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+
+    assert results == [b'x']
+    assert store.get('a') is None
+
+
+# --- Redis ---
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_redis_round_trip_and_delete(clock):
+    client = FakeRedis(clock)
+    store = RedisSessionStore(client, 'form', ttl_seconds=60)
+    store.put('a', b'form bytes')
+
+    assert store.get('a') == b'form bytes'
+    assert list(client.data) == ['citiassist:form:a']
+    store.delete('a')
+    store.delete('a')  # Missing keys are fine
+    assert store.get('a') is None
+    assert (store.hits, store.misses) == (1, 1)
+    assert store.ping()
+
+
+def test_redis_namespaces_are_separate(clock):
+    client = FakeRedis(clock)
+    forms = RedisSessionStore(client, 'form', ttl_seconds=60)
+    jobs = RedisSessionStore(client, 'job', ttl_seconds=60)
+    forms.put('a', b'form')
+
+    assert jobs.get('a') is None
+    assert forms.get('a') == b'form'
+
+
+def test_redis_entries_expire_after_ttl(clock):
+    store = RedisSessionStore(FakeRedis(clock), ttl_seconds=60)
+    store.put('a', b'x')
+
+    clock.advance(60)
+    assert store.get('a') is None
+    assert store.misses == 1
+
+
+def test_redis_reads_slide_the_expiry(clock):
+    store = RedisSessionStore(FakeRedis(clock), ttl_seconds=60)
+    store.put('a', b'x')
+
+    clock.advance(50)
+    assert store.get('a') == b'x'
+    clock.advance(50)
+    assert store.get('a') == b'x'
+    clock.advance(61)
+    assert store.get('a') is None
+
+
+def test_redis_size_limit_is_left_to_the_server(clock):
+    # maxmemory + an LRU policy evict on the server; the store reports its ceiling and reads evictions as misses
+    store = RedisSessionStore(FakeRedis(clock, maxmemory=10), ttl_seconds=60, max_bytes=10)
+    store.put('a', b'aaaa')
+    store.put('b', b'bbbb')
+    store.put('c', b'cccc')
+
+    assert store.get('a') is None
+    assert (store.get('b'), store.get('c')) == (b'bbbb', b'cccc')
+    stats = store.stats()
+    assert (stats['backend'], stats['max_bytes'], stats['misses'], stats['hits']) == ('RedisSessionStore', 10, 1, 2)
+
+
+def test_redis_store_works_with_fakeredis():
+    fakeredis = pytest.importorskip('fakeredis')
+    store = RedisSessionStore(fakeredis.FakeRedis(), 'form', ttl_seconds=60)
+    store.put('a', b'\x00form\xff')
+
+    assert store.get('a') == b'\x00form\xff'
+    assert 0 < store.client.ttl('citiassist:form:a') <= 60
+    store.delete('a')
+    assert store.get('a') is None
+    assert store.ping()
+
+
+# --- backend selection ---
+
+def test_create_session_store_picks_the_backend(monkeypatch, db_path):
+    monkeypatch.setenv('SESSION_BACKEND', 'sqlite')
+    monkeypatch.setenv('SESSION_DB_PATH', db_path)
+    monkeypatch.setenv('SESSION_MAX_BYTES', '1024')
+    store = create_session_store('form', ttl_seconds=90)
+
+    assert isinstance(store, SQLiteSessionStore)
+    assert (store.namespace, store.ttl_seconds, store.max_bytes) == ('form', 90, 1024)
+
+    monkeypatch.setenv('SESSION_BACKEND', 'memory')
+    monkeypatch.setenv('SESSION_TTL', '120')
+    store = create_session_store('form')
+    assert isinstance(store, MemorySessionStore)
+    assert store.ttl_seconds == 120
+
+
+def test_create_session_store_rejects_unknown_backends(monkeypatch):
+    monkeypatch.setenv('SESSION_BACKEND', 'memcached')
+    with pytest.raises(ValueError):
+        create_session_store('form')
@@ -0,0 +1,134 @@
+"""
+Content-addressed cache for uploads that have been seen before.
+
+The same photo often arrives more than once: a retried /api/report-issue after
+a timeout, or one form sent to /api/analyze-document and then to
+/api/start-form-fill. Every upload is keyed by the SHA-256 of its bytes, and
+two kinds of entries hang off that key:
+
+- variants: the preprocessed image per pipeline mode (image_pipeline), so a
+  repeat skips decoding, resizing and re-encoding;
+- results: an endpoint's finished answer, so a repeat costs a hash instead of
+  a Gemini call. Result keys include a version hash of the prompt, generation
+  config and model, so editing a prompt never serves a stale answer.
+
+Only complete answers are stored; blocked, partial or failed ones are retried
+next time. Entries sit in an in-process LRU (UPLOAD_CACHE_MEMORY_BYTES) in
+front of an SQLite file (UPLOAD_CACHE_PATH) capped at UPLOAD_CACHE_DISK_BYTES
+and shared by every worker on the host. Both tiers are SessionStores, so the
+least recently used entries go first and everything expires after
+UPLOAD_CACHE_TTL seconds without a read.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from image_pipeline import DOCUMENT_MAX_DIM, OUTPUT_FORMAT, PHOTO_MAX_DIM, TARGET_BYTES, PreparedImage
+from session_store import MemorySessionStore, SQLiteSessionStore
+
+UPLOAD_CACHE = os.getenv("UPLOAD_CACHE", "1") == "1"
+UPLOAD_CACHE_TTL = int(os.getenv("UPLOAD_CACHE_TTL", str(7 * 24 * 3600)))
+UPLOAD_CACHE_MEMORY_BYTES = int(os.getenv("UPLOAD_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+# Empty path: memory tier only
+UPLOAD_CACHE_PATH = os.getenv("UPLOAD_CACHE_PATH", "citiassist_uploads.db")
+UPLOAD_CACHE_DISK_BYTES = int(os.getenv("UPLOAD_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+
+def upload_digest(data):
+    """Content address of an upload."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def version_tag(*parts):
+    """Short hash of whatever decides an answer (prompt text, config, model name)."""
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:12]
+
+
+# Preprocessed variants are only reusable while the pipeline settings stay the same
+PIPELINE_VERSION = version_tag(PHOTO_MAX_DIM, DOCUMENT_MAX_DIM, TARGET_BYTES, OUTPUT_FORMAT)
+
+
+def _pack_prepared(prepared):
+    header = {'mime_type': prepared.mime_type, 'size': list(prepared.size), 'stats': prepared.stats}
+    return json.dumps(header).encode('utf-8') + b'\n' + prepared.data
+
+
+def _unpack_prepared(blob):
+    header, data = blob.split(b'\n', 1)
+    header = json.loads(header)
+    return PreparedImage(data, header['mime_type'], tuple(header['size']), header['stats'])
+
+
+class UploadStore:
+    """Variants and results per upload digest, in a memory tier plus an optional shared disk tier."""
+
+    def __init__(self, memory, disk=None, enabled=True):
+        self.memory = memory
+        self.disk = disk
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.counters = {'variant_hits': 0, 'variant_misses': 0, 'result_hits': 0, 'result_misses': 0,
+                         'results_stored': 0, 'bytes_saved': 0}
+
+    @classmethod
+    def from_env(cls):
+        memory = MemorySessionStore(UPLOAD_CACHE_TTL, UPLOAD_CACHE_MEMORY_BYTES)
+        disk = None
+        if UPLOAD_CACHE and UPLOAD_CACHE_PATH:
+            disk = SQLiteSessionStore(UPLOAD_CACHE_PATH, 'upload', UPLOAD_CACHE_TTL, UPLOAD_CACHE_DISK_BYTES)
+        return cls(memory, disk, UPLOAD_CACHE)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def _put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def prepared(self, digest, mode, prepare):
+        """(PreparedImage, reused) for `mode`; `prepare()` runs the pipeline on a miss."""
+        if not self.enabled:
+            return prepare(), False
+        key = f"{digest}:variant:{mode}:{PIPELINE_VERSION}"
+        blob = self._get(key)
+        if blob is not None:
+            prepared = _unpack_prepared(blob)
+            self._count('variant_hits')
+            self._count('bytes_saved', prepared.stats.get('original_bytes', 0))
+            return prepared, True
+        self._count('variant_misses')
+        prepared = prepare()
+        self._put(key, _pack_prepared(prepared))
+        return prepared, False
+
+    def result(self, digest, endpoint, version):
+        """The stored answer for this upload at `endpoint`, or None."""
+        if not self.enabled:
+            return None
+        blob = self._get(f"{digest}:result:{endpoint}:{version}")
+        self._count('result_hits' if blob is not None else 'result_misses')
+        return json.loads(blob) if blob is not None else None
+
+    def put_result(self, digest, endpoint, version, value):
+        """Stores a complete answer (anything json.dumps accepts)."""
+        if not self.enabled:
+            return
+        self._put(f"{digest}:result:{endpoint}:{version}", json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        self._count('results_stored')
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(counters, enabled=self.enabled, pipeline_version=PIPELINE_VERSION,
+                    memory=self.memory.stats(), disk=self.disk.stats() if self.disk is not None else None)